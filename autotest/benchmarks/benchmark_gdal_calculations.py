@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Project:  Gdal Calculations benchmarks
+# Purpose:  Time gdal_calculations workloads on synthetic rasters
+# Author:   Luke Pinner
+###############################################################################
+# Copyright (c) 2013, Luke Pinner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+'''
+Benchmark gdal_calculations workloads on synthetic rasters.
+
+Synthetic 4 band UInt16 "dates" are generated for every combination of:
+    --sizes        : raster width/height in pixels (Default=1000 5000),
+                     e.g. --sizes 1000 5000 10000 20000 for the full suite.
+                     Note each date is size*size*8 bytes uncompressed.
+    --layouts      : "striped" (one row blocks) and/or "tiled" (256x256 blocks)
+    --compression  : GTiff COMPRESS option, "NONE" and/or "DEFLATE"
+    --srs          : "match" (all dates in the same SRS) and/or "reproject"
+                     (every second date is warped to a different SRS)
+    --nodata       : "none" and/or "nodata" (NoData=0 with ~10% NoData pixels,
+                     processed with Env.nodata=True)
+
+and the following workloads are timed:
+    ndvi           : (nir-red)/(nir+red) using NIR from one date and red from another
+    reclass        : range reclassification of a band
+    reductions     : statistics and percentiles of a band
+    stack          : mean and median composites of a DatasetStack of the dates
+
+in the following modes (--modes):
+    tiled          : Env.tiled=True
+    untiled        : Env.tiled=False
+    numexpr        : numexpr.evaluate on the whole bands, read explicitly with
+                     ReadAsArray after apply_environment (ndvi only, requires numexpr,
+                     NoData is not masked)
+
+Results are printed and, with --output results.json, written as JSON with the
+software versions and a list of results, each with a unique "name"
+(workload/mode/size/layout/compression/srs/nodata) so runs from different
+versions can be compared. Each result has the wall time (seconds), CPU time
+(cpu_seconds) and, from Env.iocounter, the bytes read, decoded and written.
+With --profile, Env.profile is set and the peak memory use (Env.profiler.memory())
+of each run is also recorded.
+
+With --baseline, the results are compared with the baseline of the default suite
+stored in the repository (baselines/default.json) by compare_benchmarks.py (see
+that script for the --tolerance options), or with --baseline baseline.json with
+another stored baseline, e.g.
+    python benchmark_gdal_calculations.py --baseline
+    ...change gdal_dataset.py...
+    python benchmark_gdal_calculations.py --baseline
+
+--update-baseline runs the suite and replaces baselines/default.json, see
+baselines/README for when and how to regenerate it.
+
+Usage:
+    python benchmark_gdal_calculations.py [--sizes 1000 5000] [--workloads ndvi stack]
+                                          [--modes tiled untiled] [--repeat 3]
+                                          [--output results.json] [--datadir dir] [--keep]
+                                          [--profile] [--baseline [baseline.json] [--tolerance 0.1]]
+                                          [--update-baseline]
+'''
+
+import sys
+import os
+import json
+import time
+import shutil
+import platform
+import tempfile
+from timeit import default_timer as timer
+
+import numpy as np
+from osgeo import gdal, osr
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..','lib'))
+
+import gdal_calculations
+from gdal_calculations import *
+
+import compare_benchmarks
+
+BASELINE=os.path.join(os.path.dirname(os.path.abspath(__file__)),'baselines','default.json')
+SIZES=['1000','5000']
+LAYOUTS=['striped','tiled']
+COMPRESSION=['NONE','DEFLATE']
+SRS=['match','reproject']
+NODATA=['none','nodata']
+WORKLOADS=['ndvi','reclass','reductions','stack']
+MODES=['tiled','untiled','numexpr']
+
+NDATES=4
+NBANDS=4
+BLOCKSIZE=256
+EPSG=(32755,3577) #UTM zone 55S and Australian Albers
+GEOTRANSFORM=[600000,30,0,6100000,0,-30]
+
+###############################################################################
+#Synthetic data
+def srs_wkt(epsg):
+    srs=osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    return srs.ExportToWkt()
+
+def creation_options(layout,compression):
+    options=['BIGTIFF=IF_SAFER']
+    if layout=='tiled':options+=['TILED=YES','BLOCKXSIZE=%s'%BLOCKSIZE,'BLOCKYSIZE=%s'%BLOCKSIZE]
+    if compression!='NONE':options.append('COMPRESS=%s'%compression)
+    return options
+
+def create_date(path,size,layout,compression,nodata,seed):
+    ''' Create a 4 band UInt16 raster of smooth surfaces plus noise, written in strips'''
+    driver=gdal.GetDriverByName('GTiff')
+    ds=driver.Create(path,size,size,NBANDS,gdal.GDT_UInt16,creation_options(layout,compression))
+    ds.SetGeoTransform(GEOTRANSFORM)
+    ds.SetProjection(srs_wkt(EPSG[0]))
+    random=np.random.RandomState(seed)
+    nrows=max(1,2**20//size)
+    x=np.arange(size,dtype=np.float32)
+    for i in range(NBANDS):
+        band=ds.GetRasterBand(i+1)
+        if nodata=='nodata':band.SetNoDataValue(0)
+        for yoff in range(0,size,nrows):
+            y=np.arange(yoff,min(yoff+nrows,size),dtype=np.float32)[:,np.newaxis]
+            data=(np.sin(x/(50.0+i*10))+np.cos(y/(70.0+seed))+2)*2000*(i+1)
+            data=data+random.randint(0,100,data.shape)
+            if nodata=='nodata':data[random.rand(*data.shape)<0.1]=0
+            band.WriteArray(data.astype(np.uint16),0,yoff)
+    ds=None
+
+def reproject_date(path,outpath,layout,compression):
+    ''' Warp a date to the second SRS'''
+    src=gdal.Open(path)
+    vrt=gdal.AutoCreateWarpedVRT(src,None,srs_wkt(EPSG[1]),gdal.GRA_NearestNeighbour)
+    ds=gdal.GetDriverByName('GTiff').CreateCopy(outpath,vrt,options=creation_options(layout,compression))
+    ds=vrt=src=None
+
+def create_dates(datadir,size,layout,compression,srs,nodata):
+    ''' Get the paths of the synthetic dates, creating them if they don't exist'''
+    paths=[]
+    for i in range(NDATES):
+        name='%s_%s_%s_%s_%s'%(size,layout,compression,nodata,i)
+        path=os.path.join(datadir,'date_%s.tif'%name)
+        if not os.path.exists(path):create_date(path,size,layout,compression,nodata,i)
+        if srs=='reproject' and i%2:
+            warped=os.path.join(datadir,'date_%s_%s.tif'%(name,EPSG[1]))
+            if not os.path.exists(warped):reproject_date(path,warped,layout,compression)
+            path=warped
+        paths.append(path)
+    return paths
+
+###############################################################################
+#Workloads, each returns the number of bands read
+def ndvi(paths,mode):
+    nir=Dataset(paths[0])[3]
+    red=Dataset(paths[1])[2]
+    if mode=='numexpr':
+        import numexpr
+        nir,red=Float32(nir),Float32(red)
+        nir,red=nir.apply_environment(red)
+        arrays={'nir':nir.ReadAsArray(),'red':red.ReadAsArray()}
+        out=ArrayDataset(numexpr.evaluate('(nir-red)/(nir+red)',local_dict=arrays),
+                         prototype_ds=nir)
+    else:
+        red=Float32(red)
+        out=(nir-red)/(nir+red)
+    return 2
+
+def reclass_(paths,mode):
+    out=reclass(Dataset(paths[0])[0],[(0,2000,1),(2000,4000,2),(4000,6000,3),(6000,65536,4)])
+    return 1
+
+def reductions(paths,mode):
+    band=Dataset(paths[0])[0]
+    stats=band.statistics()
+    percentiles=band.percentile([5,50,95])
+    return 2
+
+def stack(paths,mode):
+    ds=DatasetStack(paths,band=3)
+    mean=ds.reduce('mean')
+    median=ds.reduce('median')
+    return 2*len(paths)
+
+#Workload functions and the modes they support
+WORKLOAD_FUNCTIONS={'ndvi':(ndvi,MODES),
+                    'reclass':(reclass_,['tiled','untiled']),
+                    'reductions':(reductions,['tiled','untiled']),
+                    'stack':(stack,['tiled','untiled'])}
+
+###############################################################################
+def cpu_time():
+    times=os.times()
+    return times[0]+times[1] #user+system
+
+def run(workload,mode,paths,nodata,tempdir):
+    ''' Run a workload once and return the elapsed and CPU seconds and number of bands read'''
+    Env.profiler.reset()
+    Env.iocounter.reset()
+    Env.tiled=mode=='tiled'
+    Env.enable_numexpr=mode=='numexpr'
+    Env.nodata=nodata=='nodata'
+    Env.reproject=True
+    Env.overwrite=True
+    Env.tempdir=tempdir
+
+    func=WORKLOAD_FUNCTIONS[workload][0]
+    start,cpu=timer(),cpu_time()
+    bands=func(paths,mode)
+    return timer()-start,cpu_time()-cpu,bands
+
+def iocounts():
+    ''' Get the bytes read, decoded and written in the last run'''
+    summary=Env.iocounter.summary()
+    return {'bytes_read':sum([s['bytes'] for s in summary['sources'].values()]),
+            'bytes_decoded':sum([s['bytes_decoded'] for s in summary['sources'].values()]),
+            'bytes_written':sum([w['bytes'] for w in summary['written'].values()])}
+
+def benchmark(args):
+    results=[]
+    for size in map(int,args.sizes):
+        for layout in args.layouts:
+            for compression in args.compression:
+                for nodata in args.nodata:
+                    for srs in args.srs:
+                        paths=None
+                        for workload in args.workloads:
+                            #Single date workloads aren't affected by reprojection
+                            if srs=='reproject' and workload in ('reclass','reductions'):continue
+                            for mode in args.modes:
+                                if mode not in WORKLOAD_FUNCTIONS[workload][1]:continue
+                                if paths is None:
+                                    paths=create_dates(args.datadir,size,layout,compression,srs,nodata)
+                                result={'name':'/'.join(map(str,[workload,mode,size,layout,compression.lower(),srs,nodata])),
+                                        'workload':workload,'mode':mode,'size':size,'layout':layout,
+                                        'compression':compression,'srs':srs,'nodata':nodata,'pixels':size*size}
+                                try:
+                                    runs,cpu=[],[]
+                                    for i in range(args.repeat):
+                                        seconds,cpu_seconds,bands=run(workload,mode,paths,nodata,args.tempdir)
+                                        runs.append(seconds)
+                                        cpu.append(cpu_seconds)
+                                    seconds=min(runs)
+                                    result['cpu_seconds']=min(cpu)
+                                    result.update(iocounts())
+                                    if args.profile:result['memory']=Env.profiler.memory()
+                                    nbytes=size*size*bands*gdal.GetDataTypeSize(gdal.GDT_UInt16)/8
+                                    result.update({'seconds':seconds,'runs':runs,'bytes':nbytes,
+                                                   'mpixels_per_second':size*size/seconds/1e6,
+                                                   'mbytes_per_second':nbytes/seconds/2**20})
+                                    print('%-60s %10.3f s %10.2f Mpixel/s %10.2f MB/s'%(
+                                        result['name'],seconds,result['mpixels_per_second'],result['mbytes_per_second']))
+                                except Exception as e:
+                                    result['error']='%s: %s'%(type(e).__name__,e)
+                                    print('%-60s %s'%(result['name'],result['error']))
+                                results.append(result)
+    return results
+
+def metadata():
+    try:import numexpr;numexpr_version=numexpr.__version__
+    except ImportError:numexpr_version=None
+    return {'gdal_calculations':gdal_calculations.__version__,
+            'gdal':gdal.VersionInfo('RELEASE_NAME'),
+            'numpy':np.__version__,
+            'numexpr':numexpr_version,
+            'python':platform.python_version(),
+            'platform':platform.platform(),
+            'date':time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def main():
+    from argparse import ArgumentParser
+    argparser=ArgumentParser(description='Benchmark gdal_calculations workloads on synthetic rasters')
+    argparser.add_argument('--sizes', nargs='+', default=SIZES, help='Raster sizes (pixels, default %s)'%' '.join(SIZES))
+    argparser.add_argument('--layouts', nargs='+', default=LAYOUTS, choices=LAYOUTS)
+    argparser.add_argument('--compression', nargs='+', default=COMPRESSION, type=str.upper, help='GTiff COMPRESS options (default %s)'%' '.join(COMPRESSION))
+    argparser.add_argument('--srs', nargs='+', default=SRS, choices=SRS)
+    argparser.add_argument('--nodata', nargs='+', default=NODATA, choices=NODATA)
+    argparser.add_argument('--workloads', nargs='+', default=WORKLOADS, choices=WORKLOADS)
+    argparser.add_argument('--modes', nargs='+', default=MODES, choices=MODES)
+    argparser.add_argument('--repeat', type=int, default=1, help='Number of runs of each benchmark, the fastest is reported')
+    argparser.add_argument('--output', default=None, help='JSON results file')
+    argparser.add_argument('--datadir', default=None, help='Directory for the synthetic rasters (default a new temporary directory)')
+    argparser.add_argument('--tempdir', default=None, help='Env.tempdir for temporary rasters, can be /vsimem')
+    argparser.add_argument('--profile', default=False, action='store_true', help='Set Env.profile and record the peak memory use')
+    argparser.add_argument('--keep', default=False, action='store_true', help="Don't delete the synthetic rasters")
+    argparser.add_argument('--baseline', default=None, nargs='?', const=BASELINE,
+                           help='Compare the results with a baseline JSON results file (default baselines/default.json)')
+    argparser.add_argument('--update-baseline', dest='update_baseline', default=False, action='store_true',
+                           help='Write the results to baselines/default.json')
+    argparser.add_argument('--tolerance', default=[], action='append',
+                           help='Relative increase allowed before a result is a regression, '
+                                'either a fraction for all metrics or metric=fraction (default %s)'%compare_benchmarks.TOLERANCE)
+    args=argparser.parse_args()
+    if args.baseline and not os.path.exists(args.baseline):
+        argparser.error('baseline %s does not exist, create it with --update-baseline (see baselines/README)'%args.baseline)
+
+    if 'numexpr' in args.modes:
+        try:import numexpr
+        except ImportError:
+            print('numexpr is not installed, skipping numexpr benchmarks')
+            args.modes.remove('numexpr')
+
+    gdal.UseExceptions()
+    Env.profile=args.profile
+    Env.iocount=True
+    tempdir=args.datadir is None
+    if tempdir:args.datadir=tempfile.mkdtemp(prefix='gdal_calculations_benchmark_')
+    elif not os.path.isdir(args.datadir):os.makedirs(args.datadir)
+    if args.tempdir is None:args.tempdir=args.datadir
+
+    try:
+        results={'metadata':metadata(),'results':benchmark(args)}
+        for output in (args.output,args.update_baseline and BASELINE):
+            if not output:continue
+            with open(output,'w') as f:
+                json.dump(results,f,indent=1,sort_keys=True)
+    finally:
+        if tempdir and not args.keep:shutil.rmtree(args.datadir,ignore_errors=True)
+
+    if args.baseline:
+        baseline=compare_benchmarks.load(args.baseline)
+        comparisons=compare_benchmarks.compare(baseline,results,compare_benchmarks.tolerances(args.tolerance))
+        print('')
+        print(compare_benchmarks.report(comparisons,baseline=baseline,current=results))
+        if compare_benchmarks.regressions(comparisons):sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Project:  Gdal Calculations benchmarks
+# Purpose:  Compare benchmark results with a stored baseline
+# Author:   Luke Pinner
+###############################################################################
+# Copyright (c) 2013, Luke Pinner
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+###############################################################################
+'''
+Compare benchmark_gdal_calculations.py results with a stored baseline.
+
+The baseline of the default suite is stored in baselines/default.json (see
+baselines/README), other baselines can be stored by running the benchmarks with
+--output. Compare a fresh run with a baseline:
+    python benchmark_gdal_calculations.py --output results.json
+    python compare_benchmarks.py baselines/default.json results.json
+
+Results are matched by name (workload/mode/size/layout/compression/srs/nodata)
+and each metric is compared:
+    seconds, cpu_seconds                   : wall and CPU time
+    bytes_read, bytes_decoded, bytes_written : from Env.iocounter
+    memory.*                               : peak memory (benchmarks run with --profile)
+
+A metric is a regression if it increased by more than the tolerance
+(--tolerance 0.1, i.e. 10%, for all metrics or --tolerance seconds=0.25 for
+one metric) and an improvement if it decreased by more than the tolerance.
+Time differences smaller than --min-seconds are ignored as noise. A benchmark
+that fails but passed in the baseline is also a regression.
+
+The report lists the regressions and improvements (--all lists every
+comparison) and the exit status is 1 if there are any regressions.
+
+Usage:
+    python compare_benchmarks.py baseline.json results.json [--tolerance 0.1]
+                                 [--tolerance seconds=0.25] [--min-seconds 0.05]
+                                 [--metrics seconds bytes_read] [--all]
+'''
+
+import sys
+import json
+
+METRICS=['seconds','cpu_seconds','bytes_read','bytes_decoded','bytes_written',
+         'memory.buffer_bytes','memory.cache_bytes','memory.vsimem_bytes','memory.temporary_bytes']
+TOLERANCE=0.1
+MIN_SECONDS=0.05
+METADATA=['gdal_calculations','gdal','numpy','numexpr','python','platform','date']
+
+def load(path):
+    ''' Load a JSON results file'''
+    with open(path) as f:
+        return json.load(f)
+
+def tolerances(values):
+    ''' Parse a list of "fraction" or "metric=fraction" tolerances into a
+        dict of {metric:fraction}, the None key is the default'''
+    tolerance={None:TOLERANCE}
+    for value in values:
+        if '=' in value:
+            metric,value=value.split('=',1)
+            tolerance[metric.strip()]=float(value)
+        else:tolerance[None]=float(value)
+    return tolerance
+
+def value(result,metric):
+    ''' Get a (dotted, i.e. memory.buffer_bytes) metric from a result or None'''
+    for key in metric.split('.'):
+        try:result=result[key]
+        except (KeyError,TypeError):return None
+    return result
+
+def compare(baseline,current,tolerance={},min_seconds=MIN_SECONDS,metrics=METRICS):
+    ''' Compare current results with baseline results and return a list of
+        comparison dicts of name, metric, baseline, current, change and status, one of
+        "ok", "regression", "improvement", "new", "missing" or "error"'''
+    default=tolerance.get(None,TOLERANCE)
+    baseline=dict([(r['name'],r) for r in baseline['results']])
+    comparisons=[]
+    names=[r['name'] for r in current['results']]
+    current=dict([(r['name'],r) for r in current['results']])
+    names+=sorted([n for n in baseline if n not in current])
+
+    for name in names:
+        old,new=baseline.get(name),current.get(name)
+        if old is None or new is None:
+            comparisons.append({'name':name,'metric':'','baseline':None,'current':None,'change':None,
+                                'status':'new' if old is None else 'missing'})
+            continue
+        if 'error' in new or 'error' in old:
+            status='ok'
+            if 'error' in new and 'error' not in old:status='error'
+            comparisons.append({'name':name,'metric':'error','baseline':old.get('error'),
+                                'current':new.get('error'),'change':None,'status':status})
+            continue
+
+        for metric in metrics:
+            a,b=value(old,metric),value(new,metric)
+            if a is None or b is None:continue
+            if a:change=(b-a)/float(a)
+            elif b:change=float('inf')
+            else:change=0.0
+            limit=tolerance.get(metric,default)
+            if metric.endswith('seconds') and abs(b-a)<min_seconds:status='ok'
+            elif change>limit:status='regression'
+            elif change<-limit:status='improvement'
+            else:status='ok'
+            comparisons.append({'name':name,'metric':metric,'baseline':a,'current':b,
+                                'change':change,'status':status})
+    return comparisons
+
+def regressions(comparisons):
+    ''' Get the comparisons that are regressions or errors'''
+    return [c for c in comparisons if c['status'] in ('regression','error')]
+
+def format_value(metric,value):
+    if value is None:return '-'
+    if metric.endswith('seconds'):return '%.3f s'%value
+    if 'bytes' in metric:return '%.1f MB'%(value/2.0**20)
+    return str(value)
+
+def report(comparisons,all=False,baseline=None,current=None):
+    ''' Format the comparisons as a text report'''
+    lines=[]
+    if baseline is not None and current is not None:
+        row='%-20s %-30s %-30s'
+        lines.append(row%('','Baseline','Current'))
+        for key in METADATA:
+            old,new=baseline['metadata'].get(key),current['metadata'].get(key)
+            lines.append(row%(key,str(old)[:30],str(new)[:30]))
+        lines.append('')
+
+    row='%-50s %-22s %12s %12s %8s  %s'
+    lines.append(row%('Benchmark','Metric','Baseline','Current','Change','Status'))
+    lines.append(row%('-'*50,'-'*22,'-'*12,'-'*12,'-'*8,'-'*11))
+    for c in comparisons:
+        if not all and c['status']=='ok':continue
+        if c['metric']=='error':
+            lines.append(row%(c['name'][-50:],'error','','','',c['status'].upper()))
+            lines.append('    baseline: %s'%c['baseline'])
+            lines.append('    current:  %s'%c['current'])
+            continue
+        if c['change'] is None:change=''
+        else:change='%+.1f%%'%(c['change']*100)
+        lines.append(row%(c['name'][-50:],c['metric'],format_value(c['metric'],c['baseline']),
+                          format_value(c['metric'],c['current']),change,c['status'].upper()))
+    lines.append('')
+
+    names=set([c['name'] for c in comparisons])
+    counts=dict([(s,len(set([c['name'] for c in comparisons if c['status']==s])))
+                 for s in ('regression','improvement','new','missing','error')])
+    lines.append('%s benchmarks compared: %s with regressions, %s with improvements, '
+                 '%s new, %s missing, %s errors'%(len(names),counts['regression'],counts['improvement'],
+                                                 counts['new'],counts['missing'],counts['error']))
+    return '\n'.join(lines)
+
+def main():
+    from argparse import ArgumentParser
+    argparser=ArgumentParser(description='Compare benchmark_gdal_calculations.py results with a stored baseline')
+    argparser.add_argument('baseline', help='Baseline JSON results file')
+    argparser.add_argument('current', help='JSON results file to compare with the baseline')
+    argparser.add_argument('--tolerance', default=[], action='append',
+                           help='Relative increase allowed before a result is a regression, '
+                                'either a fraction for all metrics or metric=fraction (default %s)'%TOLERANCE)
+    argparser.add_argument('--min-seconds', type=float, default=MIN_SECONDS,
+                           help='Ignore time differences smaller than this (default %s)'%MIN_SECONDS)
+    argparser.add_argument('--metrics', nargs='+', default=METRICS, help='Metrics to compare (default all)')
+    argparser.add_argument('--all', default=False, action='store_true', help='List every comparison, not just the changes')
+    args=argparser.parse_args()
+
+    baseline,current=load(args.baseline),load(args.current)
+    comparisons=compare(baseline,current,tolerances(args.tolerance),args.min_seconds,args.metrics)
+    print(report(comparisons,args.all,baseline,current))
+    if regressions(comparisons):sys.exit(1)
+
+if __name__ == '__main__':
+    main()
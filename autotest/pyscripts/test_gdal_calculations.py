@@ -937,6 +937,1087 @@ def test_gdal_calculations_py_19():
     finally:
         cleanup()
 
+def test_gdal_calculations_py_20():
+    ''' Test mask band handling '''
+    try:
+        from gdal_calculations import Dataset, Env
+        Env.tempdir='/vsimem'
+
+        #Regular raster with a per-dataset mask and no nodata value
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        tmp=gdal.GetDriverByName('GTiff').CreateCopy('/vsimem/tgc_20.tif',dsf._dataset)
+        tmp.CreateMaskBand(gdal.GMF_PER_DATASET)
+        mask=np.ones((dsf.y_size,dsf.x_size),np.uint8)*255
+        mask[0,0]=0
+        tmp.GetRasterBand(1).GetMaskBand().WriteArray(mask)
+        tmp=None
+        dsm=Dataset('/vsimem/tgc_20.tif')
+
+        #Mask bands are ignored by default
+        Env.nodata=True
+        out=dsm+1
+        val=out[0].GetMaskBand().ReadAsArray(0, 0, 1, 1)
+        assert val==255, "out[0].GetMaskBand().ReadAsArray(0, 0, 1, 1)==%s"%repr(val)
+
+        Env.maskbands=True
+        out=dsm+1
+        val=out[0].GetMaskBand().ReadAsArray(0, 0, 2, 1)
+        assert (val[0][0],val[0][1])==(0,255), "out[0].GetMaskBand().ReadAsArray(0, 0, 2, 1)==%s"%repr(val)
+        val=out.ReadAsArray(1, 0, 1, 1)
+        assert val==3, "out.ReadAsArray(1, 0, 1, 1)==%s"%repr(val)
+
+        #Blocks read the mask alongside the data
+        for block in dsm.ReadBlocksAsArray():
+            assert block.mask[0,0] and not block.mask[0,1], "block.mask[0,0:2]==%s"%repr(block.mask[0,0:2])
+            break
+
+        dsf,dsm,out=None,None,None
+        gdal.Unlink('/vsimem/tgc_20.tif')
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_21():
+    ''' Test NaN nodata handling '''
+    try:
+        from gdal_calculations import Dataset, Env, Float32
+        Env.tempdir='/vsimem'
+
+        f='data/tgc_geo_resize.vrt'
+        dsf=Dataset(f, gdal.GA_ReadOnly)
+        #Create a copy of the VRT so GDAL doesn't modify it on disk
+        dsg=Dataset(gdal.GetDriverByName('VRT').CreateCopy('',dsf._dataset))
+        dsg[0].SetNoDataValue(0)
+
+        Env.nodata='nan'
+        assert Env.nodata=='NAN', "Env.nodata != 'NAN' ('%s')"%Env.nodata
+        try:Env.nodata='INCORRECT'
+        except:pass
+        else:return fail('Env.nodata accepted an incorrect value')
+
+        #Integer data with nodata is promoted and nodata written back
+        out=dsg[0]+1
+        val=out.ReadAsArray(0, 0, 1, 1)
+        assert val==0, "out.ReadAsArray(0, 0, 1, 1)==%s"%repr(val)
+        assert out.nodata==[0], "out.nodata==%s"%repr(out.nodata)
+
+        #Float data
+        out=Float32(dsg[0])*2
+        assert out.data_type==gdal.GDT_Float32, "data_type!=Float32 (%s)"%gdal.GetDataTypeName(out.data_type)
+        val=out.ReadAsArray(0, 0, 1, 1)
+        assert val==0, "out.ReadAsArray(0, 0, 1, 1)==%s"%repr(val)
+
+        #Boolean results
+        out=dsg[0]<1
+        val=out.ReadAsArray(0, 0, 1, 1)
+        assert val==0, "out.ReadAsArray(0, 0, 1, 1)==%s"%repr(val)
+
+        dsf,dsg,out=None,None,None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_22():
+    ''' Test skipping empty windows '''
+    try:
+        from gdal_calculations import Dataset, Env
+        Env.tempdir='/vsimem'
+
+        #Sparse tiled raster with only one block written
+        fn='/vsimem/tgc_22.tif'
+        tmp=gdal.GetDriverByName('GTiff').Create(fn,64,64,1,gdal.GDT_Int16,
+                 ['TILED=YES','BLOCKXSIZE=16','BLOCKYSIZE=16','SPARSE_OK=TRUE'])
+        tmp.SetGeoTransform([147.5, 0.01, 0.0, -34.5, 0.0, -0.01])
+        tmp.GetRasterBand(1).SetNoDataValue(-1)
+        tmp.GetRasterBand(1).WriteArray(np.ones((16,16),np.int16)*5,16,16)
+        tmp=None
+        dss=Dataset(fn)
+
+        Env.nodata=True
+        Env.sparse=True
+        out=dss*2
+        val=out.ReadAsArray(16, 16, 1, 1)
+        assert val==10, "out.ReadAsArray(16, 16, 1, 1)==%s"%repr(val)
+        val=out.ReadAsArray(40, 40, 1, 1)
+        assert val==-1, "out.ReadAsArray(40, 40, 1, 1)==%s"%repr(val)
+        assert out.nodata==[-1], "out.nodata==%s"%repr(out.nodata)
+
+        dss,out=None,None
+        gdal.Unlink(fn)
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_23():
+    ''' Test streaming statistics '''
+    try:
+        from gdal_calculations import Dataset, Env, Statistics
+        Env.tiled=True
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        values=np.arange(1,10001,dtype=np.float64)
+
+        #numpy reductions
+        s=dsf.sum()
+        assert s==50005000, "dsf.sum()==%s"%repr(s)
+        s=dsf.max()
+        assert s==10000, "dsf.max()==%s"%repr(s)
+        s=dsf.min()
+        assert s==1, "dsf.min()==%s"%repr(s)
+        s=dsf.mean()
+        assert approx_equal(s,values.mean()), "dsf.mean()==%s"%repr(s)
+        s=dsf.std(ddof=1)
+        assert approx_equal(s,values.std(ddof=1)), "dsf.std(ddof=1)==%s"%repr(s)
+
+        #Masked
+        stats=dsf.statistics(mask=dsf>5000)
+        assert isinstance(stats,Statistics), "isinstance(%s,Statistics)!=True"%repr(stats)
+        assert stats.count()==5000, "stats.count()==%s"%repr(stats.count())
+        assert stats.min()==5001, "stats.min()==%s"%repr(stats.min())
+
+        #Per band
+        f='data/tgc_multiband.tif'
+        dsm=Dataset(f)
+        stats=dsm.statistics(per_band=True)
+        assert len(stats.mean())==dsm.nbands, "len(stats.mean())==%s"%repr(len(stats.mean()))
+        vals=dsm.ReadAsArray().reshape(dsm.nbands,-1)
+        assert approx_equal(stats.max(),vals.max(axis=1)), "stats.max()==%s"%repr(stats.max())
+
+        #Tiled reductions match the untiled (numpy) results and datatypes
+        fn='/vsimem/tgc_23.tif'
+        tmp=gdal.GetDriverByName('GTiff').Create(fn,16,16,1,gdal.GDT_Float32)
+        tmp.SetGeoTransform([147.5, 0.01, 0.0, -34.5, 0.0, -0.01])
+        data=np.arange(256,dtype=np.float32).reshape(16,16)
+        data[3,3]=np.nan
+        tmp.GetRasterBand(1).WriteArray(data)
+        tmp=None
+        dsn=Dataset(fn)
+        for ds in (dsf,dsn):
+            for attr in ('sum','min','max','mean'):
+                Env.tiled=True
+                tiled=getattr(ds,attr)()
+                Env.tiled=False
+                untiled=getattr(ds,attr)()
+                if np.isnan(untiled):assert np.isnan(tiled), "tiled %s()==%s, untiled==nan"%(attr,repr(tiled))
+                else:assert approx_equal(tiled,untiled), "tiled %s()==%s, untiled==%s"%(attr,repr(tiled),repr(untiled))
+                kinds=[np.asarray(v).dtype.kind.replace('u','i') for v in (tiled,untiled)]
+                assert kinds[0]==kinds[1], "tiled %s() dtype==%s, untiled==%s"%(attr,np.asarray(tiled).dtype,np.asarray(untiled).dtype)
+        Env.tiled=True
+
+        #Empty and all masked blocks don't change the statistics
+        stats=Statistics()
+        stats.update(np.arange(10,dtype=np.int16))
+        stats.update(np.zeros((0,0),np.int16))
+        stats.update(np.ma.masked_all((4,4),np.int16))
+        other=Statistics().update(np.arange(10,20,dtype=np.int16))
+        stats.merge(other)
+        stats.merge(Statistics())
+        assert stats.count()==20 and stats.sum()==190, "(count,sum)==%s"%repr((stats.count(),stats.sum()))
+        assert stats.min()==0 and stats.max()==19, "(min,max)==%s"%repr((stats.min(),stats.max()))
+        assert approx_equal(stats.var(),np.arange(20).var()), "var()==%s"%repr(stats.var())
+        assert np.isnan(Statistics().mean()), "Statistics().mean() is not NaN"
+
+        dsf,dsm,dsn=None,None,None
+        gdal.Unlink(fn)
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_24():
+    ''' Test streaming histograms and percentiles '''
+    try:
+        from gdal_calculations import Dataset, Env, Histogram
+        Env.tiled=True
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+
+        #Auto range
+        hist=dsf.histogram(bins=100)
+        assert isinstance(hist,Histogram), "isinstance(%s,Histogram)!=True"%repr(hist)
+        assert hist.counts.sum()==10000, "hist.counts.sum()==%s"%repr(hist.counts.sum())
+        assert hist.edges[0]==1 and hist.edges[-1]==10000, "hist.edges==%s"%repr(hist.edges)
+        p=hist.percentile(50)
+        assert abs(p-5000.5)<100, "hist.percentile(50)==%s"%repr(p)
+
+        #Fixed range
+        hist=dsf.histogram(bins=10,range=(0,5000))
+        assert hist.counts.sum()==5000, "hist.counts.sum()==%s"%repr(hist.counts.sum())
+        assert hist.outside==5000, "hist.outside==%s"%repr(hist.outside)
+
+        #Sketch
+        p=dsf.percentile([10,50,90])
+        assert np.all(np.abs(p-[1000.5,5000.5,9000.5])<100), "dsf.percentile([10,50,90])==%s"%repr(p)
+        p=dsf.percentile(50,mask=dsf>5000)
+        assert abs(p-7500.5)<100, "dsf.percentile(50,mask=dsf>5000)==%s"%repr(p)
+
+        dsf=None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_25():
+    ''' Test zonal statistics '''
+    try:
+        from gdal_calculations import Dataset, Env, zonal_stats
+        Env.tiled=True
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        zones=(dsf>5000)+(dsf>7500)
+
+        table=zonal_stats(dsf,zones,['count','sum','min','max','mean'])
+        assert list(table.zone)==[0,1,2], "table.zone==%s"%repr(table.zone)
+        assert list(table['count'])==[5000,2500,2500], "table['count']==%s"%repr(table['count'])
+        assert list(table['min'])==[1,5001,7501], "table['min']==%s"%repr(table['min'])
+        assert list(table['max'])==[5000,7500,10000], "table['max']==%s"%repr(table['max'])
+        assert table['sum'][0]==12502500, "table['sum'][0]==%s"%repr(table['sum'][0])
+        assert approx_equal(table['mean'][2],8750.5), "table['mean'][2]==%s"%repr(table['mean'][2])
+
+        #Untiled
+        Env.tiled=False
+        untiled=zonal_stats(dsf,zones,['count','sum'])
+        assert list(untiled['sum'])==list(table['sum']), "untiled['sum']==%s"%repr(untiled['sum'])
+
+        dsf,zones=None,None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_26():
+    ''' Test focal statistics '''
+    try:
+        from gdal_calculations import Dataset, Env
+        Env.tiled=True
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        data=dsf.ReadAsArray().astype(np.float64)
+
+        #Tiled results must match untiled results across block boundaries
+        out=dsf.focal('mean',5)
+        tiled=out.ReadAsArray()
+        Env.tiled=False
+        untiled=dsf.focal('mean',5).ReadAsArray()
+        assert np.all(tiled==untiled), "focal('mean',5) tiled!=untiled"
+        assert approx_equal(tiled[50,50],data[48:53,48:53].mean()), "tiled[50,50]==%s"%repr(tiled[50,50])
+        assert approx_equal(tiled[0,0],data[0:3,0:3].mean()), "tiled[0,0]==%s"%repr(tiled[0,0])
+
+        Env.tiled=True
+        out=dsf.focal('max',3).ReadAsArray()
+        assert out[39,10]==data[40,11], "focal('max',3)[39,10]==%s"%repr(out[39,10])
+        assert out[99,99]==10000, "focal('max',3)[99,99]==%s"%repr(out[99,99])
+
+        #Majority of integer classes, ties go to the lowest class
+        classes=dsf%5
+        out=classes.focal('majority',3).ReadAsArray()
+        counts=np.bincount((data[49:52,39:42]%5).astype(np.int64).ravel())
+        assert out[50,40]==counts.argmax(), "focal('majority',3)[50,40]==%s"%repr(out[50,40])
+        try:
+            (dsf/2.0).focal('majority',3)
+            raise AssertionError('float focal("majority") did not raise ValueError')
+        except ValueError:pass
+
+        #Many classes per block are relabelled, not rejected
+        out=dsf.focal('majority',3).ReadAsArray()
+        values,counts=np.unique(data[49:52,39:42],return_counts=True)
+        assert out[50,40]==values[counts.argmax()], "dsf.focal('majority',3)[50,40]==%s"%repr(out[50,40])
+
+        try:
+            dsf.focal('mean',4)
+            raise AssertionError('dsf.focal("mean",4) did not raise ValueError')
+        except ValueError:pass
+
+        dsf,out=None,None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_27():
+    ''' Test map_blocks '''
+    try:
+        from gdal_calculations import Dataset, Env, map_blocks
+        Env.tiled=True
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        data=dsf.ReadAsArray()
+
+        def ratio(a,b):
+            return (a-b)/(a+b).astype(np.float32)
+
+        out=map_blocks(ratio,dsf,dsf*2,dtype=np.float32)
+        assert out.data_type==gdal.GDT_Float32, "data_type!=Float32 (%s)"%gdal.GetDataTypeName(out.data_type)
+        assert approx_equal(out.ReadAsArray().mean(),-1/3.0), "out.mean()==%s"%repr(out.ReadAsArray().mean())
+
+        #Multiband output
+        out=map_blocks(lambda a:np.array([a,a*2]),dsf)
+        assert out.RasterCount==2, "out.RasterCount==%s"%repr(out.RasterCount)
+        assert (out[1].ReadAsArray()==data*2).all(), "out[1]!=dsf*2"
+
+        #Halo
+        out=map_blocks(lambda a:a[:-2,2:],dsf,halo=1)
+        assert (out.ReadAsArray()[1:,:-1]==data[:-1,1:]).all(), "halo window offset"
+
+        #Wrong shape
+        try:
+            map_blocks(lambda a:a[:-1],dsf)
+            raise AssertionError('map_blocks did not raise RuntimeError')
+        except RuntimeError:pass
+
+        dsf,out=None,None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_28():
+    ''' Test band chunked DatasetStack reductions '''
+    try:
+        from gdal_calculations import DatasetStack, Env
+        import warnings
+        Env.tempdir='/vsimem'
+        Env.nodata=True
+
+        #Four single band rasters, the last is NoData in the first 8 rows
+        files=[]
+        for i in range(4):
+            fn='/vsimem/tgc_28_%s.tif'%i
+            tmp=gdal.GetDriverByName('GTiff').Create(fn,32,32,1,gdal.GDT_Int16)
+            tmp.SetGeoTransform([147.5, 0.01, 0.0, -34.5, 0.0, -0.01])
+            tmp.GetRasterBand(1).SetNoDataValue(-1)
+            data=np.ones((32,32),np.int16)*(i+1)
+            if i==3:data[:8]=-1
+            tmp.GetRasterBand(1).WriteArray(data)
+            tmp=None
+            files.append(fn)
+        stack=DatasetStack(files)
+
+        out=stack.reduce('count',buffer_size=32*32*8) #one band per chunk
+        data=out.ReadAsArray()
+        assert data[0,0]==3 and data[31,31]==4, "count==%s"%repr((data[0,0],data[31,31]))
+
+        out=stack.reduce('max',buffer_size=32*32*8)
+        data=out.ReadAsArray()
+        assert data[0,0]==3 and data[31,31]==4, "max==%s"%repr((data[0,0],data[31,31]))
+
+        out=stack.mean(axis=0)
+        data=out.ReadAsArray()
+        assert data[0,0]==2 and data[31,31]==2.5, "mean==%s"%repr((data[0,0],data[31,31]))
+
+        out=stack.reduce('median',buffer_size=2*4*32*8) #one row per strip
+        data=out.ReadAsArray()
+        assert data[0,0]==2 and data[31,31]==2.5, "median==%s"%repr((data[0,0],data[31,31]))
+
+        #Warn when the GDAL cache can't hold a block of every band
+        cachemax=gdal.GetCacheMax()
+        try:
+            gdal.SetCacheMax(1024)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                out=stack.reduce('median',buffer_size=2*4*32*8)
+            assert [w for w in caught if 'GDAL cache' in str(w.message)], "no GDAL cache warning"
+        finally:gdal.SetCacheMax(cachemax)
+
+        out=stack.reduce('percentile',q=[0,100])
+        assert out.RasterCount==2, "out.RasterCount==%s"%repr(out.RasterCount)
+        data=out.ReadAsArray()
+        assert list(data[:,31,31])==[1,4], "percentile==%s"%repr(data[:,31,31])
+
+        stack,out=None,None
+        for fn in files:gdal.Unlink(fn)
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_29():
+    ''' Test lookup table reclassification '''
+    try:
+        from gdal_calculations import Dataset, Env, reclass
+        Env.tiled=True
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        data=dsf.ReadAsArray()
+
+        #Dense lookup
+        out=reclass(dsf,{1:10,2:20,10000:0})
+        vals=out.ReadAsArray()
+        assert vals[0,0]==10 and vals[0,1]==20, "vals[0,:2]==%s"%repr(vals[0,:2])
+        assert vals[99,99]==0, "vals[99,99]==%s"%repr(vals[99,99])
+        assert (vals[50]==data[50]).all(), "unmatched values changed"
+
+        #Default
+        out=reclass(dsf,{1:10},default=0)
+        assert out.ReadAsArray().sum()==10, "out.sum()==%s"%repr(out.ReadAsArray().sum())
+
+        #Ranges
+        out=reclass(dsf,[(0,5000,1),(5000,7500,2),(7500,10001,3)])
+        vals=out.ReadAsArray()
+        assert list(np.bincount(vals.ravel()))==[0,4999,2500,2501], "np.bincount(vals)==%s"%repr(np.bincount(vals.ravel()))
+
+        #Overlapping and nested ranges are ambiguous
+        for table in ([(0,100,1),(10,20,2)],[(0,5000,1),(4000,10001,2)]):
+            try:
+                reclass(dsf,table)
+                raise AssertionError('reclass(dsf,%s) did not raise ValueError'%repr(table))
+            except ValueError:pass
+
+        #NoData passthrough
+        Env.nodata=True
+        fn='/vsimem/tgc_29.tif'
+        tmp=gdal.GetDriverByName('GTiff').Create(fn,16,16,1,gdal.GDT_Int16)
+        tmp.SetGeoTransform([147.5, 0.01, 0.0, -34.5, 0.0, -0.01])
+        tmp.GetRasterBand(1).SetNoDataValue(-1)
+        tmp.GetRasterBand(1).Fill(1)
+        tmp.GetRasterBand(1).WriteArray(np.zeros((1,16),np.int16)-1)
+        tmp=None
+        dsn=Dataset(fn)
+        out=reclass(dsn,{1:5,-1:5})
+        vals=out.ReadAsArray()
+        assert (vals[0]==-1).all() and (vals[1:]==5).all(), "NoData not passed through"
+
+        dsf,dsn,out=None,None,None
+        gdal.Unlink(fn)
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_30():
+    ''' Test conditional where/con '''
+    try:
+        from gdal_calculations import Dataset, Env, where, con
+        Env.tiled=True
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        data=dsf.ReadAsArray()
+
+        #Raster and scalar branches, the condition is uniform in most blocks
+        out=where(dsf>5000,dsf,0)
+        vals=out.ReadAsArray()
+        assert (vals==np.where(data>5000,data,0)).all(), "where(dsf>5000,dsf,0)"
+
+        out=con(dsf<=5000,dsf*2,dsf)
+        vals=out.ReadAsArray()
+        assert (vals==np.where(data<=5000,data*2,data)).all(), "con(dsf<=5000,dsf*2,dsf)"
+
+        #Float scalar makes a float output
+        out=where(dsf>5000,dsf,0.5)
+        assert out.data_type in (gdal.GDT_Float32,gdal.GDT_Float64), "out.data_type==%s"%gdal.GetDataTypeName(out.data_type)
+
+        #NoData in the condition with scalar branches, the output must hold the NoData value
+        Env.nodata=True
+        fn='/vsimem/tgc_30.tif'
+        tmp=gdal.GetDriverByName('GTiff').Create(fn,16,16,1,gdal.GDT_Int16)
+        tmp.SetGeoTransform([147.5, 0.01, 0.0, -34.5, 0.0, -0.01])
+        tmp.GetRasterBand(1).SetNoDataValue(-9999)
+        tmp.GetRasterBand(1).Fill(1)
+        tmp.GetRasterBand(1).WriteArray(np.zeros((1,16),np.int16)-9999)
+        tmp.GetRasterBand(1).WriteArray(np.zeros((1,16),np.int16),0,1)
+        tmp=None
+        dsn=Dataset(fn)
+        out=where(dsn,1,0)
+        assert out.nodata[0]==-9999, "out.nodata==%s"%repr(out.nodata)
+        vals=out.ReadAsArray()
+        assert vals.dtype.kind=='i', "vals.dtype==%s"%vals.dtype
+        assert (vals[0]==-9999).all(), "NoData not passed through (%s)"%repr(vals[0])
+        assert (vals[1]==0).all() and (vals[2:]==1).all(), "where(dsn,1,0)!=expected"
+
+        dsf,dsn,out=None,None,None
+        gdal.Unlink(fn)
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_31():
+    ''' Test multiple outputs in a single pass '''
+    try:
+        from gdal_calculations import Dataset, Env, evaluate
+        Env.tiled=True
+        cd=os.path.abspath(os.curdir)
+
+        testdir=os.path.abspath(os.path.dirname(__file__))
+        datadir=os.path.join(testdir,'data')
+        tmpdir=os.path.join(testdir,'tmp')
+        topdir=os.path.abspath(os.path.join(testdir,'..','..'))
+        bindir=os.path.join(topdir,'bin')
+        libdir=os.path.join(topdir,'lib')
+        f1=os.path.join(datadir,'tgc_multiband.tif')
+
+        dsm=Dataset(f1)
+        data=dsm.ReadAsArray().astype(np.float32)
+        out=os.path.join(tmpdir,'tgc_31_ratio.tif')
+        outputs=evaluate([('ratio','(a[3]-a[2])/(a[3]+a[2]).astype(np.float32)'),('mask','a[0]>a[1]')],
+                         {'a':dsm},{'ratio':out})
+        vals=outputs['ratio'].ReadAsArray()
+        with np.errstate(invalid='ignore',divide='ignore'):
+            expected=(data[3]-data[2])/(data[3]+data[2])
+        assert np.allclose(vals,expected,equal_nan=True), "ratio!=expected"
+        assert outputs['ratio'].GetDescription()==out, "ratio not written to %s"%out
+        vals=outputs['mask'].ReadAsArray()
+        assert (vals==(data[0]>data[1])).all(), "mask!=expected"
+        outputs,dsm=None,None
+
+        #The leftmost variable in the first expression is the reference, as for a single expression
+        Env.reproject=True
+        dsg=Dataset(os.path.join(datadir,'tgc_geo.tif'))
+        dsa=Dataset(os.path.join(datadir,'tgc_alb.vrt'))
+        out=evaluate([('sum','b+a')],{'a':dsg,'b':dsa})['sum']
+        assert osr.SpatialReference(out.srs).IsSame(osr.SpatialReference(dsa.srs)), "out srs != b srs"
+        expected=(dsa+dsg).srs
+        assert osr.SpatialReference(out.srs).IsSame(osr.SpatialReference(expected)), "out srs != (b+a) srs"
+        out=evaluate([('sum','b+a')],{'a':dsg,'b':dsa},reference='a')['sum']
+        assert osr.SpatialReference(out.srs).IsSame(osr.SpatialReference(dsg.srs)), "out srs != reference srs"
+        Env.reproject=False
+        out,dsg,dsa=None,None,None
+
+        #Commandline
+        os.chdir(libdir) #So script can find module
+        script=os.path.join(bindir,'gdal_calculate')
+        if sys.platform == 'win32':script+='.cmd'
+        out=os.path.join(tmpdir,'tgc_31_{name}.tif')
+        args='--calc="sum=a[0]+a[1]" --calc="diff=a[0]-a[1]" --a="%s" --outfile="%s" --overwrite -q --redirect-stderr' % (f1,out)
+        ret = gdaltest.runexternal(script+' '+args).strip()
+        for name in ('sum','diff'):
+            fn=out.replace('{name}',name)
+            assert os.path.exists(fn), '%s not created\n%s'%(fn,ret)
+            gdal.Unlink(fn)
+        gdal.Unlink(os.path.join(tmpdir,'tgc_31_ratio.tif'))
+
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        os.chdir(cd)
+        cleanup()
+
+def test_gdal_calculations_py_32():
+    ''' Test the compact dtype policy '''
+    try:
+        from gdal_calculations import Dataset, Env, map_blocks, evaluate
+        import operator
+        Env.tiled=True
+
+        assert Env.dtype_policy=='NUMPY', "Env.dtype_policy != 'NUMPY' ('%s')"%Env.dtype_policy
+        try:
+            Env.dtype_policy='SMALL'
+            raise AssertionError("Env.dtype_policy='SMALL' did not raise AttributeError")
+        except AttributeError:pass
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+
+        out=operator.truediv(dsf,dsf+1)
+        assert out.data_type==gdal.GDT_Float64, "data_type!=Float64 (%s)"%gdal.GetDataTypeName(out.data_type)
+
+        Env.dtype_policy='compact'
+        out=operator.truediv(dsf,dsf+1)
+        assert out.data_type==gdal.GDT_Float32, "data_type!=Float32 (%s)"%gdal.GetDataTypeName(out.data_type)
+        val=out.ReadAsArray(0, 0, 1, 1)
+        assert approx_equal(val,0.5), "out.ReadAsArray(0, 0, 1, 1)==%s"%repr(val)
+
+        #map_blocks (without a dtype) and evaluate
+        out=map_blocks(lambda a:a/2.0,dsf)
+        assert out.data_type==gdal.GDT_Float32, "map_blocks data_type!=Float32 (%s)"%gdal.GetDataTypeName(out.data_type)
+        out=map_blocks(lambda a:a/2.0,dsf,dtype=np.float64)
+        assert out.data_type==gdal.GDT_Float64, "map_blocks(dtype=float64) data_type!=Float64 (%s)"%gdal.GetDataTypeName(out.data_type)
+        out=evaluate([('half','a/2.0')],{'a':dsf})['half']
+        assert out.data_type==gdal.GDT_Float32, "evaluate data_type!=Float32 (%s)"%gdal.GetDataTypeName(out.data_type)
+
+        dsf,out=None,None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_33():
+    ''' Test 1 bit packed boolean rasters '''
+    try:
+        from gdal_calculations import Dataset, Env
+        Env.tiled=True
+        Env.tempdir='/vsimem'
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        data=dsf.ReadAsArray()
+
+        out=dsf>5000
+        nbits=out.GetRasterBand(1).GetMetadataItem('NBITS','IMAGE_STRUCTURE')
+        assert nbits is None, "NBITS==%s"%repr(nbits)
+
+        Env.packbits=True
+        out=dsf>5000
+        nbits=out.GetRasterBand(1).GetMetadataItem('NBITS','IMAGE_STRUCTURE')
+        assert nbits=='1', "NBITS==%s"%repr(nbits)
+        assert (out.ReadAsArray()==(data>5000)).all(), "out!=(data>5000)"
+
+        #Chained logic and save
+        out=(dsf>5000)&(dsf<7500)
+        assert (out.ReadAsArray()==((data>5000)&(data<7500))).all(), "out!=((data>5000)&(data<7500))"
+        out=dsf<7500
+        fn='/vsimem/tgc_33.tif'
+        saved=out.save(fn)
+        nbits=saved.GetRasterBand(1).GetMetadataItem('NBITS','IMAGE_STRUCTURE')
+        assert nbits=='1', "saved NBITS==%s"%repr(nbits)
+
+        dsf,out,saved=None,None,None
+        gdal.Unlink(fn)
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_34():
+    ''' Test broadcasting single bands across multiband datasets '''
+    try:
+        from gdal_calculations import Dataset, Env
+        Env.tiled=True
+        Env.nodata=True
+
+        #Synthetic 4 band and 1 band rasters with the same extent
+        driver=gdal.GetDriverByName('GTiff')
+        rasters=[]
+        for fn,nbands in (('/vsimem/tgc_34_4.tif',4),('/vsimem/tgc_34_3.tif',3),('/vsimem/tgc_34_1.tif',1)):
+            ds=driver.Create(fn,64,48,nbands,gdal.GDT_Int16,['TILED=YES','BLOCKXSIZE=16','BLOCKYSIZE=16'])
+            ds.SetGeoTransform([100000,25,0,200000,0,-25])
+            for i in range(nbands):
+                data=np.arange(64*48,dtype=np.int16).reshape(48,64)%(i+7)
+                ds.GetRasterBand(i+1).SetNoDataValue(i+1)
+                ds.GetRasterBand(i+1).WriteArray(data)
+            ds=None
+            rasters.append(fn)
+
+        dsm=Dataset(rasters[0])
+        dsb=Dataset(rasters[2])
+        mdata=dsm.ReadAsArray()
+        bdata=dsb.ReadAsArray()
+        mmask=mdata==np.arange(1,5)[:,np.newaxis,np.newaxis]
+        bmask=bdata==1
+
+        #Single band Dataset, Band and swapped operands all give 4 bands
+        for out in (dsm*dsb,dsb*dsm,dsm*dsm[0],dsm[0]*dsm):
+            assert out.nbands==4, "out.nbands==%s"%out.nbands
+        out=dsm*dsb
+        vals=out.ReadAsArray()
+        invalid=vals==out.nodata[0]
+        assert (invalid==(mmask|bmask)).all(), "NoData mask!=expected"
+        assert (vals[~invalid]==(mdata*bdata)[~invalid]).all(), "dsm*dsb!=mdata*bdata"
+
+        #Band counts that can't be broadcast
+        try:
+            out=dsm+Dataset(rasters[1])
+            raise AssertionError('4 band+3 band did not raise RuntimeError')
+        except RuntimeError:pass
+
+        dsm,dsb,out=None,None,None
+        for fn in rasters:gdal.Unlink(fn)
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_35():
+    ''' Test profiling '''
+    try:
+        from gdal_calculations import Dataset, Env, Profiler
+        Env.tiled=True
+        Env.tempdir='/vsimem'
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        out=(dsf+1)*2
+        summary=Env.profiler.summary()
+        assert summary['nodes']=={} and summary['datasets']=={}, "profiled when Env.profile==False"
+
+        Env.profile=True
+        assert isinstance(Env.profiler,Profiler), "isinstance(Env.profiler,Profiler)!=True"
+        out=(dsf+1)*2
+        summary=Env.profiler.summary()
+        nodes=sorted(summary['nodes'])
+        assert len(nodes)==2, "nodes==%s"%repr(nodes)
+        for node in nodes:
+            for phase in ('read','compute','write','total'):
+                assert phase in summary['nodes'][node], "%s not in %s"%(phase,repr(summary['nodes'][node]))
+        nwindows=len(list(dsf.__windows__()))
+        reads=summary['datasets'][os.path.abspath(f)]['read']
+        assert reads['calls']==nwindows, "reads['calls']==%s"%reads['calls']
+        assert 'Node' in str(Env.profiler), "'Node' not in str(Env.profiler)"
+
+        Env.profiler.reset()
+        summary=Env.profiler.summary()
+        assert summary['nodes']=={} and summary['datasets']=={}, "Env.profiler.reset() failed"
+
+        dsf,out=None,None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_36():
+    ''' Test peak memory accounting '''
+    try:
+        from gdal_calculations import Dataset, Env
+        Env.tiled=True
+        Env.tempdir='/vsimem'
+        Env.profile=True
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        out=(dsf+1)*2
+        memory=Env.profiler.memory()
+        xblock,yblock=dsf.block_size
+        assert memory['buffer_bytes']>=xblock*yblock*dsf.ReadAsArray().itemsize, "memory['buffer_bytes']==%s"%memory['buffer_bytes']
+        assert memory['temporary_datasets']==2, "memory['temporary_datasets']==%s"%memory['temporary_datasets']
+        assert memory['temporary_bytes']>0, "memory['temporary_bytes']==%s"%memory['temporary_bytes']
+        assert memory['vsimem_bytes']>=memory['temporary_bytes'], "memory['vsimem_bytes']==%s"%memory['vsimem_bytes']
+        assert memory['live_temporary_datasets']==1, "memory['live_temporary_datasets']==%s"%memory['live_temporary_datasets']
+        assert Env.profiler.summary()['memory']['buffer_bytes']==memory['buffer_bytes'], "summary()['memory']!=memory()"
+        assert 'buffer_bytes' in str(Env.profiler), "'buffer_bytes' not in str(Env.profiler)"
+
+        out=None
+        memory=Env.profiler.memory()
+        assert memory['live_temporary_datasets']==0, "memory['live_temporary_datasets']==%s"%memory['live_temporary_datasets']
+
+        dsf=None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_37():
+    ''' Test progress callbacks and throttling '''
+    try:
+        from gdal_calculations import Dataset, Env, Progress
+        Env.tiled=True
+        Env.tempdir='/vsimem'
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        nwindows=len(list(dsf.__windows__()))
+
+        infos=[]
+        Env.progress=Progress(2,callbacks=[infos.append],interval=0,console=False)
+        out=(dsf+1)*2
+        assert len(infos)==2*nwindows+1, "len(infos)==%s"%len(infos)
+        info=infos[-1]
+        assert info['fraction']==1, "info['fraction']==%s"%info['fraction']
+        assert info['windows']==info['total_windows']==2*nwindows, "info['windows']==%s"%info['windows']
+        assert info['pixels']==2*dsf.x_size*dsf.y_size, "info['pixels']==%s"%info['pixels']
+        assert info['bytes']>0, "info['bytes']==%s"%info['bytes']
+        assert info['eta']==0, "info['eta']==%s"%info['eta']
+        fractions=[i['fraction'] for i in infos]
+        assert fractions==sorted(fractions), "fractions not increasing: %s"%fractions
+
+        #Throttled, only the start and completion
+        infos=[]
+        Env.progress=Progress(2,callbacks=[infos.append],interval=3600,console=False)
+        out=(dsf+1)*2
+        assert len(infos)==2, "len(infos)==%s"%len(infos)
+
+        #Statistics passes report progress too
+        infos=[]
+        Env.progress=Progress(1,callbacks=[infos.append],interval=0,console=False)
+        stats=dsf.statistics()
+        assert len(infos)==nwindows+1, "statistics len(infos)==%s"%len(infos)
+        assert infos[-1]['fraction']==1, "statistics info['fraction']==%s"%infos[-1]['fraction']
+
+        dsf,out=None,None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_38():
+    ''' Test Chrome trace event timelines '''
+    try:
+        from gdal_calculations import Dataset, Env, Tracer
+        import json
+        Env.tiled=True
+        Env.tempdir='/vsimem'
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        nwindows=len(list(dsf.__windows__()))
+        out=dsf+1
+        assert Env.tracer.events==[], "traced when Env.trace==False"
+
+        Env.trace=True
+        assert isinstance(Env.tracer,Tracer), "isinstance(Env.tracer,Tracer)!=True"
+        out=dsf+1
+        events=Env.tracer.events
+        for cat,n in (('operation',1),('read',nwindows),('write',nwindows)):
+            begin=[e for e in events if e['cat']==cat and e['ph']=='B']
+            end=[e for e in events if e['cat']==cat and e['ph']=='E']
+            assert len(begin)==len(end)==n, "%s %s begin and %s end events"%(len(begin),cat,len(end))
+        reads=[e for e in events if e['cat']=='read' and e['ph']=='B']
+        assert reads[0]['args']['dataset']==os.path.abspath(f), "reads[0]['args']==%s"%repr(reads[0]['args'])
+        assert [e['ts'] for e in events]==sorted([e['ts'] for e in events]), "events not in order"
+        assert events[0]['tid']==events[-1]['tid'], "events[0]['tid']!=events[-1]['tid']"
+
+        fn=os.path.join('tmp','tgc_38.json')
+        Env.tracer.dump(fn)
+        trace=json.load(open(fn))
+        assert len(trace['traceEvents'])==len(events), "len(trace['traceEvents'])==%s"%len(trace['traceEvents'])
+        os.unlink(fn)
+
+        dsf,out=None,None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_39():
+    ''' Test per window cost heatmaps '''
+    try:
+        from gdal_calculations import Dataset, Env, Heatmapper
+        from osgeo import gdal
+        Env.tiled=True
+        Env.tempdir='/vsimem'
+        Env.heatmap=True
+        assert isinstance(Env.heatmapper,Heatmapper), "isinstance(Env.heatmapper,Heatmapper)!=True"
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        out=dsf+1
+        out.save('/vsimem/tgc_39.tif')
+        ds=gdal.Open('/vsimem/tgc_39_heatmap.tif')
+        assert ds is not None, "heatmap not saved"
+        assert (ds.RasterCount,ds.RasterXSize,ds.RasterYSize)==(2,1,3), "(bands,cols,rows)==%s"%repr((ds.RasterCount,ds.RasterXSize,ds.RasterYSize))
+        assert ds.GetRasterBand(1).GetDescription()=='seconds', "band 1 description!='seconds'"
+        seconds=ds.GetRasterBand(1).ReadAsArray()
+        nbytes=ds.GetRasterBand(2).ReadAsArray()
+        assert (seconds>=0).all(), "seconds<0"
+        assert (nbytes>0).all(), "nbytes==0"
+        assert ds.GetGeoTransform()[0]==dsf.gt[0] and ds.GetGeoTransform()[3]==dsf.gt[3], "heatmap origin!=dataset origin"
+        ds=None
+        gdal.Unlink('/vsimem/tgc_39_heatmap.tif')
+        gdal.Unlink('/vsimem/tgc_39.tif')
+
+        Env.heatmapper.reset()
+        try:
+            Env.heatmapper.save('/vsimem/tgc_39_heatmap.tif')
+            return fail('Env.heatmapper.save() succeeded with no data')
+        except RuntimeError:pass
+
+        dsf,out=None,None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_40():
+    ''' Test planning calculations without running them '''
+    try:
+        from gdal_calculations import Dataset, Env, Plan, explain
+        from osgeo import gdal
+        Env.tiled=True
+        Env.tempdir='/vsimem'
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        nwindows=len(list(dsf.__windows__()))
+
+        #Callable
+        plan=explain(lambda:dsf+1)
+        assert isinstance(plan,Plan), "isinstance(plan,Plan)!=True"
+        assert Env.plan is None, "Env.plan is not None"
+        summary=plan.summary()
+        assert (summary['passes'],summary['windows'])==(1,nwindows), "(passes,windows)==%s"%repr((summary['passes'],summary['windows']))
+        assert summary['temporaries']==1, "summary['temporaries']==%s"%summary['temporaries']
+        assert summary['bytes_read']==dsf.x_size*dsf.y_size*dsf.nbands*gdal.GetDataTypeSize(dsf.data_type)/8, "summary['bytes_read']==%s"%summary['bytes_read']
+        out=dsf+1
+        assert summary['outputs'][0]['datatype']==gdal.GetDataTypeName(out.data_type), "planned datatype!=%s"%gdal.GetDataTypeName(out.data_type)
+        assert summary['outputs'][0]['x_size']==out.x_size, "planned x_size!=%s"%out.x_size
+
+        #String expression, clipped to the MINOF extent and saved
+        dss=Dataset('data/tgc_geo_shifted.vrt')
+        fn=os.path.join('tmp','tgc_40.tif')
+        plan=explain('a*2+b',{'a':dsf,'b':dss},fn)
+        summary=plan.summary()
+        assert [i['name'] for i in summary['inputs']]==['a','b'], "inputs==%s"%repr(summary['inputs'])
+        steps=[s['step'] for s in summary['steps']]
+        assert 'ClippedDataset' in steps, "steps==%s"%repr(steps)
+        assert steps.count('pass')==2 and steps[-1]=='output', "steps==%s"%repr(steps)
+        assert summary['outputs'][0]['path']==fn, "summary['outputs']==%s"%repr(summary['outputs'])
+        assert summary['bytes_written']>0, "summary['bytes_written']==0"
+        assert not os.path.exists(fn), "explain wrote %s"%fn
+        assert 'Estimated totals' in str(plan), "'Estimated totals' not in str(plan)"
+
+        #evaluate
+        plan=explain([('x','a*2'),('y','a+1')],{'a':dsf},{'x':fn})
+        summary=plan.summary()
+        assert (summary['passes'],summary['temporaries'])==(1,1), "(passes,temporaries)==%s"%repr((summary['passes'],summary['temporaries']))
+        assert [o['path'] for o in summary['outputs']]==[fn,'temporary 2'], "outputs==%s"%repr([o['path'] for o in summary['outputs']])
+        assert not os.path.exists(fn), "explain wrote %s"%fn
+
+        dsf,dss,out=None,None,None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_41():
+    ''' Test I/O counters '''
+    try:
+        from gdal_calculations import Dataset, Env, IOCounter
+        Env.tiled=True
+        Env.tempdir='/vsimem'
+
+        f='data/tgc_geo.tif'
+        dsf=Dataset(f)
+        path=os.path.abspath(f)
+        nwindows=len(list(dsf.__windows__()))
+        out=dsf+1
+        assert Env.iocounter.summary()=={'sources':{},'views':{},'written':{}}, "counted when Env.iocount==False"
+
+        Env.iocount=True
+        assert isinstance(Env.iocounter,IOCounter), "isinstance(Env.iocounter,IOCounter)!=True"
+        out=dsf+dsf
+        summary=Env.iocounter.summary()
+        source=summary['sources'][path]
+        assert source['calls']==2*nwindows, "source['calls']==%s"%source['calls']
+        assert source['pixels']==2*dsf.x_size*dsf.y_size, "source['pixels']==%s"%source['pixels']
+        #Each block is read twice, once from the source and once from the cache
+        assert source['misses']==source['hits']==source['unique_blocks'], "(misses,hits,unique_blocks)==%s"%repr((source['misses'],source['hits'],source['unique_blocks']))
+        assert source['redundancy']==1, "source['redundancy']==%s"%source['redundancy']
+        assert summary['views'][path]['calls']==2*nwindows, "summary['views']==%s"%repr(summary['views'])
+        written=summary['written'].values()
+        assert len(written)==1 and written[0]['pixels']==dsf.x_size*dsf.y_size, "summary['written']==%s"%repr(summary['written'])
+
+        #Views
+        Env.iocounter.reset()
+        out=dsf[0]+1
+        summary=Env.iocounter.summary()
+        assert '%s[0]'%path in summary['views'], "summary['views']==%s"%repr(summary['views'])
+        assert summary['sources'][path]['calls']==nwindows, "summary['sources']==%s"%repr(summary['sources'])
+        assert 'Redun.' in str(Env.iocounter), "'Redun.' not in str(Env.iocounter)"
+
+        #Band indexes are mapped through Bands of intermediate views
+        from gdal_calculations.gdal_dataset import ClippedDataset
+        from gdal_calculations.profiling import source
+        dsm=Dataset('data/tgc_multiband.tif')
+        clipped=ClippedDataset(dsm[2],dsm.extent)
+        ds,bands=source(clipped[0])
+        assert ds is dsm and bands==[2], "source(clipped[0])==%s"%repr((ds,bands))
+        dsm,clipped,ds=None,None,None
+
+        dsf,out=None,None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_42():
+    ''' Test preview mode '''
+    try:
+        from gdal_calculations import Dataset, Env
+        Env.tiled=True
+        Env.tempdir='/vsimem'
+
+        try:
+            Env.preview_scale=0
+            return fail('Env.preview_scale=0 did not raise AttributeError')
+        except AttributeError:pass
+
+        f='data/tgc_geo.tif'
+        full=Dataset(f)
+        Env.preview_scale=4
+        dsf=Dataset(f)
+        assert (dsf.x_size,dsf.y_size)==(25,25), "(x_size,y_size)==%s"%repr((dsf.x_size,dsf.y_size))
+        assert approx_equal(dsf.gt[1],full.gt[1]*4) and approx_equal(dsf.gt[5],full.gt[5]*4), "gt==%s"%repr(dsf.gt)
+        assert approx_equal(dsf.extent,full.extent), "extent==%s"%repr(dsf.extent)
+        assert dsf.nodata==full.nodata, "nodata==%s"%repr(dsf.nodata)
+
+        #Temporaries aren't decimated again
+        out=dsf+1
+        assert (out.x_size,out.y_size)==(25,25), "(out.x_size,out.y_size)==%s"%repr((out.x_size,out.y_size))
+        assert (out.ReadAsArray()==dsf.ReadAsArray()+1).all(), "out!=dsf+1"
+        out=out.save('/vsimem/tgc_preview.tif')
+        assert (out.x_size,out.y_size)==(25,25), "saved (x_size,y_size)==%s"%repr((out.x_size,out.y_size))
+
+        #Datasets opened before preview_scale was set aren't decimated
+        out=full+1
+        assert (out.x_size,out.y_size)==(100,100), "full (x_size,y_size)==%s"%repr((out.x_size,out.y_size))
+
+        Env.preview_scale=1
+        assert Dataset(f).x_size==100, "Dataset(f).x_size!=100 when Env.preview_scale==1"
+
+        full,dsf,out=None,None,None
+        gdal.Unlink('/vsimem/tgc_preview.tif')
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
+def test_gdal_calculations_py_43():
+    ''' Test writing masked data with a NoData value that doesn't fit the datatype '''
+    try:
+        from gdal_calculations import TemporaryDataset
+        from gdal_calculations.gdal_dataset import nodata_fits
+        from osgeo import gdal
+
+        assert nodata_fits(0,np.uint8) and nodata_fits(255,np.uint8), "nodata_fits(0|255,uint8)!=True"
+        assert not nodata_fits(-9999,np.uint8), "nodata_fits(-9999,uint8)==True"
+        assert not nodata_fits(1.5,np.int16), "nodata_fits(1.5,int16)==True"
+        assert not nodata_fits(np.nan,np.int32), "nodata_fits(nan,int32)==True"
+        assert nodata_fits(np.nan,np.float32), "nodata_fits(nan,float32)!=True"
+        assert not nodata_fits(1e300,np.float32), "nodata_fits(1e300,float32)==True"
+
+        data=np.ma.MaskedArray(np.ones((10,10),np.uint8),np.eye(10,dtype=np.bool))
+        tmpds=TemporaryDataset(10,10,1,gdal.GDT_Byte,nodata=[0])
+        tmpds.write_data(data)
+        out=tmpds.ReadAsArray()
+        assert (out==np.where(np.eye(10),0,1)).all(), "masked pixels weren't written as NoData"
+
+        #Don't silently write the raw buffer under the mask
+        tmpds.nodata=[-9999]
+        try:
+            tmpds.write_data(data)
+            return fail('write_data accepted a NoData value that does not fit the datatype')
+        except ValueError:pass
+
+        tmpds=None
+        return 'success'
+    except AssertionError:
+        return fail()
+    finally:
+        cleanup()
+
 #-----------------------------------------------------------
 def fail(reason=''):
     exc_type, exc_value, exc_tb=sys.exc_info()
@@ -984,6 +2065,30 @@ gdaltest_list = [
                  test_gdal_calculations_py_16,
                  test_gdal_calculations_py_17,
                  test_gdal_calculations_py_18,
+                 test_gdal_calculations_py_20,
+                 test_gdal_calculations_py_21,
+                 test_gdal_calculations_py_22,
+                 test_gdal_calculations_py_23,
+                 test_gdal_calculations_py_24,
+                 test_gdal_calculations_py_25,
+                 test_gdal_calculations_py_26,
+                 test_gdal_calculations_py_27,
+                 test_gdal_calculations_py_28,
+                 test_gdal_calculations_py_29,
+                 test_gdal_calculations_py_30,
+                 test_gdal_calculations_py_31,
+                 test_gdal_calculations_py_32,
+                 test_gdal_calculations_py_33,
+                 test_gdal_calculations_py_34,
+                 test_gdal_calculations_py_35,
+                 test_gdal_calculations_py_36,
+                 test_gdal_calculations_py_37,
+                 test_gdal_calculations_py_38,
+                 test_gdal_calculations_py_39,
+                 test_gdal_calculations_py_40,
+                 test_gdal_calculations_py_41,
+                 test_gdal_calculations_py_42,
+                 test_gdal_calculations_py_43,
                 ]
 
 if __name__ == '__main__':
@@ -18,11 +18,22 @@ Notes:
          the limitations specified in the examples below.
 
 Classes/Objects:
-    Dataset(filepath_or_dataset ,*args)
+    Dataset(filepath_or_dataset ,*args, preview=True)
         - Base Dataset class.
         - Instantiate by passing a path or gdal.Dataset object.
+        - Read at a reduced resolution while Env.preview_scale > 1 unless preview=False.
         - Supports gdal.Dataset and numpy.ndarray method and attribute calls.
         - Supports arithmetic operations (i.e ds1 + ds2)
+        - Single band Datasets/Bands are broadcast across the bands of multiband
+          Datasets (i.e ds_6band * ds_1band), other band counts must match.
+        - The statistics(per_band=False, mask=None) method and the numpy sum, mean,
+          min, max, var and std methods are calculated in a single tiled pass.
+        - The histogram(bins=256, range=None, per_band=False, mask=None) and
+          percentile(q, per_band=False, mask=None, k=2048) methods are also
+          calculated block by block.
+        - The focal(statistic='mean', size=3) method calculates moving window
+          majority/max/mean/min/std/sum, reading each block with an overlapping halo.
+          majority is for integer class rasters, many classes per block are slower.
     Band
         - Returned from Dataset[i] (zero based) or Dataset.GetRasterBand(j) (1 based)
           methods, not instantiated directly.
@@ -53,20 +64,97 @@ Classes/Objects:
         - Similar to gdalbuildvrt -separate etc... functionality, except the class
           can handle rasters with different extents,cellsizes and coordinate systems
           as long as they overlap.
+        - The reduce(statistic, q=None, buffer_size=128*1024*1024) method and the
+          numpy max, mean, min and sum methods with axis=0 read the bands in chunks
+          to calculate per pixel statistics across the stack.
+    Statistics(nbands=None, skipnan=True)
+        - Mergeable count/sum/min/max/mean/var/std accumulated block by block.
+        - NaN values propagate as in numpy if skipnan is False, integer sums are int64
+          and min/max keep the datatype of the data.
+        - Returned by the Dataset/Band statistics method.
+    Histogram(bins, range, nbands=None)
+        - Mergeable fixed bin histogram with approximate percentiles.
+        - Returned by the Dataset/Band histogram method.
+    QuantileSketch(k=2048, nbands=None)
+        - Mergeable approximate quantile sketch with bounded memory.
+        - Used by the Dataset/Band percentile method.
+    ZonalStatistics()
+        - Mergeable per zone count/sum/min/max/mean/var/std grouped with numpy.bincount.
+        - Used by the zonal_stats function.
+    Profiler()
+        - Per node (operation/method/function call) and per input dataset timings
+          of the read/compute/write/vrt/create_copy phases when Env.profile is set.
+        - The memory() method returns the peak numpy block buffer, GDAL block cache,
+          /vsimem and TemporaryDataset bytes and the live TemporaryDatasets.
+        - Instantiated on import as Env.profiler.
+    Tracer()
+        - Records begin/end events of block reads/writes, VRT construction (warps etc.),
+          create_copy and operations with thread ids when Env.trace is set.
+        - Instantiated on import as Env.tracer, Env.tracer.dump(path) writes a Chrome
+          trace event JSON file (view it in chrome://tracing or Perfetto).
+    Heatmapper()
+        - Records the seconds and bytes read for each processing window when Env.heatmap is set.
+        - Instantiated on import as Env.heatmapper, Env.heatmapper.save(path) writes a
+          georeferenced raster with one pixel per window.
+    IOCounter()
+        - Counts the reads, pixels and bytes requested of each Dataset/Band (and the Clipped/
+          Converted/WarpedDatasets derived from them) and the blocks read from their
+          sources and the bytes written to new and temporary datasets when Env.iocount is set.
+        - Estimates the GDAL block cache hits/misses and bytes decoded with a least recently
+          used cache of gdal.GetCacheMax() bytes, a source with a redundancy > 1 is re-read.
+        - Instantiated on import as Env.iocounter.
+    Plan()
+        - Execution plan of a calculation, returned by the explain function.
+        - The summary() method returns the inputs, steps, outputs and estimated totals as a dict.
+    Progress(operations=0, callbacks=[], interval=0.5, console=True)
+        - Progress of a calculation, assign to Env.progress to enable it.
+        - operations is the expected number of operations/method calls, the number of
+          windows is taken from each operation's processing plan.
+        - Each callback(info) is called at most every interval seconds and on completion
+          with a dict of fraction, windows, total_windows, pixels, bytes, elapsed,
+          pixels_per_second, mbytes_per_second and eta (seconds remaining).
+        - The console progress bar is used unless console is False.
     Env - Object for setting various environment properties.
         - This is instantiated on import.
         - The following properties are supported:
             cellsize
               - one of 'DEFAULT','MINOF','MAXOF', [xres,yres], xyres
               - Default = "DEFAULT"
+            dtype_policy
+              - one of "NUMPY", "COMPACT"
+              - "COMPACT" writes float32 instead of float64 results when all the operands fit
+                in a float32 (such as Byte/Byte ratios). This applies to arithmetic/boolean
+                operations, ndarray methods, map_blocks (without a dtype) and evaluate.
+                Integer results are not narrowed.
+              - Default = "NUMPY" (use the datatype numpy returns)
             enable_numexpr
               - this can break core numpy methods, such as numpy.sum([Dataset(foo),Dataset(bar)]
               - Default = False
             extent
               - one of "MINOF", "INTERSECT", "MAXOF", "UNION", [xmin,ymin,xmax,ymax]
               - Default = "MINOF"
+            heatmap
+              - record the seconds and bytes read for each processing window - True/False
+              - a raster with one pixel per window (band 1 seconds, band 2 bytes) is saved alongside
+                outputs (i.e. out.tif -> out_heatmap.tif) or use Env.heatmapper.save(path),
+                Env.heatmapper.reset() clears it
+              - Default = False
+            iocount
+              - count the ReadAsArray calls, pixels and bytes requested of each Dataset/Band and VRT
+                and the source blocks they read - True/False
+              - print Env.iocounter for a report or use Env.iocounter.summary(), Env.iocounter.reset()
+                clears the counts
+              - Default = False
+            maskbands
+              - read GDAL mask bands (alpha bands, .msk files, per-dataset masks) with each block
+                and use them to mask NoData when Env.nodata is set - True/False
+              - Default = False
             nodata
               - handle nodata using masked arrays - True/False
+              - or "NAN" to replace NoData with NaN when reading and let floating point
+                arithmetic propagate it (much faster than masked arrays). Integer data
+                with NoData is promoted to floating point. NaN is converted back to the
+                output NoData value when writing.
               - Default = False
             ntiles
               - number of tiles to process at a time
@@ -74,6 +162,27 @@ Classes/Objects:
             overwrite
               - overwrite if required - True/False
               - Default = False
+            packbits
+              - store boolean results as 1 bit (NBITS=1) GTiffs when there's no NoData value,
+                saving them as GTiffs keeps them packed - True/False
+              - Default = False
+            preview_scale
+              - quick look at a reduced resolution, datasets opened while it is > 1 are read at
+                1/preview_scale of their resolution (with the same extent), so calculations
+                process preview_scale**2 times fewer pixels. GDAL reads them from overviews if
+                there are any, otherwise by downsampling (nearest neighbour)
+              - outputs are written at the reduced resolution, datasets opened before it was set
+                are unaffected
+              - an integer >= 1
+              - Default = 1
+            profile
+              - time the block reads, computation, block writes, VRT construction and create_copy
+                of each operation/method/function call (node) and input dataset - True/False
+              - also tracks the peak memory use (numpy block buffers, GDAL block cache,
+                /vsimem files and TemporaryDatasets), see Env.profiler.memory()
+              - print Env.profiler for a summary table or use Env.profiler.summary() for a dict,
+                Env.profiler.reset() clears the timings
+              - Default = False
             reproject
               - reproject if required - True/False
               - datasets are projected to the SRS of the first input dataset in an expression
@@ -84,6 +193,12 @@ Classes/Objects:
             snap
               - a gdal_calculations.Dataset/Band object
               - Default = None
+            sparse
+              - skip reading and calculating windows that are empty (never written sparse
+                GTiff blocks or outside all VRT sources) or all NoData - True/False
+              - Requires Env.nodata. Temp rasters are created with SPARSE_OK=TRUE, use the
+                SPARSE_OK=TRUE creation option to keep the saved output sparse as well.
+              - Default = False
             srs
               - the output spatial reference system
               - one of osgeo.osr.SpatialReference (object)|WKT (string)|EPSG code (integer)
@@ -97,9 +212,42 @@ Classes/Objects:
             tiled
               - use tiled processing - True/False
               - Default = True
+            trace
+              - record begin/end events of block reads/writes, VRT construction, create_copy and
+                operations for a timeline - True/False
+              - write them with Env.tracer.dump('trace.json') as Chrome trace events
+              - Default = False
     Byte, UInt16, Int16, UInt32, Int32, Float32, Float64
         - Type conversions functions
         - Returns a ConvertedDataset object
+    map_blocks(func, *rasters, dtype=None, nbands=None, halo=0)
+        - Apply a numpy function to aligned blocks of one or more Datasets/Bands,
+          optionally with a halo of overlapping pixels.
+        - Returns a TemporaryDataset object
+    reclass(raster, table, default=None)
+        - Reclassify a Dataset/Band in a single pass with a {value:new_value} dict
+          or a sequence of non-overlapping (min, max, new_value) ranges.
+        - Returns a TemporaryDataset object
+    where(condition, x, y), con(condition, x, y)
+        - Values from x (Dataset/Band or scalar) where the condition is True, else y.
+        - x and y are only read for blocks where they are selected.
+        - Returns a TemporaryDataset object
+    evaluate(expressions, rasters, outfiles={}, outformat='GTIFF', options=[], reference=None)
+        - Evaluate multiple {name:expression} numpy expressions in a single pass,
+          reading each block of the {variable:Dataset/Band} rasters once.
+        - The rasters are aligned to the reference variable, by default the leftmost
+          variable in the first expression, as for a single expression.
+        - Returns a dict of {name:Dataset}
+    explain(expression, rasters={}, outfile=None)
+        - Plan a calculation (a string expression using the {variable:Dataset/Band} rasters,
+          a callable such as lambda:ds1+ds2 or evaluate expressions) without running it.
+        - Returns a Plan object, print it to see the reprojections, resampling, clipping and
+          casts, the output grid, the windows of each pass, the temporary rasters and the
+          estimated bytes read and written.
+    zonal_stats(values, zones, stats=['count','sum','mean'])
+        - Calculate statistics of a values Dataset/Band for each zone in a
+          zones Dataset/Band block by block.
+        - Returns a numpy record array with a zone field and a field for each statistic.
 
 Examples:
 
@@ -202,11 +350,20 @@ __version__='1.1'
 from gdal_dataset import *
 from conversions import *
 from environment import *
+from stats import *
+from profiling import *
+from planning import *
 
 from gdal_dataset import __all__ as __dall__
 from conversions import __all__ as __call__
 from environment import __all__ as __eall__
+from stats import __all__ as __sall__
+from profiling import __all__ as __pall__
+from planning import __all__ as __plall__
 __all__=[]
 __all__.extend(__dall__)
 __all__.extend(__call__)
 __all__.extend(__eall__)
+__all__.extend(__sall__)
+__all__.extend(__pall__)
+__all__.extend(__plall__)
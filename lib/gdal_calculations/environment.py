@@ -29,6 +29,7 @@ Author: Luke Pinner
 __all__ = [ "Env", "Progress"]
 
 import sys,os,tempfile
+from timeit import default_timer as timer
 import numpy as np
 from osgeo import gdal, osr
 
@@ -40,13 +41,19 @@ class _Env(object):
 
     #Properties
     enable_numexpr=False
-    nodata=False
+    heatmap=False
+    iocount=False
+    maskbands=False
     ntiles=1
     overwrite=False
+    packbits=False
+    profile=False
     progress=False
     reproject=False
+    sparse=False
     tiled=True
     tempoptions=['BIGTIFF=IF_SAFER']
+    trace=False
 
     @property
     def cellsize(self):
@@ -72,6 +79,22 @@ class _Env(object):
         except:pass
         raise AttributeError('%s not one of "DEFAULT"|"MINOF"|"MAXOF"|[xsize,ysize]|xysize'%repr(value))
 
+    @property
+    def dtype_policy(self):
+        try:return self._dtype_policy
+        except AttributeError:
+            self._dtype_policy='NUMPY'
+            return self._dtype_policy
+
+    @dtype_policy.setter
+    def dtype_policy(self, value):
+        try:
+            if value.upper() in ['NUMPY','COMPACT']:
+                self._dtype_policy = value.upper()
+                return
+        except:pass
+        raise AttributeError('%s not one of "NUMPY"|"COMPACT"'%repr(value))
+
     @property
     def extent(self):
         try:return self._extent
@@ -93,6 +116,41 @@ class _Env(object):
         except:pass
         raise AttributeError('%s not one of "MINOF"|"INTERSECT"|"MAXOF"|"UNION"|[xmin,ymin,xmax,ymax]'%repr(value))
 
+    @property
+    def nodata(self):
+        try:return self._nodata
+        except AttributeError:
+            self._nodata=False
+            return self._nodata
+
+    @nodata.setter
+    def nodata(self, value):
+        try:
+            if value.upper()=='NAN':
+                self._nodata='NAN'
+                return
+        except AttributeError:pass
+        if value in (True,False):
+            self._nodata=bool(value)
+            return
+        raise AttributeError('%s not one of True|False|"NAN"'%repr(value))
+
+    @property
+    def preview_scale(self):
+        try:return self._preview_scale
+        except AttributeError:
+            self._preview_scale=1
+            return self._preview_scale
+
+    @preview_scale.setter
+    def preview_scale(self, value):
+        try:
+            if int(value)==value and value>=1:
+                self._preview_scale=int(value)
+                return
+        except:pass
+        raise AttributeError('%s is not an integer >= 1'%repr(value))
+
     @property
     def resampling(self):
         try:return self._resampling
@@ -189,22 +247,104 @@ class _Env(object):
 
 Env=_Env()
 
+def term_progress(info):
+    '''Console progress bar callback'''
+    gdal.TermProgress_nocb(info['fraction'])
+
 class Progress(object):
-    def __init__(self,operations=0):
-        self.steps = 1 #n. steps per operation
+    ''' Track the progress of a calculation in windows (blocks) processed.
+
+        operations is the expected number of passes over the rasters, i.e. the
+        number of operations/method calls in an expression. Each pass calls
+        start(windows) with the list of windows it will process, so the total is
+        the real number of windows, and update_progress() after each window.
+
+        Progress is passed to each callback(info) at most every interval seconds
+        (and on completion) as a dict of:
+            fraction, windows, total_windows, pixels, bytes (read), elapsed (seconds),
+            pixels_per_second, mbytes_per_second, eta (seconds remaining or None)
+        The console progress bar is one of the callbacks unless console is False.
+    '''
+    def __init__(self,operations=0,callbacks=[],interval=0.5,console=True):
+        self.callbacks=list(callbacks)
+        self.interval=interval
+        self.console=console
+        self.reset(operations)
+
+    def reset(self,operations=0):
+        self.steps = 1 #n. windows in the current pass
         self.operations=float(operations)
         self.progress=0
         self.enabled=operations>0
-        if self.enabled:
-            gdal.TermProgress_nocb(0)
+        self.passes=0
+        self.completed=0 #n. windows in previous passes
+        self.windows=[]
+        self.pixels=0
+        self.nbytes=0
+        self.fraction=0.0
+        self.started=timer()
+        self.updated=None
+        if self.enabled:self.__emit__(self.started)
 
-    def reset(self,operations=0):
-        self.__init__(operations)
+    def start(self,windows,raster=None):
+        '''Start a pass over a list of (x_off,y_off,x_size,y_size) windows of a Dataset/Band'''
+        if Env.heatmap:Env.heatmapper.start(windows,raster)
+        if not self.enabled:return
+        if self.passes:self.completed+=self.progress
+        self.passes+=1
+        self.windows=windows
+        self.steps=max(len(windows),1)
+        self.progress=0
+
+    def update_bytes(self,nbytes):
+        '''Add the bytes read for the current window'''
+        if Env.heatmap:Env.heatmapper.update_bytes(nbytes)
+        if self.enabled:self.nbytes+=nbytes
 
     def update_progress(self):
-        if self.enabled:
-            self.progress+=1.0
-            gdal.TermProgress_nocb(self.progress/(self.operations*self.steps))
+        '''Update after each window is processed'''
+        if Env.heatmap:Env.heatmapper.update()
+        if not self.enabled:return
+        if self.progress<len(self.windows):
+            window=self.windows[int(self.progress)]
+            self.pixels+=window[2]*window[3]
+        self.progress+=1
+        now=timer()
+        if self.updated is None or now-self.updated>=self.interval or self.__fraction__()>=1:
+            self.__emit__(now)
+
+    def info(self,now=None):
+        '''Get the current progress as a dict'''
+        if now is None:now=timer()
+        elapsed=now-self.started
+        fraction=self.fraction
+        if elapsed>0:pps,mbps=self.pixels/elapsed,self.nbytes/elapsed/2.0**20
+        else:pps,mbps=0.0,0.0
+        if 0<fraction<1:eta=elapsed*(1-fraction)/fraction
+        elif fraction>=1:eta=0.0
+        else:eta=None
+        return {'fraction':fraction,'windows':self.completed+self.progress,
+                'total_windows':self.__total__(),'pixels':self.pixels,'bytes':self.nbytes,
+                'elapsed':elapsed,'pixels_per_second':pps,'mbytes_per_second':mbps,'eta':eta}
+
+    def __total__(self):
+        if not self.passes:return int(self.operations*self.steps)
+        #Windows in previous passes, this pass and any passes still expected
+        return int(self.completed+self.steps*(1+max(self.operations-self.passes,0)))
+
+    def __fraction__(self):
+        total=self.__total__()
+        if total<=0:return 1.0
+        return min((self.completed+self.progress)/float(total),1.0)
+
+    def __emit__(self,now):
+        #Don't go backwards when there are more passes than expected
+        self.fraction=max(self.fraction,self.__fraction__())
+        self.updated=now
+        info=self.info(now)
+        callbacks=self.callbacks
+        if self.console:callbacks=[term_progress]+callbacks
+        for callback in callbacks:callback(info)
 
 Env.progress=Progress()
 
@@ -0,0 +1,113 @@
+# -*- coding: UTF-8 -*-
+'''
+Name: focal.py
+Purpose: Vectorised moving window (focal) kernels
+
+Author: Luke Pinner
+'''
+# Copyright: (c) Luke Pinner 2013
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#-------------------------------------------------------------------------------
+__all__ = [ "STATISTICS", "focal_statistic" ]
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+STATISTICS=('majority','max','mean','min','std','sum')
+
+def sliding(data, size, axis):
+    ''' Sliding window view (no copy) of size values along an axis,
+        the windows are in the last dimension
+    '''
+    axis=axis%data.ndim
+    shape=list(data.shape)
+    shape[axis]=shape[axis]-size+1
+    shape.append(size)
+    strides=list(data.strides)+[data.strides[axis]]
+    return as_strided(data, shape=shape, strides=strides)
+
+def separable(data, size, func):
+    ''' Apply a separable reduction (sum, min, max) over a size x size
+        window in the last two dimensions, the output is 2*(size//2)
+        rows and columns smaller than the input
+    '''
+    for axis in (-1,-2):
+        data=func(sliding(data,size,axis),axis=-1)
+    return data
+
+def focal_statistic(data, statistic, size):
+    ''' Calculate a focal statistic over a size x size moving window.
+
+        data is a (bands,) rows, cols ndarray or MaskedArray with a halo of
+        size//2 pixels on each side. Masked and NaN values are ignored.
+        Returns a MaskedArray without the halo, masked where there are no valid
+        values in the moving window.
+    '''
+    values=np.ma.getdata(data)
+    valid=~np.ma.getmaskarray(data)
+    if values.dtype.kind=='f':valid&=~np.isnan(values)
+    count=separable(valid.astype(np.int32),size,np.sum)
+
+    if statistic in ('sum','mean','std'):
+        total=separable(np.where(valid,values,0).astype(np.float64),size,np.sum)
+        if statistic=='sum':result=total
+        else:
+            dtype=np.promote_types(values.dtype,np.float32)
+            with np.errstate(invalid='ignore',divide='ignore'):
+                mean=total/count.astype(np.float64)
+                if statistic=='mean':result=mean.astype(dtype)
+                else:
+                    squares=np.where(valid,values,0).astype(np.float64)**2
+                    var=separable(squares,size,np.sum)/count-mean**2
+                    result=np.sqrt(np.maximum(var,0)).astype(dtype)
+
+    elif statistic in ('min','max'):
+        if values.dtype.kind=='f':fill=np.inf
+        elif values.dtype.kind=='b':fill=True
+        else:fill=np.iinfo(values.dtype).max
+        if statistic=='min':
+            result=separable(np.where(valid,values,fill).astype(values.dtype),size,np.min)
+        else:
+            if values.dtype.kind=='f':fill=-np.inf
+            elif values.dtype.kind=='b':fill=False
+            else:fill=np.iinfo(values.dtype).min
+            result=separable(np.where(valid,values,fill).astype(values.dtype),size,np.max)
+
+    elif statistic=='majority':
+        #Count each class present in the block, ties go to the lowest value.
+        #Classes are relabelled 0..n-1 per block and counted in a pass each,
+        #so blocks with many classes are slower but not limited
+        classes,labels=np.unique(values[valid],return_inverse=True)
+        if values.dtype.kind in 'fc' and (classes!=np.floor(classes)).any():
+            raise ValueError('majority requires integer (class) values')
+        labelled=np.full(values.shape,-1,np.int64)
+        labelled[valid]=labels
+        result=np.zeros(count.shape,values.dtype)
+        most=np.zeros(count.shape,np.int32)
+        for label,value in enumerate(classes):
+            n=separable((labelled==label).astype(np.int32),size,np.sum)
+            more=n>most
+            result[more]=value
+            most[more]=n[more]
+
+    else:raise ValueError('%s not one of %s'%(repr(statistic),'|'.join(STATISTICS)))
+
+    return np.ma.MaskedArray(result,count==0)
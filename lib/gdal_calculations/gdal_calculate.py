@@ -22,7 +22,12 @@ Required parameters:
      --calc     : calculation in numpy syntax, rasters specified as using
                   any legal python variable name syntax, band numbers are
                   specified using square brackets (zero based indexing)
-     --outfile  : output filepath
+                  Multiple named calculations can be listed (--calc name=calculation)
+                  and are evaluated in a single pass on the numpy arrays
+                  of each block of the rasters.
+     --outfile  : output filepath, "{name}" is replaced by the calculation name.
+                  If there are multiple calculations and no "{name}", the name is
+                  appended to the filename, e.g. out.tif -> out_name.tif
      --{*}      : filepaths for raster variables used in --calc
                   e.g. --calc='(someraster[0]+2)*c' --someraster='foo.tif' --c='bar.tif'
 
@@ -32,14 +37,41 @@ Optional parameters:
                        Multiple options may be listed.
      --cellsize      : one of DEFAULT|MINOF|MAXOF|"xres yres"|xyres
                        (Default=DEFAULT, leftmost dataset in expression)
+     --dtype-policy  : one of NUMPY|COMPACT, COMPACT uses float32 instead of float64
+                       results when all the operands fit in a float32 (Default=NUMPY)
+     --explain       : print the execution plan without running the calculation, i.e.
+                       which rasters are reprojected, resampled, clipped or cast, the
+                       output grid, the windows of each pass, the temporary rasters and
+                       the estimated bytes read and written (Default=False)
      --extent        : one of MINOF|INTERSECT|MAXOF|UNION|"xmin ymin xmax ymax"
                        (Default=MINOF)
+     --heatmap       : write a raster with one pixel per processing window of the seconds
+                       (band 1) and bytes read (band 2) alongside the output, i.e.
+                       out.tif -> out_heatmap.tif (Default=False)
+     --iocount       : print the reads of each input, temporary and VRT (warped, clipped,
+                       converted) raster, the source blocks read, the estimated GDAL
+                       block cache hits/misses and bytes decoded and how many times
+                       each source is decoded (redundancy) (Default=False)
+     --maskbands     : use GDAL mask bands (alpha bands, .msk files) as well as
+                       NoData values when --nodata is set (Default=False)
      --nodata        : handle nodata using masked arrays (Default=False)
                        uses numpy.ma.MaskedArray to handle NoData values
                        MaskedArrays can be much slower...
+     --nan           : handle nodata by converting it to NaN (Default=False)
+                       much faster than --nodata for floating point calculations
      --notile        : don't use tiled processing, faster but uses more memory (Default=False)
      --numexpr       : Enable numexpr evaluation (Default=False)
      --overwrite     : overwrite if required (Default=False)
+     --packbits      : store boolean results as 1 bit (NBITS=1) GTiffs (Default=False)
+     --preview       : quick look, calculate at a reduced resolution so the first input
+                       is at most this many pixels wide/high, reading from overviews if
+                       there are any, i.e. --preview 1024 (Default=full resolution)
+     --profile       : print the time spent reading, computing, writing, building VRTs
+                       and copying for each operation and input dataset and the peak
+                       memory use (Default=False)
+     --trace         : write a Chrome trace event JSON file of the block reads/writes,
+                       VRT construction and operations, view it in chrome://tracing
+                       or Perfetto
      -q --quiet      : Don't display progress (Default=False)
      --reproject     : reproject if required (Default=False)
                        datasets are projected to the SRS of the first input
@@ -48,6 +80,8 @@ Optional parameters:
                        "LANCZOS"|"MODE"|"NEAREST"|gdal.GRA_*)
                        (Default="NEAREST")
     --snap           : filepath of a raster to snap extent coordinates to.
+    --sparse         : skip empty or all NoData windows, requires --nodata or --nan (Default=False)
+                       use --co=SPARSE_OK=TRUE to keep a GTiff output sparse
     --srs            : the output spatial reference system
                        one of osgeo.osr.SpatialReference (object)|WKT (string)|EPSG code (integer)
                        (Default = None)
@@ -86,7 +120,7 @@ Example:
 # THE SOFTWARE.
 #
 #-------------------------------------------------------------------------------
-import os, sys, numpy, tempfile
+import os, re, sys, math, numpy, tempfile
 from osgeo import gdal
 from gdal_dataset import *
 from environment import *
@@ -94,6 +128,26 @@ from conversions import *
 import geometry
 from gdal_calculations import __version__
 
+def passes(calc):
+    '''Count the passes over the rasters in an expression for the progress meter,
+       i.e. operations and method/function calls that process the rasters block by block.
+       Type conversion functions and subscripting use VRTs so aren't counted'''
+    import ast
+    n=0
+    for node in ast.walk(ast.parse(calc,mode='eval').body):
+        if isinstance(node,ast.BinOp):n+=1
+        elif isinstance(node,ast.UnaryOp) and not isinstance(node.operand,ast.Num):n+=1
+        elif isinstance(node,ast.Compare):n+=len(node.ops)
+        elif isinstance(node,ast.Call):
+            if isinstance(node.func,ast.Attribute):n+=1
+            elif getattr(node.func,'id',None) in ('con','map_blocks','reclass','where'):n+=1
+    return max(n,1)
+
+def throughput(info):
+    '''Format the progress info'''
+    return 'Processed %.1f Mpixels in %.1f s (%.1f Mpixels/s, %.1f MB/s read)'%(
+            info['pixels']/1e6,info['elapsed'],info['pixels_per_second']/1e6,info['mbytes_per_second'])
+
 def main():
 
     prog='gdal_calculate'
@@ -146,7 +200,7 @@ def main():
         del sys.argv[sys.argv.index('--redirect-stderr')]
 
     #Required parameters
-    argparser.add_argument('--calc', dest='calc', help='calculation in numpy syntax using +-/* or numpy array functions (i.e. numpy.logical_and())', required=True)
+    argparser.add_argument('--calc', dest='calc', action='append', help='calculation in numpy syntax using +-/* or numpy array functions (i.e. numpy.logical_and()), repeat --calc name=calculation for multiple outputs', required=True)
     argparser.add_argument('--out', '--outfile', dest='outfile', help='output file to Generate.', required=True)
 
     #Optional parameters
@@ -163,38 +217,80 @@ def main():
         'options may be listed. See the GTIFF documentation for legal'
         'creation options.')
     argparser.add_argument('--cellsize', dest='cellsize', default='DEFAULT', help='Output extent - one of "DEFAULT", "MINOF", "MAXOF", "xres yres" , xyres')
+    argparser.add_argument('--dtype-policy', dest='dtype_policy', default='NUMPY', help='Output datatype policy - one of "NUMPY", "COMPACT" (float32 instead of float64 when all the operands fit in a float32)')
+    argparser.add_argument('--explain', dest='explain', default=False, action='store_true', help='Print the execution plan without running the calculation')
     argparser.add_argument('--extent', dest='extent', default='MINOF', help='Output extent - one of "MINOF", "INTERSECT", "MAXOF", "UNION", "xmin ymin xmax ymax"')
+    argparser.add_argument('--heatmap', dest='heatmap', default=False, action='store_true', help='Write a raster of the seconds and bytes read for each processing window alongside the output')
+    argparser.add_argument('--iocount', dest='iocount', default=False, action='store_true', help='Print the reads, block cache hits/misses and bytes decoded of each input and VRT')
+    argparser.add_argument("--maskbands", dest="maskbands", default=False, action='store_true', help='Use GDAL mask bands (alpha bands, .msk files) as well as NoData values when --nodata is set')
     argparser.add_argument("--nodata", dest="nodata", default=False, action='store_true', help='Account for nodata  (Note this uses masked arrays which can be much slower)')
+    argparser.add_argument("--nan", dest="nan", default=False, action='store_true', help='Account for nodata by converting it to NaN (faster than --nodata for floating point calculations)')
     argparser.add_argument("--notile", dest='notile', default=False, action='store_true', help='Don\'t use tiled processing - True/False')
     argparser.add_argument("--numexpr", dest="enable_numexpr", default=False, action='store_true', help='Enable numexpr')
     argparser.add_argument('--overwrite', dest='overwrite', default=False, action='store_true', help='Overwrite output file if it already exists')
+    argparser.add_argument('--packbits', dest='packbits', default=False, action='store_true', help='Store boolean results as 1 bit (NBITS=1) GTiffs')
+    argparser.add_argument('--preview', dest='preview', default=None, type=int, help='Calculate at a reduced resolution, at most this many pixels wide/high')
+    argparser.add_argument('--profile', dest='profile', default=False, action='store_true', help='Print the time spent in each phase of each operation and input dataset')
     argparser.add_argument('--reproject', dest='reproject', default=False, action='store_true', help='Reproject input rasters if required (datasets are projected to the SRS of the first input dataset in an expression)')
     argparser.add_argument('--resampling', dest='resampling', default='NEAREST', help='Resampling type when reprojecting - one of "AVERAGE"|"BILINEAR"|"CUBIC"|"CUBICSPLINE"|"LANCZOS"|"MODE"|"NEAREST"|gdal.GRA_*)')
+    argparser.add_argument('--sparse', dest='sparse', default=False, action='store_true', help='Skip empty or all NoData windows (requires --nodata or --nan)')
     argparser.add_argument('--snap', dest='snap', default='', help='Filepath of a raster to snap extent coordinates to')
+    argparser.add_argument('--trace', dest='trace', default=None, help='Write a Chrome trace event JSON file of the block reads/writes, VRT construction and operations')
     argparser.add_argument('--tempdir', dest='tempdir', default=tempfile.gettempdir(), help='Temp working directory')
     argparser.add_argument('--tempoptions', dest='tempoptions', default=['BIGTIFF=IF_SAFER'], action='append', help='Creation GTIFF options for Temp rasters')
     argparser.add_argument('--ntiles', dest='ntiles', default=1, help='Number of tiles to process at a time')
 
     args, rasters = argparser.parse_known_args()
+    if args.preview is not None and args.preview<1:
+        argparser.error('--preview must be at least 1 pixel, not %s'%args.preview)
 
     #Set environment variables
     Env.cellsize=args.cellsize
+    Env.dtype_policy=args.dtype_policy
     try:Env.extent=map(float,args.extent.split())
     except:Env.extent=args.extent
+    Env.heatmap=args.heatmap
+    Env.iocount=args.iocount
+    Env.maskbands=args.maskbands
     Env.nodata=args.nodata
+    if args.nan:Env.nodata='NAN'
     Env.enable_numexpr=args.enable_numexpr
     Env.ntiles=int(args.ntiles)
     Env.overwrite=args.overwrite
+    Env.packbits=args.packbits
+    Env.profile=args.profile
+    Env.trace=bool(args.trace)
     Env.reproject=args.reproject
     try:Env.resampling=int(args.resampling)
     except:Env.resampling=args.resampling
     if args.snap:Env.snap=Dataset(args.snap)
+    Env.sparse=args.sparse
     Env.tiled=not args.notile
     Env.tempdir=args.tempdir
     Env.tempoptions=args.tempoptions
     
+    #Named calculations
+    calcs=[]
+    for calc in args.calc:
+        match=re.match(r'\s*([A-Za-z_]\w*)\s*=(?!=)(.*)$',calc,re.S)
+        if match:calcs.append(match.groups())
+        else:calcs.append((None,calc))
+    outfiles={}
+    for i,(name,calc) in enumerate(calcs):
+        if name is None:name='calc%s'%(i+1)
+        if '{name}' in args.outfile:outfile=args.outfile.replace('{name}',name)
+        elif len(calcs)>1:
+            root,ext=os.path.splitext(args.outfile)
+            outfile='%s_%s%s'%(root,name,ext)
+        else:outfile=args.outfile
+        calcs[i]=(name,calc)
+        outfiles[name]=outfile
+    args.calc=calcs[0][1]
+    args.outfile=outfiles[calcs[0][0]]
+
     #get Datset objects from input files
     datasets=[]
+    variables={}
     while rasters:
         arg=rasters.pop(0)
         try:var,path=arg.split('=') # --arg=filepath?
@@ -207,15 +303,41 @@ def main():
                 path=None
         if var and path:
             var=var.lstrip('-')
+            if args.preview and not datasets:
+                #Decimate so the first input is at most --preview pixels wide/high
+                ds=gdal.Open(path)
+                size=max(ds.RasterXSize,ds.RasterYSize)
+                Env.preview_scale=max(1,int(math.ceil(size/float(args.preview))))
+                ds=None
             locals()[var]=Dataset(path)
             datasets.append(locals()[var])
+            variables[var]=locals()[var]
+
+    #Print the plan instead of running the calculation
+    if args.explain:
+        if len(calcs)>1:print(explain(calcs,variables,outfiles))
+        else:print(explain(lambda:eval(args.calc,globals(),variables),variables,args.outfile))
+        return
+
+    #Multiple calculations, read each block of the inputs once
+    if len(calcs)>1:
+        if not args.quiet:
+            print('Running calculations')
+            Env.progress=Progress(1)
+        try:
+            evaluate(calcs,variables,outfiles,args.outformat,args.creation_options)
+        except Exception as e:
+            sys.stderr.write('\n%s: %s\n'%(type(e).__name__,e))
+            sys.exit(1)
+        if not args.quiet:print(throughput(Env.progress.info()))
+        if args.profile:print(Env.profiler)
+        if args.iocount:print(Env.iocounter)
+        if args.trace:Env.tracer.dump(args.trace)
+        return
+
     #Setup progress meter
     if not args.quiet:
-        try:
-            import ast
-            ops=ast.parse(args.calc,mode='eval')
-            #How many operations/method calls?
-            ops=len([i for i in ast.walk(ops.body) if isinstance(i,(ast.BinOp,ast.Call))])
+        try:ops=passes(args.calc)
         except:ops=len(datasets)+1
         print('Running calculation')
         Env.progress=Progress(ops)
@@ -233,6 +355,7 @@ def main():
     except:
         try:
             outfile = eval(args.calc)
+            if not args.quiet:print(throughput(Env.progress.info()))
             if not args.quiet:print('Saving output')
             outfile.save(args.outfile,args.outformat,args.creation_options)
         except Exception as e:
@@ -240,3 +363,7 @@ def main():
             sys.stderr.write('\n%s: %s\n'%(type(e).__name__,e.message))
             sys.exit(1)
 
+    if args.profile:print(Env.profiler)
+    if args.iocount:print(Env.iocounter)
+    if args.trace:Env.tracer.dump(args.trace)
+
@@ -34,15 +34,22 @@ __all__ = [ "Dataset",          "ArrayDataset",
             "ConvertedDataset", "ClippedDataset",
             "WarpedDataset",    "DatasetStack",
             "TemporaryDataset", "NewDataset",
-            "Block"
+            "Block",            "map_blocks",
+            "reclass",          "where",
+            "con",              "evaluate",
+            "explain"
           ]
 
 import numpy as np
 from osgeo import gdal, gdal_array, osr
-import os, tempfile, operator, sys
+import os, tempfile, operator, sys, warnings, math
 from contextlib import contextmanager
 
 from environment import Env,Progress
+from stats import Statistics,Histogram,QuantileSketch
+from focal import focal_statistic,STATISTICS as FOCAL_STATISTICS
+from profiling import profiled,profilenode,heatmap_path
+from planning import Plan
 import geometry
 
 gdal.UseExceptions()
@@ -51,12 +58,28 @@ osr.UseExceptions()
 # Calculations classes
 class Block(object):
     '''Block class thanks to Matt Gregory'''
+
+    #Per-dataset masks for the current window, keyed by (id(gdal.Dataset),window)
+    #so masks shared across bands (GMF_PER_DATASET) are only read once per window
+    _maskcache={}
+
+    @profiled('read',dataset=1,window=2)
     def __init__(self, dataset_or_band, x_off, y_off, x_size, y_size,*args,**kwargs):
+        read_mask=kwargs.pop('read_mask',False)
         self.x_off = x_off
         self.y_off = y_off
         self.x_size = x_size
         self.y_size = y_size
         self.data = dataset_or_band.ReadAsArray(x_off, y_off, x_size, y_size,*args,**kwargs)
+        self.mask = None
+        if read_mask:self.mask=self.__readmask__(dataset_or_band)
+        Env.progress.update_bytes(self.data.nbytes)
+        if Env.plan:Env.plan.read(dataset_or_band,self.data)
+        if Env.iocount:Env.iocounter.read(dataset_or_band,(x_off, y_off, x_size, y_size),self.data)
+        if Env.profile:
+            window=(x_off, y_off, x_size, y_size)
+            Env.profiler.buffer(window,self.data)
+            if self.mask is not None:Env.profiler.buffer(window,self.mask)
 
     def __getattr__(self, attr):
         '''Pass any other attribute or method calls
@@ -64,6 +87,51 @@ class Block(object):
         if attr in dir(np.ndarray):return getattr(self.data,attr)
         else:raise AttributeError("'Block' object has no attribute '%s'"%attr)
 
+    def __readmask__(self, dataset_or_band):
+        '''Read the GDAL mask band window(s) (alpha bands, .msk files, per-dataset masks)
+           Returns a boolean array (True==invalid) or None if all pixels are valid'''
+        try:                   #Is it a Band
+            ds=dataset_or_band.dataset._dataset
+            bands=[dataset_or_band.band]
+        except AttributeError: #No, it's a Dataset
+            ds=dataset_or_band._dataset
+            bands=[ds.GetRasterBand(i+1) for i in range(ds.RasterCount)]
+
+        window=(self.x_off, self.y_off, self.x_size, self.y_size)
+        masks=[]
+        for band in bands:
+            flags=band.GetMaskFlags()
+            #NoData masks are handled by comparing pixel values, no need to read them
+            if flags & (gdal.GMF_ALL_VALID|gdal.GMF_NODATA):masks.append(None)
+            elif flags & gdal.GMF_PER_DATASET:masks.append(self.__datasetmask__(ds,band,window))
+            else:masks.append(band.GetMaskBand().ReadAsArray(*window)==0)
+
+        if masks.count(None)==len(masks):return None
+        if len(masks)==1:return masks[0]
+        #A per-dataset mask applies to all bands, return it as a single
+        #2D mask that broadcasts across the bands instead of copying it
+        if not [m for m in masks if m is not masks[0]]:return masks[0]
+        mask=np.zeros((len(masks),self.y_size,self.x_size),np.bool)
+        for i,m in enumerate(masks):
+            if m is not None:mask[i]=m
+        return mask
+
+    def __datasetmask__(self, ds, band, window):
+        '''Read a per-dataset mask once per window'''
+        key=(id(ds),)+window
+        try:return Block._maskcache[key]
+        except KeyError:pass
+        #Only cache the current window
+        for k in Block._maskcache.keys():
+            if k[1:]!=window:del Block._maskcache[k]
+        mask=band.GetMaskBand().ReadAsArray(*window)==0
+        Block._maskcache[key]=mask
+        return mask
+
+    @classmethod
+    def clear_mask_cache(cls):
+        cls._maskcache.clear()
+
 class RasterLike(object):
     '''Super class for Band and Dataset objects to avoid duplication '''
 
@@ -82,10 +150,11 @@ class RasterLike(object):
         return dataset1,dataset2
     check_extent=apply_environment #synonym for backwards compatability with v. <0.5
 
+    @profiled('create_copy')
     def create_copy(self,outpath,outformat='GTIFF',options=[]):
         ok=(os.path.exists(outpath) and Env.overwrite) or (not os.path.exists(outpath))
         if ok:
-            if Env.progress.enabled:callback=gdal.TermProgress_nocb
+            if Env.progress.enabled and Env.progress.console:callback=gdal.TermProgress_nocb
             else:callback=None
             try:                   #Is it a Band
                 ds=self.dataset._dataset
@@ -95,12 +164,120 @@ class RasterLike(object):
             ds=driver.CreateCopy(outpath,ds,options=options,callback=callback)
             ds=None
             del ds
-            return Dataset(outpath)
+            if Env.heatmap and Env.heatmapper.seconds is not None:
+                Env.heatmapper.save(heatmap_path(outpath))
+            return Dataset(outpath,preview=False)
         else:raise RuntimeError('Output %s exists and overwrite is not set.'%outpath)
     save=create_copy  # synonym for backwards compatibility
 
     def read_blocks_as_array(self, nblocks=None):
         '''Read GDAL Datasets/Bands block by block'''
+        for xoff, yoff, xsize, ysize in self.__windows__(nblocks):
+            yield Block(self, xoff, yoff, xsize, ysize, read_mask=Env.maskbands)
+    #CamelCase synonym
+    ReadBlocksAsArray=read_blocks_as_array
+
+    @profilenode('statistics')
+    def statistics(self, per_band=False, mask=None):
+        ''' Calculate count/sum/min/max/mean/var/std block by block in a single pass.
+
+            Returns a Statistics object which returns scalars or, if per_band is True,
+            arrays with one value per band. NoData (if Env.nodata is set) and NaN
+            values are ignored. If a mask Dataset/Band is specified, only pixels
+            where the mask is non-zero are included.
+        '''
+        dataset,maskds=self,None
+        if mask is not None:dataset,maskds=self.apply_environment(mask)
+        if per_band:stats=Statistics(dataset.nbands)
+        else:stats=Statistics()
+        return dataset.__accumulate__(stats,maskds)
+
+    def focal(self, statistic='mean', size=3):
+        ''' Calculate a moving window (focal) statistic and return a temporary dataset.
+
+            statistic is one of 'majority', 'max', 'mean', 'min', 'std' or 'sum'
+            and size is the (odd) width of the square moving window. Each window is
+            read with a halo of size//2 pixels so the results are the same whether
+            Env.tiled is True or False. NoData (if Env.nodata is set), NaN and
+            pixels outside the raster are ignored.
+
+            majority is for integer class rasters, it counts each class in a block
+            separately so blocks with many classes are slower.
+        '''
+        if statistic not in FOCAL_STATISTICS:
+            raise ValueError('%s not one of %s'%(repr(statistic),'|'.join(FOCAL_STATISTICS)))
+        if statistic=='majority' and np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(self.data_type)).kind in 'fc':
+            raise ValueError('majority requires an integer (class) raster, not %s'%gdal.GetDataTypeName(self.data_type))
+        try:
+            size=int(size)
+            if size<1 or not size%2:raise ValueError
+        except (TypeError,ValueError):
+            raise ValueError('%s is not a positive odd integer'%repr(size))
+        halo=size//2
+
+        return map_blocks(lambda data:focal_statistic(data,statistic,size),self,halo=halo)
+
+    @profilenode('histogram')
+    def histogram(self, bins=256, range=None, per_band=False, mask=None):
+        ''' Calculate a fixed bin histogram block by block.
+
+            Returns a Histogram object with counts, edges and approximate
+            percentiles. If range (min, max) is not specified, it is calculated
+            from the data in an initial statistics pass. NoData, NaN and mask
+            handling is the same as for the statistics method.
+        '''
+        dataset,maskds=self,None
+        if mask is not None:dataset,maskds=self.apply_environment(mask)
+        nbands=None
+        if per_band:nbands=dataset.nbands
+        if range is None:
+            if per_band:stats=Statistics(nbands)
+            else:stats=Statistics()
+            stats=dataset.__accumulate__(stats,maskds)
+            range=np.array([stats.min(),stats.max()]).T
+        hist=Histogram(bins,range,nbands)
+        return dataset.__accumulate__(hist,maskds)
+
+    @profilenode('percentile')
+    def percentile(self, q, per_band=False, mask=None, k=2048):
+        ''' Calculate approximate percentile(s) block by block in a single pass.
+
+            Uses a QuantileSketch with bounded memory, accuracy increases with k.
+            NoData, NaN and mask handling is the same as for the statistics method.
+        '''
+        dataset,maskds=self,None
+        if mask is not None:dataset,maskds=self.apply_environment(mask)
+        nbands=None
+        if per_band:nbands=dataset.nbands
+        sketch=dataset.__accumulate__(QuantileSketch(k,nbands),maskds)
+        return sketch.percentile(q)
+
+    #===========================================================================
+    #Private methods
+    #===========================================================================
+    def __accumulate__(self, accumulator, maskds=None):
+        '''Update a Statistics/Histogram/QuantileSketch block by block'''
+        if Env.tiled:windows=list(self.__windows__())
+        else:windows=[(0, 0, self.x_size, self.y_size)]
+        Env.progress.start(windows,self)
+        if Env.plan:windows=Env.plan.start(type(accumulator).__name__.lower(),windows,self)
+        for window in windows:
+            if Env.sparse and Env.nodata and self.__isempty__(*window):
+                Env.progress.update_progress()
+                continue
+            data=self.__readblock__(*window).data
+            if maskds is not None:
+                m=np.ma.filled(maskds.__readblock__(*window).data,0)
+                m=(m==0)|(m!=m) #Exclude zero, NoData and NaN
+                data=np.ma.MaskedArray(data,np.ma.getmaskarray(data)|m)
+            accumulator.update(data)
+            Env.progress.update_progress()
+
+        Block.clear_mask_cache()
+        return accumulator
+
+    def __windows__(self, nblocks=None):
+        '''Generate (xoff, yoff, xsize, ysize) block windows without reading them'''
 
         ncols=self.x_size
         nrows=self.y_size
@@ -125,13 +302,8 @@ class RasterLike(object):
                 else:
                     xsize = ncols - xoff
 
-                yield Block(self, xoff, yoff, xsize, ysize )
-    #CamelCase synonym
-    ReadBlocksAsArray=read_blocks_as_array
+                yield xoff, yoff, xsize, ysize
 
-    #===========================================================================
-    #Private methods
-    #===========================================================================
     def __check_cellsize__(self,dataset1,dataset2):
         #Do we need to resample?
         if Env.cellsize=='MAXOF':
@@ -211,6 +383,147 @@ class RasterLike(object):
         ext=geometry.GeoTransformToExtent(self.gt,self.x_size,self.y_size)
         return [ext[1][0],ext[1][1],ext[3][0],ext[3][1]]
 
+    def __readblock__(self, x_off, y_off, x_size, y_size, fill_value=None):
+        '''Read a Block and apply the Env NoData handling'''
+        block=Block(self, x_off, y_off, x_size, y_size, read_mask=Env.maskbands)
+        if Env.nodata=='NAN':block.data=self.__nanblock__(block)
+        elif Env.nodata:
+            if fill_value is None:fill_value=self.nodata[0]
+            block.data=self.__maskblock__(block,fill_value)
+        return block
+
+    def __readhalo__(self, x_off, y_off, x_size, y_size, halo=0):
+        '''Read a window with a halo of overlapping pixels on each side as a MaskedArray.
+           The halo is clamped to the raster and masked outside it'''
+        x0,y0=max(x_off-halo,0),max(y_off-halo,0)
+        x1,y1=min(x_off+x_size+halo,self.x_size),min(y_off+y_size+halo,self.y_size)
+        data=self.__readblock__(x0,y0,x1-x0,y1-y0).data
+        pad=[(y0-y_off+halo,y_off+y_size+halo-y1),(x0-x_off+halo,x_off+x_size+halo-x1)]
+        if data.ndim==3:pad.insert(0,(0,0))
+        values=np.pad(np.ma.getdata(data),pad,'edge')
+        mask=np.pad(np.ma.getmaskarray(data),pad,'constant',constant_values=True)
+        return np.ma.MaskedArray(values,mask)
+
+    def __blockmask__(self,block):
+        '''Get a boolean NoData mask for a block using the NoData values
+           and, if they were read, the GDAL mask bands'''
+        data=block.data
+        if data.ndim==2:mask=self.__nodatamask__(data,self.nodata[0])
+        else:
+            #Compare all bands at once with the NoData values broadcast down the band axis
+            hasnodata=np.array([n is not None for n in self.nodata])
+            if not hasnodata.any():mask=np.zeros(data.shape,np.bool)
+            else:
+                nodata=np.array([0 if n is None else n for n in self.nodata])
+                mask=data==nodata[:,np.newaxis,np.newaxis]
+                if not hasnodata.all():mask&=hasnodata[:,np.newaxis,np.newaxis]
+        if block.mask is not None:mask|=block.mask
+        return mask
+
+    def __maskblock__(self,block,fill_value=None):
+        '''Convert block data to a MaskedArray'''
+        data=np.ma.MaskedArray(block.data,self.__blockmask__(block))
+        data.fill_value=fill_value
+        return data
+
+    def __nanblock__(self,block):
+        '''Replace NoData values in block data with NaN.
+           Integer data is only promoted to floating point if
+           the Dataset/Band has a NoData value or mask band'''
+        data=block.data
+        hasnodata=block.mask is not None or [n for n in self.nodata if n is not None]
+        if not hasnodata:return data
+        if data.dtype.kind not in 'fc':
+            data=data.astype(np.promote_types(data.dtype,np.float32))
+        data[self.__blockmask__(block)]=np.nan
+        return data
+
+    def __nanmask__(self,data,*operands):
+        '''NaN doesn't propagate to integer/boolean results, so mask the
+           result where any floating point operand is NaN'''
+        mask=None
+        for o in operands:
+            try:
+                if o.dtype.kind!='f':continue
+            except AttributeError:continue
+            if mask is None:mask=np.isnan(o)
+            else:mask=mask|np.isnan(o)
+        if mask is None or not mask.any():return data
+        return np.ma.MaskedArray(data,mask|np.zeros(data.shape,np.bool))
+
+    def __nbits__(self,boolean,nodata):
+        '''Get the NBITS to pack boolean results with when Env.packbits is set,
+           there's no room for a NoData value in a 1 bit raster'''
+        if Env.packbits and boolean and not [n for n in nodata if n is not None]:return 1
+        return None
+
+    def __broadcastbands__(self,*operands):
+        '''Plan the number of output bands. Single band operands are broadcast
+           across all the bands of multiband operands, other band counts must match'''
+        nbands=[]
+        for o in operands:
+            if o is None:continue
+            elif isinstance(o,RasterLike):nbands.append(o.nbands)
+            elif np.ndim(o)==3:nbands.append(np.shape(o)[0])
+            else:nbands.append(1)
+        n=max(nbands)
+        if [b for b in nbands if b not in (1,n)]:
+            raise RuntimeError('Unable to broadcast rasters with %s bands'%' and '.join(map(str,nbands)))
+        return n
+
+    def __compactdtype__(self,dtype,*operands):
+        '''Get the Env.dtype_policy="COMPACT" datatype of a result, float32 instead
+           of float64 when all the operands fit in a float32. Only float64 results
+           are narrowed, integer results keep the numpy datatype.'''
+        dtype=np.dtype(dtype)
+        if dtype.kind=='b':return np.dtype(np.uint8)
+        if dtype!=np.float64:return dtype
+        for o in operands:
+            if o is None:continue
+            if np.ndim(o): #Array
+                if not np.can_cast(o.dtype,np.float32):return dtype
+            else: #Scalar
+                try:value=float(o)
+                except (TypeError,ValueError):return dtype
+                if np.dtype(type(o)).kind in 'iu' and abs(value)>2**24:return dtype
+                if abs(value)>np.finfo(np.float32).max:return dtype
+        return np.dtype(np.float32)
+
+    def __dtypepolicy__(self,data,*operands):
+        '''Cast a result to the Env.dtype_policy datatype'''
+        if Env.dtype_policy=='COMPACT':
+            dtype=self.__compactdtype__(data.dtype,*operands)
+            if dtype!=data.dtype:data=data.astype(dtype) #Only copy when narrowing
+        return data
+
+    def __nodatamask__(self,data,nodata):
+        if nodata is None:return np.zeros(data.shape,np.bool)
+        else:return data==nodata
+
+    def __allnodata__(self,data):
+        '''Is all the (masked or NaN) block data NoData'''
+        if np.ma.isMaskedArray(data):return np.ma.getmaskarray(data).all()
+        elif Env.nodata=='NAN' and data.dtype.kind=='f':return np.isnan(data).all()
+        else:return False
+
+    def __isempty__(self, x_off, y_off, x_size, y_size):
+        '''Use the GDAL data coverage status to check if a window is empty,
+           i.e. never written (sparse GTiffs) or not covered by any VRT source'''
+        #Without NoData, empty blocks are read as 0 which may be a valid value
+        if None in self.nodata:return False
+        empty=getattr(gdal,'GDAL_DATA_COVERAGE_STATUS_EMPTY',None)
+        if empty is None:return False #GDAL < 2.2
+
+        try:                   #Is it a Band
+            bands=[self.band]
+        except AttributeError: #No, it's a Dataset
+            bands=[self._dataset.GetRasterBand(i+1) for i in range(self.nbands)]
+
+        for band in bands:
+            flags,pct=band.GetDataCoverageStatus(x_off, y_off, x_size, y_size)
+            if flags!=empty:return False
+        return True
+
     def __getnodes__(self, root, nodetype, name, index=True):
         '''Function for handling serialised VRT XML'''
         #Originally based on the  _xmlsearch function in GDAL autotest/gdrivers/vrtderived.py
@@ -277,48 +590,73 @@ class RasterLike(object):
     def __ndarraymethod__(self,attr):
         '''Pass method calls down to ndarrays and return a temporary dataset.'''
 
+        @profilenode(attr)
         def __method__(*args,**kwargs):
             if attr[:8] == '__array_': return None #This breaks numexpr
 
-            if Env.tiled:
-                reader=self.ReadBlocksAsArray()
-                xblock,yblock=self.block_size
-                Env.progress.steps = (self.x_size*self.y_size)/(xblock*yblock*Env.ntiles)
-            else: reader=[Block(self,0, 0,self.x_size, self.y_size)]
+            #Reductions don't return block shaped results,
+            #so calculate them in a single streaming pass instead
+            if Env.tiled and attr in ('sum','mean','min','max','var','std') and not args:
+                if kwargs.get('axis') is None and not [k for k in kwargs if k not in ('axis','ddof')]:
+                    #NaN propagates like numpy unless it is NoData
+                    stats=self.__accumulate__(Statistics(skipnan=bool(Env.nodata)))
+                    if attr in ('var','std'):return getattr(stats,attr)(kwargs.get('ddof',0))
+                    else:return getattr(stats,attr)()
+
+            if Env.tiled:windows=list(self.__windows__())
+            else: windows=[(0, 0, self.x_size, self.y_size)]
+            Env.progress.start(windows,self)
+            if Env.plan:windows=Env.plan.start(attr,windows,self)
+            sparse=Env.sparse and Env.nodata
 
             tmpds=None
-            for b in reader:
-
-                if Env.nodata:
-                    if b.data.ndim==2:mask=(b.data==self.nodata[0])
-                    else:mask=np.array([b.data[i,:,:]==self.nodata[i] for i in range(b.data.shape[0])])
-                    b.data=np.ma.MaskedArray(b.data,mask)
-                    b.data.fill_value=self.nodata[0]
-                    nodata=[self.nodata[0]]*self.nbands
+            for window in windows:
+                #Skip empty windows, the first window is always processed so
+                #the output datatype is known
+                if tmpds and sparse and self.__isempty__(*window):
+                    tmpds.write_nodata(*window)
+                    Env.progress.update_progress()
+                    continue
+
+                b=self.__readblock__(*window)
+                if Env.nodata:nodata=[self.nodata[0]]*self.nbands
                 else:nodata=self.nodata
 
+                if tmpds and sparse and self.__allnodata__(b.data):
+                    tmpds.write_nodata(*window)
+                    Env.progress.update_progress()
+                    continue
+
                 data=getattr(b.data,attr)(*args,**kwargs)
+                if Env.nodata=='NAN' and data.dtype.kind not in 'fc':
+                    data=self.__nanmask__(data,b.data)
 
                 #Sanity check - returns array of same dimensions as block
                 if data.shape not in [((b.y_size,b.x_size)),(self.nbands,b.y_size,b.x_size)]:
                     if Env.tiled:raise RuntimeError('When Env.tiled==True, the "%s" method is not supported.'%attr)
                     else:return data
+                data=self.__dtypepolicy__(data,b.data,*args)
 
                 if not tmpds:
                     #GDAL casts unknown types to Float64... bools don't need to be that big
-                    if data.dtype==np.bool:data=data.astype(np.uint8)
+                    boolean=data.dtype==np.bool
+                    if boolean:data=data.astype(np.uint8)
                     datatype=gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype.type)
 
                     if datatype is None:raise RuntimeError('Unsupported operation: "%s"'%attr)
                     if data.ndim==2:nbands=1
                     else:nbands=data.shape[0]
+                    if Env.nodata=='NAN' and nodata[0] is None and data.dtype.kind=='f':
+                        nodata=[np.nan]*nbands
 
                     tmpds=TemporaryDataset(self.x_size,self.y_size,nbands,
-                                           datatype,self.srs,self.gt, nodata)
+                                           datatype,self.srs,self.gt, nodata,
+                                           self.__nbits__(boolean,nodata))
 
                 tmpds.write_data(data, b.x_off, b.y_off)
                 Env.progress.update_progress()
 
+            Block.clear_mask_cache()
             try:tmpds.FlushCache() #Fails when file is in /vsimem
             except:pass
 
@@ -326,6 +664,7 @@ class RasterLike(object):
 
         return __method__
 
+    @profilenode(lambda self,op,*args,**kwargs:getattr(op,'__name__','operation'))
     def __operation__(self,op,other=None,swapped=False,*args,**kwargs):
         ''' Perform arithmetic/bitwise/boolean and return a temporary dataset.
             Set `swapped` to True to perform the operation
@@ -338,33 +677,40 @@ class RasterLike(object):
             else:
                 dataset1,dataset2=self.check_extent(other)
 
-        if Env.tiled:
-            reader=dataset1.ReadBlocksAsArray()
-            xblock,yblock=self.block_size
-            Env.progress.steps = (self.x_size*self.y_size)/(xblock*yblock*Env.ntiles)
-        else: reader=[Block(dataset1,0, 0,dataset1.x_size, dataset1.y_size)]
+        if Env.tiled:windows=list(dataset1.__windows__())
+        else: windows=[(0, 0, dataset1.x_size, dataset1.y_size)]
+        Env.progress.start(windows,dataset1)
+        if Env.plan:windows=Env.plan.start(getattr(op,'__name__','operation').strip('_'),windows,dataset1)
+        sparse=Env.sparse and Env.nodata
+        operands=[d for d in (dataset1,dataset2) if isinstance(d,RasterLike)]
+
+        #Plan the output bands up front, a single band operand is read once per
+        #window and broadcast by numpy across the bands of the other operand
+        nbands=self.__broadcastbands__(dataset1,dataset2)
+        if Env.nodata:nodata=[dataset1.nodata[0]]*nbands
+        elif len(dataset1.nodata)==nbands:nodata=dataset1.nodata
+        else:nodata=dataset1.nodata*nbands
+
         tmpds=None
-        for b1 in reader:
-            if Env.nodata:
-                if b1.data.ndim==2:mask=(b1.data==dataset1.nodata[0])
-                else:mask=np.array([b1.data[i,:,:]==dataset1.nodata[i] for i in range(b1.data.shape[0])])
-                b1.data=np.ma.MaskedArray(b1.data,mask)
-                b1.data.fill_value=dataset1.nodata[0]
-                nodata=[dataset1.nodata[0]]*dataset1.nbands
-            else:nodata=dataset1.nodata
+        for window in windows:
+            #Skip windows where any operand is empty as the result will be all NoData,
+            #the first window is always processed so the output datatype is known
+            if tmpds and sparse and [d for d in operands if d.__isempty__(*window)]:
+                tmpds.write_nodata(*window)
+                Env.progress.update_progress()
+                continue
 
-            if dataset2 is not None: #zero is valid
-                if isinstance(dataset2,RasterLike):
-                    b2=Block(dataset2,b1.x_off, b1.y_off,b1.x_size, b1.y_size)
+            b1=dataset1.__readblock__(*window)
+            b2=None
 
-                    if Env.nodata:
-                        if b2.data.ndim==2:mask=(b2.data==dataset2.nodata[0])
-                        else:mask=np.array([b2.data[i,:,:]==dataset2.nodata[i] for i in range(b2.data.shape[0])])
-                        b2.data=np.ma.MaskedArray(b2.data,mask)
-                        b2.data.fill_value=dataset1.nodata[0]
-                        nodata=[dataset1.nodata[0]]*dataset2.nbands
-                    else:nodata=dataset1.nodata
+            if tmpds and sparse and self.__allnodata__(b1.data):
+                tmpds.write_nodata(*window)
+                Env.progress.update_progress()
+                continue
 
+            if dataset2 is not None: #zero is valid
+                if isinstance(dataset2,RasterLike):
+                    b2=dataset2.__readblock__(*window, fill_value=dataset1.nodata[0])
                     if swapped:data=op(b2.data, b1.data)
                     else:data=op(b1.data, b2.data)
                 else: #Not a Band/Dataset, try the op directly
@@ -372,17 +718,25 @@ class RasterLike(object):
                     else:data=op(b1.data,dataset2)
             else:
                 data=op(b1.data)
-            if data.dtype==np.bool:data=data.astype(np.uint8)
+            if Env.nodata=='NAN' and data.dtype.kind not in 'fc':
+                if b2 is None:data=self.__nanmask__(data,b1.data)
+                else:data=self.__nanmask__(data,b1.data,b2.data)
+            boolean=data.dtype==np.bool
+            if boolean:data=data.astype(np.uint8)
+            if b2 is None:data=self.__dtypepolicy__(data,b1.data,dataset2)
+            else:data=self.__dtypepolicy__(data,b1.data,b2.data)
             if not tmpds:
                 datatype=gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype.type)
                 if not datatype:datatype=gdal.GDT_Byte
-                try:tmpds=TemporaryDataset(dataset1.x_size,dataset1.y_size,dataset1.nbands,
-                                       datatype,dataset1.srs,dataset1.gt,nodata)
-                except:tmpds=TemporaryDataset(dataset2.x_size,dataset2.y_size,dataset2.nbands,
-                                       datatype,dataset1.srs,dataset1.gt,nodata)
+                if Env.nodata=='NAN' and nodata[0] is None and data.dtype.kind=='f':
+                    nodata=[np.nan]*len(nodata)
+                tmpds=TemporaryDataset(dataset1.x_size,dataset1.y_size,nbands,
+                                       datatype,dataset1.srs,dataset1.gt,nodata,
+                                       self.__nbits__(boolean,nodata))
             tmpds.write_data(data, b1.x_off, b1.y_off)
             Env.progress.update_progress()
 
+        Block.clear_mask_cache()
         try:tmpds.FlushCache()
         except:pass
         return tmpds
@@ -515,11 +869,15 @@ class Dataset(RasterLike):
 
         The 'magic' bit is using getattr to pass attribute or method calls
         through to the underlying GDALDataset/ndarray objects
+
+        While Env.preview_scale > 1, datasets that are opened (from a filepath or
+        GDALDataset) are read at 1/preview_scale resolution, unless preview=False.
     '''
-    def __init__(self,filepath_or_dataset=None,*args):
+    def __init__(self,filepath_or_dataset=None,*args,**kwargs):
         gdal.UseExceptions()
 
         fp=filepath_or_dataset
+        preview=kwargs.pop('preview',True)
 
         if type(fp) is gdal.Dataset:
             self._dataset = fp
@@ -537,6 +895,11 @@ class Dataset(RasterLike):
             self._dataset = gdal.GetDriverByName('VRT').CreateCopy(tmp_fn,tmp_ds)
             self.gt = self.GetGeoTransform()
 
+        #Quick look at a reduced resolution
+        if fp is not None and preview and Env.preview_scale>1:
+            self.__preview__(Env.preview_scale)
+            self.gt = self.GetGeoTransform()
+
         self.x_size=self.RasterXSize
         self.y_size=self.RasterYSize
         self.nbands=self.RasterCount
@@ -551,6 +914,44 @@ class Dataset(RasterLike):
     def __del__(self):
         self._dataset=None
         del self._dataset
+        try:gdal.Unlink(self.__dict__['_previewfn'])
+        except:pass
+
+    def __preview__(self,scale):
+        ''' Replace the GDALDataset with a VRT of it decimated by scale, with the
+            same extent. GDAL reads it from the overviews if there are any,
+            otherwise by downsampling (i.e. RasterIO with a smaller buffer).'''
+        ds=self._dataset
+        if ds.GetDriver().ShortName=='MEM':return #No file for the VRT to reference
+        cols,rows=ds.RasterXSize,ds.RasterYSize
+        x_size=int(math.ceil(cols/float(scale)))
+        y_size=int(math.ceil(rows/float(scale)))
+        xscale,yscale=cols/float(x_size),rows/float(y_size)
+        gt=list(ds.GetGeoTransform())
+        gt=[gt[0],gt[1]*xscale,gt[2]*yscale,gt[3],gt[4]*xscale,gt[5]*yscale]
+
+        vrt=[]
+        vrt.append('<VRTDataset rasterXSize="%s" rasterYSize="%s">' % (x_size,y_size))
+        vrt.append('  <SRS>%s</SRS>' % ds.GetProjection())
+        vrt.append('  <GeoTransform>%s</GeoTransform>' % ', '.join(map(str,gt)))
+        for i in range(ds.RasterCount):
+            rb=ds.GetRasterBand(i+1) #gdal band index start at 1
+            nodata=rb.GetNoDataValue()
+            vrt.append('  <VRTRasterBand dataType="%s" band="%s">' % (gdal.GetDataTypeName(rb.DataType), i+1))
+            vrt.append('    <SimpleSource>')
+            vrt.append('      <SourceFilename relativeToVRT="0">%s</SourceFilename>' % ds.GetDescription())
+            vrt.append('      <SourceBand>%s</SourceBand>'%(i+1))
+            vrt.append('      <SrcRect xOff="0" yOff="0" xSize="%s" ySize="%s" />' % (cols,rows))
+            vrt.append('      <DstRect xOff="0" yOff="0" xSize="%s" ySize="%s" />' % (x_size,y_size))
+            vrt.append('    </SimpleSource>')
+            if nodata is not None: # 0 is a valid value
+                vrt.append('    <NoDataValue>%s</NoDataValue>' % nodata)
+            vrt.append('  </VRTRasterBand>')
+        vrt.append('</VRTDataset>')
+
+        self._previewfn='/vsimem/%s.vrt'%tempfile._RandomNameSequence().next()
+        self.__write_vsimem__(self._previewfn,'\n'.join(vrt))
+        self._dataset=gdal.Open(self._previewfn)
 
     def __getattr__(self, attr):
         '''Pass any other attribute or method calls
@@ -614,6 +1015,7 @@ class Dataset(RasterLike):
 class ClippedDataset(Dataset):
     '''Use a VRT to "clip" to min extent of two rasters'''
 
+    @profiled('vrt',dataset=1)
     def __init__(self,dataset_or_band,extent):
         self._tmpds=None
         self._parentds=dataset_or_band #keep a reference so it doesn't get garbage collected
@@ -739,6 +1141,7 @@ class ClippedDataset(Dataset):
         if not use_exceptions:gdal.DontUseExceptions()
 
         Dataset.__init__(self)
+        if Env.plan:Env.plan.vrt(self)
 
     def _create_simple_VRT(self,warped_ds,bands):
         ''' Create a simple VRT XML string from a warped VRT (GDALWarpOptions)'''
@@ -786,6 +1189,7 @@ class ClippedDataset(Dataset):
 class ConvertedDataset(Dataset):
     '''Use a VRT to "convert" between datatypes'''
 
+    @profiled('vrt',dataset=1)
     def __init__(self,dataset_or_band,datatype):
         self._parentds=dataset_or_band #keep a reference so it doesn't get garbage collected
         use_exceptions=gdal.GetUseExceptions()
@@ -849,6 +1253,7 @@ class ConvertedDataset(Dataset):
         if not use_exceptions:gdal.DontUseExceptions()
 
         Dataset.__init__(self)
+        if Env.plan:Env.plan.vrt(self)
 
     def __del__(self):
         try:Dataset.__del__(self)
@@ -893,9 +1298,18 @@ class NewDataset(Dataset):
     def create_copy(self,outpath,outformat='GTIFF',options=[]):
         try:self.FlushCache()
         except:pass
+        #Keep packed (Env.packbits) boolean rasters packed
+        nbits=self.GetRasterBand(1).GetMetadataItem('NBITS','IMAGE_STRUCTURE')
+        if nbits and outformat.upper()=='GTIFF' and not [o for o in options if o.upper().startswith('NBITS')]:
+            options=list(options)+['NBITS=%s'%nbits]
         return Dataset.create_copy(self,outpath,outformat,options)
 
+    @profiled('write',window=2)
     def write_data(self, data, x_off=0, y_off=0):
+        if Env.profile:Env.profiler.buffer((x_off,y_off,data.shape[-1],data.shape[-2]),data)
+        if Env.iocount:Env.iocounter.write(self,data)
+        if np.ma.isMaskedArray(data):data=self.__unmask__(data, x_off, y_off)
+        if Env.nodata=='NAN':data=self.__nantonodata__(data)
         if data.ndim==2:
             tmpbnd=self._dataset.GetRasterBand(1)
             tmpbnd.WriteArray(data, x_off, y_off)
@@ -904,13 +1318,61 @@ class NewDataset(Dataset):
                 tmpbnd=self._dataset.GetRasterBand(i+1)
                 tmpbnd.WriteArray(data[i,:,:], x_off, y_off)
 
+    def write_nodata(self, x_off=0, y_off=0, x_size=None, y_size=None):
+        '''Fill a window with NoData (or mask it if there is no NoData value)'''
+        if x_size is None:x_size=self.x_size-x_off
+        if y_size is None:y_size=self.y_size-y_off
+        if self.nbands==1:shape=(y_size,x_size)
+        else:shape=(self.nbands,y_size,x_size)
+        dtype=gdal_array.GDALTypeCodeToNumericTypeCode(self.data_type)
+
+        nodata=self.nodata[0]
+        if nodata is None:data=np.ma.masked_all(shape,dtype)
+        else:
+            data=np.empty(shape,dtype)
+            data.fill(nodata)
+        self.write_data(data, x_off, y_off)
+
+    def __unmask__(self, data, x_off, y_off):
+        '''Fill masked values with NoData or, if there is no NoData value,
+           write them to a per-dataset mask band'''
+        nodata=self.nodata[0]
+        if nodata is not None:
+            dtype=np.dtype(data.dtype)
+            if not nodata_fits(nodata,dtype):
+                raise ValueError('NoData value %s does not fit the %s datatype'%(nodata,dtype.name))
+            return data.filled(np.asarray(nodata).astype(dtype))
+
+        mask=np.ma.getmaskarray(data)
+        if mask.ndim==3:mask=mask.any(axis=0)
+        if mask.any():
+            maskband=self._dataset.GetRasterBand(1)
+            if not maskband.GetMaskFlags()==gdal.GMF_PER_DATASET:
+                self._dataset.CreateMaskBand(gdal.GMF_PER_DATASET)
+                maskband.GetMaskBand().Fill(255)
+            maskband.GetMaskBand().WriteArray(np.where(mask,0,255).astype(np.uint8), x_off, y_off)
+        return data.data
+
+    def __nantonodata__(self, data):
+        '''Convert NaN back to the NoData value'''
+        nodata=self.nodata[0]
+        if nodata is None or np.isnan(nodata) or data.dtype.kind!='f':return data
+        nans=np.isnan(data)
+        if nans.any():data[nans]=nodata
+        return data
+
 class TemporaryDataset(NewDataset):
-    def __init__(self,cols,rows,bands,datatype,srs='',gt=[],nodata=[]):
+    def __init__(self,cols,rows,bands,datatype,srs='',gt=[],nodata=[],nbits=None):
         use_exceptions=gdal.GetUseExceptions()
         gdal.UseExceptions()
 
         #print cols,rows,bands,datatype,srs,gt,nodata
-        if Env.tempdir == '/vsimem':
+        if Env.plan:
+            #Only planning, a sparse GTiff that is never filled
+            self._filedescriptor=-1
+            self._filename='/vsimem/%s.tif'%tempfile._RandomNameSequence().next()
+
+        elif Env.tempdir == '/vsimem':
             #Test to see if enough memory
             tmpdriver=gdal.GetDriverByName('MEM')
             tmpds=tmpdriver.Create('',cols,rows,bands,datatype)
@@ -923,9 +1385,15 @@ class TemporaryDataset(NewDataset):
         else:
             self._filedescriptor,self._filename=tempfile.mkstemp(suffix='.tif')
 
+        options=list(Env.tempoptions)
+        if Env.sparse or Env.plan:options.append('SPARSE_OK=TRUE')
+        if nbits:options.append('NBITS=%s'%nbits) #Packed bits, GDAL unpacks them on read
+
         NewDataset.__init__(self,self._filename,'GTIFF',
-                            cols,rows,bands,datatype,srs,gt,
-                            options=Env.tempoptions)
+                            cols,rows,bands,datatype,srs,gt,nodata,
+                            options=options)
+        if Env.profile:Env.profiler.temporary(self)
+        if Env.plan:Env.plan.temporary(self,nbits)
 
     save=NewDataset.create_copy #synonym for backwards compatibility
 
@@ -942,8 +1410,10 @@ class TemporaryDataset(NewDataset):
 
 class WarpedDataset(Dataset):
 
+    @profiled('vrt',dataset=1)
     def __init__(self,dataset_or_band, wkt_srs, snap_ds=None, snap_cellsize=None):
 
+        self._parentds=dataset_or_band #keep a reference so it doesn't get garbage collected
         use_exceptions=gdal.GetUseExceptions()
         gdal.UseExceptions()
 
@@ -974,6 +1444,7 @@ class WarpedDataset(Dataset):
 
         if not use_exceptions:gdal.DontUseExceptions()
         Dataset.__init__(self)
+        if Env.plan:Env.plan.vrt(self,snap_ds)
 
     def _create_simple_VRT(self,warped_ds,dataset_or_band):
         ''' Create a simple VRT XML string from a warped VRT (GDALWarpOptions)'''
@@ -1169,12 +1640,583 @@ class DatasetStack(Dataset):
         vrt='\n'.join(vrt)
         return vrt
 
+    @profilenode('reduce')
+    def reduce(self, statistic, q=None, buffer_size=128*1024*1024):
+        ''' Reduce the stack to a per pixel statistic and return a temporary dataset.
+
+            statistic is one of 'count' (number of valid values), 'max', 'mean',
+            'median', 'min', 'percentile' (q = a percentile or sequence of
+            percentiles, 0-100, one output band each) or 'sum'. NoData (if Env.nodata
+            is set) and NaN values are ignored.
+
+            Bands are read in chunks so each block uses no more than approximately
+            buffer_size bytes. count/max/mean/min/sum are accumulated exactly chunk
+            by chunk, median/percentile read all bands for strips of rows into a
+            single float64 buffer of half the buffer_size, numpy's nanpercentile
+            uses the other half.
+
+            Every strip reads each band, so unless the GDAL cache (gdal.SetCacheMax)
+            can hold a block of every band, the source blocks are decoded once per
+            strip. A RuntimeWarning is issued when a block needs more than one
+            strip and the cache is too small.
+        '''
+        if statistic not in ('count','max','mean','median','min','percentile','sum'):
+            raise ValueError('%s not one of count|max|mean|median|min|percentile|sum'%repr(statistic))
+        if statistic=='median':q=50
+        elif statistic=='percentile' and q is None:raise ValueError('q is required for percentile')
+
+        if Env.tiled:windows=list(self.__windows__())
+        else: windows=[(0, 0, self.x_size, self.y_size)]
+        Env.progress.start(windows,self)
+        if Env.plan:windows=Env.plan.start(statistic,windows,self)
+        bands=[self[i] for i in range(self.nbands)]
+
+        tmpds=None
+        for window in windows:
+            if q is None:data=self.__reducechunks__(bands,window,statistic,buffer_size)
+            else:data=self.__reducestrips__(bands,window,q,buffer_size)
+
+            if not tmpds:
+                datatype=gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype.type)
+                if data.ndim==2:nbands=1
+                else:nbands=data.shape[0]
+                nodata=[]
+                if statistic=='count':pass
+                elif Env.nodata and self.nodata[0] is not None:nodata=[self.nodata[0]]*nbands
+                elif Env.nodata=='NAN' and data.dtype.kind=='f':nodata=[np.nan]*nbands
+
+                tmpds=TemporaryDataset(self.x_size,self.y_size,nbands,
+                                       datatype,self.srs,self.gt,nodata)
+
+            tmpds.write_data(data, window[0], window[1])
+            Env.progress.update_progress()
+
+        Block.clear_mask_cache()
+        try:tmpds.FlushCache() #Fails when file is in /vsimem
+        except:pass
+
+        return tmpds
+
+    def __ndarraymethod__(self,attr):
+        '''Reduce across the stack (axis=0) in band chunks instead of reading all bands at once'''
+        method=Dataset.__ndarraymethod__(self,attr)
+        if attr not in ('max','mean','min','sum'):return method
+
+        def __method__(*args,**kwargs):
+            axis=kwargs.get('axis')
+            if args:axis=args[0]
+            if axis==0 and len(args)+len(kwargs)==1:return self.reduce(attr)
+            return method(*args,**kwargs)
+        return __method__
+
+    def __readbands__(self, bands, x_off, y_off, x_size, y_size):
+        '''Read a chunk of bands as (bands, rows, cols) values and an invalid mask'''
+        blocks=[band.__readblock__(x_off, y_off, x_size, y_size).data for band in bands]
+        values=np.array([np.ma.getdata(b) for b in blocks])
+        invalid=np.array([np.ma.getmaskarray(b) for b in blocks])
+        if values.dtype.kind=='f':invalid|=np.isnan(values)
+        return values,invalid
+
+    def __reducechunks__(self, bands, window, statistic, buffer_size):
+        '''Accumulate count/max/mean/min/sum for a block, reading chunks of bands'''
+        x_off, y_off, x_size, y_size=window
+        chunk=max(1,buffer_size//(x_size*y_size*8))
+        count=np.zeros((y_size,x_size),np.int32)
+        result=None
+        for i in xrange(0,len(bands),chunk):
+            values,invalid=self.__readbands__(bands[i:i+chunk],*window)
+            count+=(~invalid).sum(axis=0)
+            if statistic in ('sum','mean'):
+                part=np.where(invalid,0,values).sum(axis=0,dtype=np.float64)
+                if result is None:result=part
+                else:result+=part
+            elif statistic in ('min','max'):
+                if values.dtype.kind=='f':info=np.finfo(values.dtype)
+                else:info=np.iinfo(values.dtype)
+                if statistic=='min':part=np.where(invalid,info.max,values).min(axis=0)
+                else:part=np.where(invalid,info.min,values).max(axis=0)
+                if result is None:result=part
+                elif statistic=='min':result=np.minimum(result,part)
+                else:result=np.maximum(result,part)
+
+        if statistic=='count':
+            if len(bands)<=np.iinfo(np.uint16).max:return count.astype(np.uint16)
+            else:return count.astype(np.uint32)
+        if statistic=='mean':
+            with np.errstate(invalid='ignore',divide='ignore'):
+                result=(result/count).astype(np.promote_types(values.dtype,np.float32))
+        return np.ma.MaskedArray(result,count==0)
+
+    def __reducestrips__(self, bands, window, q, buffer_size):
+        '''Calculate exact percentiles for a block, reading all bands for strips of rows'''
+        x_off, y_off, x_size, y_size=window
+        #The strip buffer and nanpercentile's working copy
+        rows=max(1,min(y_size,buffer_size//(2*len(bands)*x_size*8)))
+        if rows<y_size:
+            cache=len(bands)*x_size*y_size*gdal.GetDataTypeSize(self.data_type)//8
+            if gdal.GetCacheMax()<cache:
+                warnings.warn('The GDAL cache (%s bytes) can not hold a block of every band (%s bytes), '
+                              'the source blocks will be decoded for each of %s strips, increase it '
+                              'with gdal.SetCacheMax or increase buffer_size'%(
+                              gdal.GetCacheMax(),cache,int(np.ceil(y_size/float(rows)))),RuntimeWarning)
+
+        strip=np.empty((len(bands),rows,x_size),np.float64)
+        dtype=result=None
+        for yoff in xrange(y_off,y_off+y_size,rows):
+            ysize=min(rows,y_off+y_size-yoff)
+            values=strip[:,:ysize]
+            for i,band in enumerate(bands): #Fill the buffer in place, NaN where invalid
+                block=band.__readblock__(x_off,yoff,x_size,ysize).data
+                if dtype is None:dtype=np.promote_types(block.dtype,np.float32)
+                values[i]=np.ma.getdata(block)
+                values[i][np.ma.getmaskarray(block)]=np.nan
+            with warnings.catch_warnings(): #All NaN slices
+                warnings.simplefilter('ignore',RuntimeWarning)
+                part=np.nanpercentile(values,q,axis=0,overwrite_input=True)
+            if result is None:result=np.zeros(part.shape[:-2]+(y_size,x_size),dtype)
+            result[...,yoff-y_off:yoff-y_off+ysize,:]=part
+        return np.ma.MaskedArray(result,np.isnan(result))
+
     def __del__(self):
         self._dataset=None
         del self._dataset
         try:gdal.Unlink(self._filename)
         except:pass
 
+@profilenode('map_blocks')
+def map_blocks(func, *rasters, **kwargs):
+    ''' Apply a function to aligned blocks of one or more Datasets/Bands and
+        return a temporary dataset.
+
+        Usage: map_blocks(func, *rasters, dtype=None, nbands=None, halo=0)
+
+        The rasters are aligned with the Env settings (extent, cellsize, srs...)
+        and func is called with a numpy array for each raster, read with the
+        Env NoData handling. func must return a (rows, cols) or (bands, rows, cols)
+        array the size of the block. If halo > 0, the blocks are read with a halo
+        of overlapping pixels on each side (as MaskedArrays, masked outside the
+        raster) and func must return the block without the halo.
+
+        The output datatype (numpy dtype) and number of bands default to those of
+        the first result.
+    '''
+    dtype=kwargs.pop('dtype',None)
+    nbands=kwargs.pop('nbands',None)
+    halo=int(kwargs.pop('halo',0))
+    if kwargs:raise TypeError('Unexpected keyword argument(s): %s'%', '.join(kwargs))
+    if not rasters:raise TypeError('map_blocks requires at least one Dataset/Band')
+
+    #Get a reference dataset so can apply env setting to all datasets
+    reference=rasters[0]
+    for raster in rasters[1:]:
+        reference,raster=reference.apply_environment(raster)
+    if len(rasters)>1:rasters=[reference.apply_environment(r)[1] for r in rasters]
+    else:rasters=[reference]
+
+    if Env.tiled:windows=list(reference.__windows__())
+    else: windows=[(0, 0, reference.x_size, reference.y_size)]
+    Env.progress.start(windows,reference)
+    if Env.plan:windows=Env.plan.start(getattr(func,'__name__','map_blocks').strip('_'),windows,reference)
+    sparse=Env.sparse and Env.nodata and not halo
+
+    tmpds=None
+    for window in windows:
+        #Skip empty windows, the first window is always processed so
+        #the output datatype is known
+        if tmpds and sparse and all([r.__isempty__(*window) for r in rasters]):
+            tmpds.write_nodata(*window)
+            Env.progress.update_progress()
+            continue
+
+        if halo:blocks=[r.__readhalo__(*window,halo=halo) for r in rasters]
+        else:blocks=[r.__readblock__(*window).data for r in rasters]
+        data=func(*blocks)
+        if dtype is None:data=reference.__dtypepolicy__(data,*blocks)
+        elif data.dtype!=dtype:data=data.astype(dtype)
+        #GDAL casts unknown types to Float64... bools don't need to be that big
+        boolean=data.dtype==np.bool
+        if boolean:data=data.astype(np.uint8)
+
+        #Sanity check - returns array of same dimensions as block
+        if data.shape[-2:]!=(window[3],window[2]) or data.ndim not in (2,3):
+            raise RuntimeError('map_blocks function returned an array of shape %s, expected %s'%(
+                               repr(data.shape),repr((window[3],window[2]))))
+
+        if not tmpds:
+            datatype=gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype.type)
+            if datatype is None:raise RuntimeError('Unsupported datatype: "%s"'%data.dtype)
+
+            if nbands is None:
+                if data.ndim==2:nbands=1
+                else:nbands=data.shape[0]
+            nodata=[]
+            if Env.nodata and reference.nodata[0] is not None:
+                nodata=[reference.nodata[0]]*nbands
+            elif Env.nodata=='NAN' and data.dtype.kind=='f':
+                nodata=[np.nan]*nbands
+
+            tmpds=TemporaryDataset(reference.x_size,reference.y_size,nbands,
+                                   datatype,reference.srs,reference.gt,nodata,
+                                   reference.__nbits__(boolean,nodata))
+
+        tmpds.write_data(data, window[0], window[1])
+        Env.progress.update_progress()
+
+    Block.clear_mask_cache()
+    try:tmpds.FlushCache() #Fails when file is in /vsimem
+    except:pass
+
+    return tmpds
+
+@profilenode('reclass')
+def reclass(raster, table, default=None):
+    ''' Reclassify a Dataset/Band with a lookup table in a single pass and
+        return a temporary dataset.
+
+        table is either a dict of {value:new_value} or a sequence of
+        (min, max, new_value) ranges (min <= value < max) that must not overlap
+        (a ValueError is raised if they do). Values that aren't
+        in the table are unchanged or, if specified, set to the default value.
+        NoData (if Env.nodata is set) is passed through.
+
+        Integer rasters with a dict table use a dense lookup array and np.take,
+        otherwise the table is sorted and searched with np.searchsorted.
+    '''
+    try:
+        rows=sorted(table.items())
+        ranges=False
+    except AttributeError:
+        rows=sorted([tuple(row) for row in table])
+        ranges=True
+        if [row for row in rows if len(row)!=3]:
+            raise ValueError('Range tables must be a sequence of (min, max, new_value)')
+        for row,next_row in zip(rows[:-1],rows[1:]):
+            if row[1]>next_row[0]:
+                raise ValueError('Overlapping reclass ranges %s and %s'%(repr(row),repr(next_row)))
+    if not rows:raise ValueError('Empty reclass table')
+
+    #Smallest output datatype that holds the new values (and the old values/NoData)
+    dtypes=[np.min_scalar_type(row[-1]) for row in rows]
+    if default is None:dtypes.append(gdal_array.GDALTypeCodeToNumericTypeCode(raster.data_type))
+    else:dtypes.append(np.min_scalar_type(default))
+    if Env.nodata and raster.nodata[0] is not None:dtypes.append(np.min_scalar_type(raster.nodata[0]))
+    dtype=np.result_type(*dtypes)
+    if dtype.kind=='f':dtype=np.promote_types(dtype,np.float32)
+    if dtype.kind=='b':dtype=np.dtype(np.uint8)
+
+    keys=np.array([row[0] for row in rows])
+    values=np.array([row[-1] for row in rows],dtype)
+    if ranges:maxs=np.array([row[1] for row in rows])
+
+    #Dense lookup array for integer keys
+    lut=None
+    if not ranges and keys.dtype.kind in 'iu' and keys[-1]-keys[0]<2**20:
+        lo=int(keys[0])
+        lut=np.zeros(int(keys[-1])-lo+1,dtype)
+        haskey=np.zeros(len(lut),np.bool)
+        lut[keys-lo]=values
+        haskey[keys-lo]=True
+
+    def __reclass__(data):
+        mask=np.ma.getmaskarray(data)
+        data=np.ma.getdata(data)
+        if data.dtype.kind=='f':
+            mask=mask|np.isnan(data)
+            data=np.where(mask,0,data)
+
+        if lut is not None and data.dtype.kind in 'iub':
+            idx=data.astype(np.int64)-lo
+            matched=(idx>=0)&(idx<len(lut))
+            idx=np.clip(idx,0,len(lut)-1)
+            matched&=np.take(haskey,idx)
+            result=np.take(lut,idx)
+        elif ranges:
+            idx=np.searchsorted(keys,data,'right')-1
+            matched=(idx>=0)&(data<np.take(maxs,idx,mode='clip'))
+            result=np.take(values,idx,mode='clip')
+        else:
+            idx=np.searchsorted(keys,data)
+            matched=np.take(keys,idx,mode='clip')==data
+            result=np.take(values,idx,mode='clip')
+
+        if default is None:result=np.where(matched&~mask,result,data)
+        else:result=np.where(matched|mask,result,default)
+        return np.ma.MaskedArray(result.astype(dtype),mask)
+
+    return map_blocks(__reclass__,raster,dtype=dtype)
+
+@profilenode('where')
+def where(condition, x, y):
+    ''' Return a temporary dataset with values from x where the condition is
+        True (non-zero) and from y where it is False.
+
+        x and y can be Datasets/Bands or scalars. The rasters are aligned with
+        the Env settings and, for each block, the condition is read first and
+        x or y are only read if they're needed for that block. NoData (if
+        Env.nodata is set) in the condition or the selected branch is passed
+        through.
+    '''
+    #Get a reference dataset so can apply env setting to all datasets
+    reference=condition
+    rasters=[r for r in (x,y) if isinstance(r,RasterLike)]
+    for raster in rasters:
+        reference,raster=reference.apply_environment(raster)
+    branches=[]
+    for branch in (x,y):
+        if isinstance(branch,RasterLike):branch=reference.apply_environment(branch)[1]
+        branches.append(branch)
+    x,y=branches
+
+    #Output datatype, number of bands and NoData
+    dtypes,nodata=[],None
+    nbands=reference.__broadcastbands__(reference,x,y)
+    for branch in branches:
+        if isinstance(branch,RasterLike):
+            dtypes.append(gdal_array.GDALTypeCodeToNumericTypeCode(branch.data_type))
+            if nodata is None:nodata=branch.nodata[0]
+        else:dtypes.append(np.min_scalar_type(branch))
+    if nodata is None:nodata=reference.nodata[0]
+    if Env.nodata and nodata is not None: #The output must hold the NoData value too
+        if np.isfinite(nodata) and nodata==int(nodata):dtypes.append(np.min_scalar_type(int(nodata)))
+        else:dtypes.append(np.min_scalar_type(nodata))
+    dtype=np.result_type(*dtypes)
+    if dtype.kind=='f':dtype=np.promote_types(dtype,np.float32)
+    if dtype.kind=='b':dtype=np.dtype(np.uint8)
+    datatype=gdal_array.NumericTypeCodeToGDALTypeCode(dtype.type)
+    if Env.nodata and nodata is not None:nodata=[nodata]*nbands
+    elif Env.nodata=='NAN' and dtype.kind=='f':nodata=[np.nan]*nbands
+    else:nodata=[]
+
+    if Env.tiled:windows=list(reference.__windows__())
+    else: windows=[(0, 0, reference.x_size, reference.y_size)]
+    Env.progress.start(windows,reference)
+    if Env.plan:windows=Env.plan.start('where',windows,reference)
+    sparse=Env.sparse and Env.nodata
+
+    tmpds=TemporaryDataset(reference.x_size,reference.y_size,nbands,
+                           datatype,reference.srs,reference.gt,nodata)
+    for window in windows:
+        if sparse and reference.__isempty__(*window):
+            tmpds.write_nodata(*window)
+            Env.progress.update_progress()
+            continue
+
+        cond=reference.__readblock__(*window).data
+        mask=np.ma.getmaskarray(cond)
+        cond=np.ma.getdata(cond)
+        if cond.dtype.kind=='f':mask=mask|np.isnan(cond)
+        cond=cond.astype(np.bool)
+
+        if nbands==1:shape=(window[3],window[2])
+        else:shape=(nbands,window[3],window[2])
+        #Pixels that aren't selected from either branch are NoData
+        if nodata:data=np.full(shape,nodata[0],dtype)
+        else:data=np.zeros(shape,dtype)
+        datamask=np.zeros(shape,np.bool)
+        datamask|=mask
+
+        #Only read the branches that are selected somewhere in this block
+        for branch,select in ((x,cond&~mask),(y,~cond&~mask)):
+            if not select.any() and not Env.plan:continue
+            if isinstance(branch,RasterLike):
+                values=branch.__readblock__(*window).data
+                invalid=np.ma.getmaskarray(values)
+                values=np.ma.getdata(values)
+                if values.dtype.kind=='f' and dtype.kind!='f':
+                    invalid=invalid|np.isnan(values)
+                    values=np.where(invalid,0,values)
+                np.copyto(data,values,casting='unsafe',where=select)
+                np.copyto(datamask,invalid,where=select)
+            else:
+                np.copyto(data,branch,casting='unsafe',where=select)
+
+        tmpds.write_data(np.ma.MaskedArray(data,datamask), window[0], window[1])
+        Env.progress.update_progress()
+
+    Block.clear_mask_cache()
+    try:tmpds.FlushCache() #Fails when file is in /vsimem
+    except:pass
+
+    return tmpds
+con=where #synonym
+
+@profilenode('evaluate')
+def evaluate(expressions, rasters, outfiles={}, outformat='GTIFF', options=[], reference=None):
+    ''' Evaluate multiple expressions in a single pass, reading each block of
+        each input once.
+
+        expressions is a dict or sequence of (name, expression) pairs, rasters is
+        a dict of {variable name: Dataset/Band} used in the expressions and
+        outfiles is an optional dict of {name: filepath}. The rasters are aligned
+        with the Env settings and the expressions are evaluated on the numpy
+        arrays (with the Env NoData handling) for each block, so numpy syntax
+        (numpy or np) and array methods can be used, but not Dataset methods or
+        the type conversion functions.
+
+        The rasters are aligned to the reference variable, by default the leftmost
+        variable in the first expression (as when an expression is evaluated on
+        the Datasets), so it sets the output SRS, cellsize and extent unless the
+        Env settings override them.
+
+        Outputs with a filepath are written directly to that file if the
+        outformat driver supports Create, otherwise they're copied from a
+        temporary dataset when the calculation is finished.
+
+        Returns a dict of {name: Dataset}
+    '''
+    try:expressions=expressions.items()
+    except AttributeError:expressions=list(expressions)
+    names=[name for name,expr in expressions]
+    for name in outfiles:
+        if os.path.exists(outfiles[name]) and not Env.overwrite:
+            raise RuntimeError('Output %s exists and overwrite is not set.'%outfiles[name])
+    driver=gdal.GetDriverByName(outformat)
+    if driver is None:raise RuntimeError('Unknown format: "%s"'%outformat)
+    create=driver.GetMetadataItem(gdal.DCAP_CREATE)=='YES'
+
+    #Get a reference dataset so can apply env setting to all datasets,
+    #the leftmost variable in the first expression that uses one
+    if reference is None:
+        for name,expr in expressions:
+            used=[var for var in compile(expr,'<%s>'%name,'eval').co_names if var in rasters]
+            if used:
+                reference=used[0]
+                break
+        else:reference=sorted(rasters)[0]
+    elif reference not in rasters:
+        raise ValueError('reference %s is not one of the rasters'%repr(reference))
+    variables=[reference]+sorted([var for var in rasters if var!=reference])
+    reference=rasters[reference]
+    for var in variables[1:]:
+        reference,raster=reference.apply_environment(rasters[var])
+    rasters=dict([(var,reference.apply_environment(rasters[var])[1]) for var in variables])
+
+    if Env.tiled:windows=list(reference.__windows__())
+    else: windows=[(0, 0, reference.x_size, reference.y_size)]
+    Env.progress.start(windows,reference)
+    if Env.plan:windows=Env.plan.start('evaluate',windows,reference)
+
+    outputs={}
+    for window in windows:
+        namespace={'numpy':np,'np':np}
+        for var in variables:namespace[var]=rasters[var].__readblock__(*window).data
+
+        for name,expr in expressions:
+            data=eval(expr,namespace)
+
+            #Sanity check - returns array of same dimensions as block
+            if np.ndim(data) not in (2,3) or np.shape(data)[-2:]!=(window[3],window[2]):
+                raise RuntimeError('"%s" returned an array of shape %s, expected %s'%(
+                                   expr,repr(np.shape(data)),repr((window[3],window[2]))))
+
+            if Env.nodata=='NAN' and data.dtype.kind not in 'fc':
+                operands=[namespace[var] for var in variables if np.shape(namespace[var])==data.shape]
+                data=reference.__nanmask__(data,*operands)
+            data=reference.__dtypepolicy__(data,*[namespace[var] for var in variables])
+            #GDAL casts unknown types to Float64... bools don't need to be that big
+            boolean=data.dtype==np.bool
+            if boolean:data=data.astype(np.uint8)
+
+            if name not in outputs:
+                datatype=gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype.type)
+                if datatype is None:raise RuntimeError('Unsupported datatype: "%s"'%data.dtype)
+                if data.ndim==2:nbands=1
+                else:nbands=data.shape[0]
+                nodata=[]
+                if Env.nodata and reference.nodata[0] is not None:
+                    nodata=[reference.nodata[0]]*nbands
+                elif Env.nodata=='NAN' and data.dtype.kind=='f':
+                    nodata=[np.nan]*nbands
+
+                nbits=reference.__nbits__(boolean,nodata)
+                if name in outfiles and create and not Env.plan:
+                    opts=list(options)
+                    if nbits and outformat.upper()=='GTIFF':opts.append('NBITS=%s'%nbits)
+                    outputs[name]=NewDataset(outfiles[name],outformat,
+                                             reference.x_size,reference.y_size,nbands,
+                                             datatype,reference.srs,reference.gt,nodata,opts)
+                else:
+                    outputs[name]=TemporaryDataset(reference.x_size,reference.y_size,nbands,
+                                                   datatype,reference.srs,reference.gt,nodata,nbits)
+
+            outputs[name].write_data(data, window[0], window[1])
+        Env.progress.update_progress()
+
+    Block.clear_mask_cache()
+    for name in names:
+        try:outputs[name].FlushCache() #Fails when file is in /vsimem
+        except:pass
+        if Env.plan:
+            if name in outfiles:Env.plan.output(outfiles[name],outputs[name],not create)
+        elif name in outfiles and not create:
+            outputs[name]=outputs[name].create_copy(outfiles[name],outformat,options)
+        elif name in outfiles:
+            outputs[name]=None #Close it so it's written
+            outputs[name]=Dataset(outfiles[name],preview=False)
+            if Env.heatmap:Env.heatmapper.save(heatmap_path(outfiles[name]))
+
+    return outputs
+
+def explain(expression, rasters={}, outfile=None):
+    ''' Plan a calculation without running it and return the Plan. Print it to
+        see which rasters are reprojected, resampled, aligned, clipped or cast,
+        the output grid, the windows of each pass, the temporaries and the
+        estimated bytes read and written.
+
+        expression is a string evaluated with the rasters dict of
+        {variable name: Dataset/Band} (and numpy, np and the gdal_calculations
+        functions), a callable that takes no arguments (i.e. lambda:ds1+ds2)
+        or a dict or sequence of (name, expression) pairs to plan evaluate().
+        outfile is an optional output filepath (or dict of {name: filepath}
+        for evaluate) to plan saving the result to.
+
+        Only the metadata and a single pixel of each raster are read in each
+        pass (to get the output datatypes), VRTs are built as usual and
+        temporary datasets are sparse /vsimem GTiffs that are never filled.
+    '''
+    plan=Plan()
+    for name in sorted(rasters):plan.input(name,rasters[name])
+
+    Env.plan=plan
+    try:
+        if isinstance(expression,basestring):
+            import gdal_calculations
+            namespace=dict([(n,getattr(gdal_calculations,n)) for n in gdal_calculations.__all__])
+            namespace.update({'numpy':np,'np':np})
+            namespace.update(rasters)
+            results=[eval(expression,namespace)]
+        elif callable(expression):
+            results=[expression()]
+        else:
+            #evaluate plans the outputs with a filepath
+            outfiles=outfile or {}
+            results=[r for n,r in evaluate(expression,rasters,outfiles).items() if n not in outfiles]
+            outfile=None
+
+        for result in results:
+            if not isinstance(result,RasterLike):continue
+            if outfile is None:plan.result(result)
+            else:plan.output(outfile,result)
+    finally:
+        Env.plan=None
+        Block.clear_mask_cache()
+
+    return plan
+
+def nodata_fits(nodata,dtype):
+    ''' Can a NoData value be represented in a numpy datatype'''
+    dtype=np.dtype(dtype)
+    try:nodata=float(nodata)
+    except (TypeError,ValueError):return False
+    if dtype.kind=='b':return nodata in (0,1)
+    if dtype.kind in 'iu':
+        if np.isnan(nodata) or nodata!=int(nodata):return False
+        info=np.iinfo(dtype)
+        return info.min<=nodata<=info.max
+    if dtype.kind=='f':
+        return np.isnan(nodata) or np.isinf(nodata) or abs(nodata)<=np.finfo(dtype).max
+    return True
+
 @contextmanager
 def WriteableNamedTemporaryFile(*args, **kwargs):
     with tempfile.NamedTemporaryFile(delete=False, *args, **kwargs) as f:
@@ -0,0 +1,243 @@
+# -*- coding: UTF-8 -*-
+'''
+Name: planning.py
+Purpose: Record the execution plan of a calculation without running it
+
+Author: Luke Pinner
+'''
+# Copyright: (c) Luke Pinner 2013
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#-------------------------------------------------------------------------------
+__all__ = [ "Plan" ]
+
+import math
+from osgeo import gdal, osr
+
+from environment import Env
+from profiling import describe
+
+class Plan(object):
+    ''' The execution plan of a calculation recorded by explain().
+
+        While Env.plan is set, each pass (operation, ndarray method call or
+        function) records its windows and processes a single 1x1 pixel window
+        instead, so only the metadata and apply_environment planning (VRTs) and
+        the output datatypes are worked out. TemporaryDatasets are sparse
+        GTiffs in /vsimem that are never filled.
+
+        The steps are the VRTs (reproject, resample, align, clip, cast), the passes
+        with their windows and estimated bytes read (the bytes per pixel of each
+        dataset read x the pixels in the pass) and written (the uncompressed size
+        of the temporary) and the outputs.
+    '''
+    def __init__(self):
+        self.inputs=[]
+        self.steps=[]
+        self.outputs=[]
+        self._pass=None
+        self._temporaries={} #{filename:label}
+
+    def input(self,name,raster):
+        '''Add an input Dataset/Band'''
+        info=grid(raster)
+        info['name']=name
+        info['path']=describe(raster)
+        self.inputs.append(info)
+
+    def start(self,name,windows,raster):
+        '''Start a pass over a list of (x_off,y_off,x_size,y_size) windows of a
+           Dataset/Band and get the window to plan it with'''
+        self._pass={'step':'pass','name':name,'windows':len(windows),
+                    'window_size':tuple(windows[0][2:]) if windows else (0,0),
+                    'pixels':sum([w[2]*w[3] for w in windows]),
+                    'grid':grid(raster),'read':[],'written':[]}
+        self.steps.append(self._pass)
+        return [(0,0,1,1)]
+
+    def read(self,dataset_or_band,data):
+        '''Add the bytes per pixel of a block read in the current pass'''
+        if self._pass is None:return
+        label=self.__label__(dataset_or_band)
+        bpp=data.nbytes/float(max(data.shape[-1]*data.shape[-2],1))
+        read=self._pass['read']
+        for i,(l,n) in enumerate(read):
+            if l==label:
+                read[i]=(l,n+bpp)
+                return
+        read.append((label,bpp))
+
+    def temporary(self,dataset,nbits=None):
+        '''Add a TemporaryDataset written by the current pass'''
+        label='temporary %s'%(len(self._temporaries)+1)
+        self._temporaries[dataset._filename]=label
+        if self._pass is not None:
+            self._pass['written'].append((label,rastersize(dataset,nbits)))
+
+    def vrt(self,dataset,snap_ds=None):
+        '''Add a Warped/Clipped/ConvertedDataset'''
+        parent=dataset._parentds
+        before,after=grid(parent),grid(dataset)
+        changes=[]
+        if not osr.SpatialReference(before['srs']).IsSame(osr.SpatialReference(after['srs'])):
+            changes.append('reproject %s -> %s'%(srsname(before['srs']),srsname(after['srs'])))
+        if before['cellsize']!=after['cellsize']:
+            changes.append('resample %s x %s -> %s x %s (%s)'%(before['cellsize']+after['cellsize']+(resampling(),)))
+        if snap_ds is not None and snap_ds is not parent:
+            changes.append('align to %s'%self.__label__(snap_ds))
+        if before['extent']!=after['extent']:
+            changes.append('clip [%s] -> [%s]'%(', '.join(['%.6g'%e for e in before['extent']]),
+                                                ', '.join(['%.6g'%e for e in after['extent']])))
+            if Env.snap and type(dataset).__name__=='ClippedDataset':
+                changes.append('snap to %s'%self.__label__(Env.snap))
+        if before['datatype']!=after['datatype']:
+            changes.append('cast %s -> %s'%(before['datatype'],after['datatype']))
+        if not changes:changes.append('%s x %s'%(after['x_size'],after['y_size']))
+        self.steps.append({'step':type(dataset).__name__,'dataset':self.__label__(parent),
+                           'changes':changes})
+
+    def output(self,path,dataset,copy=True):
+        '''Add an output, copied from a temporary or (copy=False) written directly'''
+        label=self.__label__(dataset)
+        size=rastersize(dataset)
+        if copy:
+            self.steps.append({'step':'output','path':path,'read':[(label,size)],'written':[(path,size)]})
+        else:
+            for step in self.steps:
+                if step['step']!='pass':continue
+                step['written']=[(path if l==label else l,n) for l,n in step['written']]
+            del self._temporaries[dataset._filename]
+        info=grid(dataset)
+        info['path']=path
+        self.outputs.append(info)
+
+    def result(self,raster):
+        '''Add a result of the calculation that isn't saved as an output'''
+        info=grid(raster)
+        info['path']=self.__label__(raster)
+        self.outputs.append(info)
+
+    def summary(self):
+        '''Get the plan as a dict of {'inputs':[...],'steps':[...],'outputs':[...],
+           'passes':n,'windows':n,'temporaries':n,'temporary_bytes':n,
+           'bytes_read':n,'bytes_written':n}'''
+        steps=[]
+        read=written=temporary_bytes=windows=0
+        for step in self.steps:
+            step=dict(step)
+            if step['step']=='pass':
+                step['read']=[(l,int(bpp*step['pixels'])) for l,bpp in step['read']]
+                windows+=step['windows']
+                temporaries=self._temporaries.values()
+                temporary_bytes+=sum([n for l,n in step['written'] if l in temporaries])
+            if 'read' in step:read+=sum([n for l,n in step['read']])
+            if 'written' in step:written+=sum([n for l,n in step['written']])
+            steps.append(step)
+        return {'inputs':self.inputs,'steps':steps,'outputs':self.outputs,
+                'passes':len([s for s in steps if s['step']=='pass']),'windows':windows,
+                'temporaries':len(self._temporaries),'temporary_bytes':temporary_bytes,
+                'bytes_read':read,'bytes_written':written}
+
+    def table(self):
+        '''Format the plan as text'''
+        summary=self.summary()
+        lines=['Inputs']
+        for info in summary['inputs']:
+            name=info['name'] and '%s: '%info['name'] or ''
+            lines.append('  %s%s'%(name,info['path']))
+            lines.append('      %s'%describegrid(info))
+        lines.append('')
+        lines.append('Plan')
+        for i,step in enumerate(summary['steps']):
+            if step['step']=='pass':
+                lines.append('  %2d. %s: %s windows of %s x %s'%(
+                             i+1,step['name'],step['windows'],step['window_size'][0],step['window_size'][1]))
+                lines.append('      %s'%describegrid(step['grid']))
+                for label,n in step['read']:
+                    lines.append('      read %s from %s'%(mbytes(n),label))
+                for label,n in step['written']:
+                    lines.append('      write %s to %s'%(mbytes(n),label))
+            elif step['step']=='output':
+                lines.append('  %2d. copy to %s'%(i+1,step['path']))
+                for label,n in step['read']:
+                    lines.append('      read %s from %s'%(mbytes(n),label))
+                for label,n in step['written']:
+                    lines.append('      write %s'%mbytes(n))
+            else:
+                lines.append('  %2d. %s of %s'%(i+1,step['step'],step['dataset']))
+                for change in step['changes']:lines.append('      %s'%change)
+        lines.append('')
+        lines.append('Output')
+        for info in summary['outputs']:
+            lines.append('  %s'%info['path'])
+            lines.append('      %s'%describegrid(info))
+        lines.append('')
+        lines.append('Estimated totals')
+        lines.append('  %s passes, %s windows'%(summary['passes'],summary['windows']))
+        lines.append('  %s temporaries, %s'%(summary['temporaries'],mbytes(summary['temporary_bytes'])))
+        lines.append('  %s read, %s written'%(mbytes(summary['bytes_read']),mbytes(summary['bytes_written'])))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.table()
+
+    def __label__(self,dataset):
+        path=describe(dataset)
+        return self._temporaries.get(path,path)
+
+def grid(raster):
+    '''Get the grid of a Dataset/Band as a dict'''
+    return {'x_size':raster.x_size,'y_size':raster.y_size,'nbands':raster.nbands,
+            'datatype':gdal.GetDataTypeName(raster.data_type),
+            'cellsize':(raster.gt[1],abs(raster.gt[5])),'extent':list(raster.extent),
+            'srs':raster.srs,'block_size':tuple(raster.block_size)}
+
+def describegrid(info):
+    '''Format a grid dict'''
+    return '%s x %s x %s %s, cellsize %.6g x %.6g, block %s x %s, %s'%(
+            info['x_size'],info['y_size'],info['nbands'],info['datatype'],
+            info['cellsize'][0],info['cellsize'][1],info['block_size'][0],info['block_size'][1],
+            srsname(info['srs']))
+
+def rastersize(raster,nbits=None):
+    '''Get the uncompressed size of a Dataset/Band in bytes'''
+    if nbits is None:nbits=gdal.GetDataTypeSize(raster.data_type)
+    return int(math.ceil(raster.x_size*nbits/8.0))*raster.y_size*raster.nbands
+
+def srsname(wkt):
+    '''Get a short name for a WKT coordinate system'''
+    if not wkt:return 'no coordinate system'
+    srs=osr.SpatialReference(wkt)
+    name=srs.GetAttrValue('PROJCS') or srs.GetAttrValue('GEOGCS') or 'unknown coordinate system'
+    node=srs.IsProjected() and 'PROJCS' or 'GEOGCS'
+    if srs.GetAuthorityName(node)=='EPSG':name='%s (EPSG:%s)'%(name,srs.GetAuthorityCode(node))
+    return name
+
+def resampling():
+    '''Get the name of the Env.resampling method'''
+    for name in dir(gdal):
+        if name.startswith('GRA_') and getattr(gdal,name)==Env.resampling:return name[4:].upper()
+    return str(Env.resampling)
+
+def mbytes(n):
+    return '%.1f MB'%(n/2.0**20)
+
+Env.plan=None
@@ -0,0 +1,581 @@
+# -*- coding: UTF-8 -*-
+'''
+Name: profiling.py
+Purpose: Time the read/compute/write/VRT phases of calculations,
+         track their peak memory use, trace their timeline and
+         map the cost of each processing window
+
+Author: Luke Pinner
+'''
+# Copyright: (c) Luke Pinner 2013
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#-------------------------------------------------------------------------------
+__all__ = [ "Profiler", "Tracer", "Heatmapper", "IOCounter" ]
+
+import os, json, math, threading, weakref
+from collections import OrderedDict
+from functools import wraps
+from timeit import default_timer as timer
+
+import numpy as np
+from osgeo import gdal, osr
+
+from environment import Env
+
+PHASES=('read','compute','write','vrt','create_copy')
+MEMORY=('buffer_bytes','cache_bytes','vsimem_bytes','temporary_datasets','temporary_bytes')
+
+class Profiler(object):
+    ''' Accumulate the time spent in each phase of a calculation
+        per operator node and per input dataset when Env.profile is set.
+
+        Each operation, ndarray method call or function (map_blocks, where, etc.)
+        is a node. The "compute" time of a node is the time not spent reading
+        blocks, writing blocks, building VRTs, copying or in other nodes.
+
+        The peak memory use is also tracked:
+            buffer_bytes       - numpy block buffers read and written for a window
+            cache_bytes        - GDAL block cache (gdal.GetCacheUsed)
+            vsimem_bytes       - files in /vsimem
+            temporary_datasets - number of live TemporaryDatasets
+            temporary_bytes    - size of the live TemporaryDataset files
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._nodes={}
+        self._datasets={}
+        self._order=[]
+        self._stack=[] #[name, start time, time accounted for by phases and child nodes]
+        self._inphase=False
+        self._count=0
+        self._peaks=dict([(k,0) for k in MEMORY])
+        self._window=None
+        self._buffer=0
+        self._temporary=weakref.WeakValueDictionary()
+
+    def begin(self,name):
+        '''Start timing a node'''
+        self._count+=1
+        name='%s #%s'%(name,self._count)
+        self._order.append(name)
+        self._stack.append([name,timer(),0.0])
+
+    def end(self):
+        '''Stop timing the current node'''
+        name,start,accounted=self._stack.pop()
+        total=timer()-start
+        self.__record__(self._nodes,name,'compute',total-accounted)
+        self.__record__(self._nodes,name,'total',total)
+        if self._stack:self._stack[-1][2]+=total
+        self.__sampletemporary__()
+
+    def add(self,phase,seconds,dataset=None):
+        '''Add the time spent in a phase to the current node and, optionally,
+           a Dataset/Band. Phases outside a node are recorded under the phase name'''
+        if self._stack:
+            self._stack[-1][2]+=seconds
+            name=self._stack[-1][0]
+        else:
+            name=phase
+            if name not in self._order:self._order.append(name)
+        self.__record__(self._nodes,name,phase,seconds)
+        if dataset is not None:
+            self.__record__(self._datasets,describe(dataset),phase,seconds)
+
+    def buffer(self,window,data):
+        '''Add the bytes of a numpy array read or written for a (x_off,y_off,x_size,y_size)
+           window, buffers are summed until a different window is read or written'''
+        if window!=self._window:
+            self._window=window
+            self._buffer=0
+            self.__peak__('cache_bytes',gdal.GetCacheUsed())
+        self._buffer+=nbytes(data)
+        self.__peak__('buffer_bytes',self._buffer)
+
+    def temporary(self,dataset):
+        '''Track a live TemporaryDataset'''
+        self._temporary[dataset._filename]=dataset
+        self.__sampletemporary__()
+
+    def memory(self):
+        '''Get the peak memory use as a dict of {'buffer_bytes':n,...} as well as the
+           current GDAL cache maximum and the current number and size of the live
+           TemporaryDatasets'''
+        memory=dict(self._peaks)
+        names=list(self._temporary.keys())
+        memory['cache_max']=gdal.GetCacheMax()
+        memory['live_temporary_datasets']=len(names)
+        memory['live_temporary_bytes']=sum([filesize(n) for n in names])
+        return memory
+
+    def summary(self):
+        '''Get the timings as a dict of {'nodes':{node:{phase:{'calls':n,'seconds':s}}},
+                                         'datasets':{dataset:{phase:{...}}},
+                                         'memory':{...}}'''
+        summary={'nodes':{},'datasets':{},'memory':self.memory()}
+        for key,timings in (('nodes',self._nodes),('datasets',self._datasets)):
+            for name in timings:
+                summary[key][name]={}
+                for phase,(calls,seconds) in timings[name].items():
+                    summary[key][name][phase]={'calls':calls,'seconds':seconds}
+        return summary
+
+    def table(self):
+        '''Format the timings as a text table'''
+        lines=[]
+        row='%-40s %-12s %8s %10s'
+        for title,timings,names in (('Node',self._nodes,self._order),
+                                    ('Dataset',self._datasets,sorted(self._datasets))):
+            if not timings:continue
+            lines.append(row%(title,'Phase','Calls','Seconds'))
+            lines.append(row%('-'*40,'-'*12,'-'*8,'-'*10))
+            for name in names:
+                if name not in timings:continue
+                phases=[p for p in PHASES+('total',) if p in timings[name]]
+                for i,phase in enumerate(phases):
+                    calls,seconds=timings[name][phase]
+                    if i:label=''
+                    else:label=name[-40:]
+                    lines.append('%-40s %-12s %8d %10.4f'%(label,phase,calls,seconds))
+            lines.append('')
+        memory=self.memory()
+        lines.append('%-40s %21s'%('Memory','Peak'))
+        lines.append('%-40s %21s'%('-'*40,'-'*21))
+        for key in MEMORY:
+            if key=='temporary_datasets':lines.append('%-40s %21d'%(key,memory[key]))
+            else:lines.append('%-40s %18.1f MB'%(key,memory[key]/2.0**20))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.table()
+
+    def __peak__(self,key,value):
+        if value>self._peaks[key]:self._peaks[key]=value
+
+    def __sampletemporary__(self):
+        names=list(self._temporary.keys())
+        self.__peak__('temporary_datasets',len(names))
+        self.__peak__('temporary_bytes',sum([filesize(n) for n in names]))
+        try:vsimem=['/vsimem/%s'%n for n in gdal.ReadDir('/vsimem') or []]
+        except Exception:vsimem=[n for n in names if n.startswith('/vsimem')]
+        self.__peak__('vsimem_bytes',sum([filesize(n) for n in vsimem]))
+
+    def __record__(self,timings,name,phase,seconds):
+        phases=timings.setdefault(name,{})
+        calls,total=phases.get(phase,(0,0.0))
+        phases[phase]=(calls+1,total+seconds)
+
+class Tracer(object):
+    ''' Record begin/end events of block reads and writes, VRT construction (warps,
+        clips, conversions), create_copy and operations/method/function calls
+        when Env.trace is set.
+
+        The events are in the Chrome trace event format with process and thread
+        ids, dump them to a JSON file to view them in chrome://tracing or Perfetto.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.events=[]
+        self._start=timer()
+
+    def begin(self,name,category,args=None):
+        self.__event__('B',name,category,args)
+
+    def end(self,name,category):
+        self.__event__('E',name,category)
+
+    def dump(self,path):
+        '''Write the events to a JSON trace file'''
+        f=open(path,'w')
+        try:json.dump({'traceEvents':self.events,'displayTimeUnit':'ms'},f)
+        finally:f.close()
+
+    def __event__(self,ph,name,category,args=None):
+        event={'name':name,'cat':category,'ph':ph,
+               'ts':(timer()-self._start)*1e6, #microseconds
+               'pid':os.getpid(),'tid':threading.current_thread().ident}
+        if args:event['args']=args
+        self.events.append(event)
+
+class Heatmapper(object):
+    ''' Record the time spent and bytes read for each processing window when
+        Env.heatmap is set and save them as a georeferenced raster with one pixel
+        per window.
+
+        The grid is the windows of the first operation/method/function call after
+        a reset, the windows of later calls are added to the pixel their centre falls in.
+        The time of a window is from the end of the previous window (or the start of
+        the call) so includes reading, calculating and writing it.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seconds=None
+        self.nbytes=None
+        self._gt=None      #Heatmap geotransform
+        self._srs=''
+        self._window=None  #Geotransform and windows of the current call
+        self._index=0
+        self._bytes=0
+        self._last=None
+
+    def start(self,windows,raster=None):
+        '''Start a call with a list of (x_off,y_off,x_size,y_size) windows of a Dataset/Band'''
+        self._index=0
+        self._bytes=0
+        self._last=timer()
+        if raster is None or not windows:
+            self._window=None
+            return
+        self._window=(raster.gt,windows)
+        if self._gt is None:
+            gt,(x,y,xsize,ysize)=raster.gt,windows[0]
+            self._gt=[gt[0],gt[1]*xsize,0,gt[3],0,gt[5]*ysize]
+            self._srs=raster.srs
+            shape=(int(math.ceil(raster.y_size/float(ysize))),int(math.ceil(raster.x_size/float(xsize))))
+            self.seconds=np.zeros(shape,np.float64)
+            self.nbytes=np.zeros(shape,np.float64)
+
+    def update_bytes(self,nbytes):
+        '''Add the bytes read for the current window'''
+        self._bytes+=nbytes
+
+    def update(self):
+        '''Record the current window after it's processed'''
+        now=timer()
+        if self._window is not None and self._index<len(self._window[1]):
+            gt,windows=self._window
+            x,y,xsize,ysize=windows[self._index]
+            px,py=x+xsize/2.0,y+ysize/2.0
+            mx=gt[0]+px*gt[1]+py*gt[2]
+            my=gt[3]+px*gt[4]+py*gt[5]
+            col=int(math.floor((mx-self._gt[0])/self._gt[1]))
+            row=int(math.floor((my-self._gt[3])/self._gt[5]))
+            if 0<=row<self.seconds.shape[0] and 0<=col<self.seconds.shape[1]:
+                self.seconds[row,col]+=now-self._last
+                self.nbytes[row,col]+=self._bytes
+        self._index+=1
+        self._bytes=0
+        self._last=now
+
+    def save(self,path,outformat='GTIFF'):
+        '''Save a raster with the seconds (band 1) and bytes read (band 2) of each window'''
+        if self.seconds is None:raise RuntimeError('No windows have been processed with Env.heatmap set')
+        rows,cols=self.seconds.shape
+        driver=gdal.GetDriverByName(outformat)
+        ds=driver.Create(path,cols,rows,2,gdal.GDT_Float64)
+        ds.SetGeoTransform(self._gt)
+        ds.SetProjection(self._srs)
+        for i,(name,data) in enumerate((('seconds',self.seconds),('bytes',self.nbytes))):
+            band=ds.GetRasterBand(i+1)
+            band.SetDescription(name)
+            band.WriteArray(data)
+        ds=None
+
+class IOCounter(object):
+    ''' Count the reads of each Dataset/Band, including Clipped/Converted/Warped
+        views, and of the source rasters they read from when Env.iocount is set.
+
+        Each view counts its ReadAsArray calls and the pixels and bytes requested
+        and each new or temporary dataset the pixels and bytes written to it.
+        Each source also counts the source blocks the requests touch, mapped
+        through the extent (and coordinate system) of the view. The GDAL block
+        cache hits and misses are estimated with a least recently used cache
+        of the blocks the size of gdal.GetCacheMax(), the bytes decoded are the
+        bytes of the missed blocks. A source that is decoded more than once
+        (redundancy > 1) is being re-read, i.e. by windows that aren't aligned
+        with its blocks or by the same raster wrapped in several VRTs.
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._views={}   #{label:{'views':set of ids,'calls':n,'pixels':n,'bytes':n}}
+        self._sources={} #{path:{'calls':n,...}}
+        self._written={} #{path:{'calls':n,'pixels':n,'bytes':n}}
+        self._order=[]
+        self._cache=OrderedDict() #{(path,band,xblock,yblock):nbytes}
+        self._cached=0
+        self._transforms={}
+
+    def read(self,dataset_or_band,window,data):
+        '''Count a (x_off,y_off,x_size,y_size) window read from a Dataset/Band'''
+        pixels=window[2]*window[3]
+        label=viewname(dataset_or_band)
+        view=self._views.setdefault(label,{'views':set(),'calls':0,'pixels':0,'bytes':0})
+        view['views'].add(id(dataset_or_band))
+        view['calls']+=1
+        view['pixels']+=pixels
+        view['bytes']+=data.nbytes
+
+        ds,bands=source(dataset_or_band)
+        path=ds._dataset.GetDescription()
+        if path not in self._sources:
+            self._order.append(path)
+            self._sources[path]={'calls':0,'pixels':0,'bytes':0,'blocks':0,'unique_blocks':set(),
+                                 'hits':0,'misses':0,'bytes_decoded':0,'size':0}
+        src=self._sources[path]
+        src['calls']+=1
+        src['pixels']+=pixels
+        src['bytes']+=data.nbytes
+
+        xblock,yblock=ds.block_size
+        itemsize=gdal.GetDataTypeSize(ds.data_type)//8
+        src['size']=max(src['size'],ds.x_size*ds.y_size*len(bands)*itemsize)
+        x0,y0,x1,y1=self.__sourcewindow__(dataset_or_band,ds,window)
+        for band in bands:
+            for yb in xrange(y0//yblock,(y1+yblock-1)//yblock):
+                for xb in xrange(x0//xblock,(x1+xblock-1)//xblock):
+                    #Blocks on the right and bottom edges are partial
+                    blockbytes=(min(xblock,ds.x_size-xb*xblock)*
+                                min(yblock,ds.y_size-yb*yblock)*itemsize)
+                    key=(path,band,xb,yb)
+                    src['blocks']+=1
+                    src['unique_blocks'].add(key[1:])
+                    if key in self._cache:
+                        src['hits']+=1
+                        self._cache[key]=self._cache.pop(key) #Most recently used
+                    else:
+                        src['misses']+=1
+                        src['bytes_decoded']+=blockbytes
+                        self.__cache__(key,blockbytes)
+
+    def write(self,dataset,data):
+        '''Count a window written to a NewDataset/TemporaryDataset'''
+        path=dataset._dataset.GetDescription()
+        written=self._written.setdefault(path,{'calls':0,'pixels':0,'bytes':0})
+        written['calls']+=1
+        written['pixels']+=data.shape[-1]*data.shape[-2]
+        written['bytes']+=data.nbytes
+
+    def summary(self):
+        '''Get the counts as a dict of {'sources':{path:{'calls':n,'pixels':n,'bytes':n,
+           'blocks':n,'unique_blocks':n,'hits':n,'misses':n,'hit_ratio':r,'bytes_decoded':n,
+           'size':n,'redundancy':r}}, 'views':{view:{'views':n,'calls':n,'pixels':n,'bytes':n}},
+           'written':{path:{'calls':n,'pixels':n,'bytes':n}}}'''
+        summary={'sources':{},'views':{},'written':{}}
+        for path,src in self._sources.items():
+            src=dict(src)
+            src['unique_blocks']=len(src['unique_blocks'])
+            if src['blocks']:src['hit_ratio']=src['hits']/float(src['blocks'])
+            else:src['hit_ratio']=0.0
+            if src['size']:src['redundancy']=src['bytes_decoded']/float(src['size'])
+            else:src['redundancy']=0.0
+            summary['sources'][path]=src
+        for label,view in self._views.items():
+            view=dict(view)
+            view['views']=len(view['views'])
+            summary['views'][label]=view
+        for path,written in self._written.items():
+            summary['written'][path]=dict(written)
+        return summary
+
+    def table(self):
+        '''Format the counts as a text table'''
+        summary=self.summary()
+        lines=[]
+        row='%-40s %6s %8s %9s %9s %8s %8s %6s %9s %6s'
+        lines.append(row%('Source','Calls','Mpixels','MB req.','Blocks','Unique','Misses','Hit %','MB dec.','Redun.'))
+        lines.append(row%('-'*40,'-'*6,'-'*8,'-'*9,'-'*9,'-'*8,'-'*8,'-'*6,'-'*9,'-'*6))
+        for path in self._order:
+            s=summary['sources'][path]
+            lines.append('%-40s %6d %8.2f %9.1f %9d %8d %8d %6.1f %9.1f %6.2f'%(
+                         path[-40:],s['calls'],s['pixels']/1e6,s['bytes']/2.0**20,s['blocks'],
+                         s['unique_blocks'],s['misses'],s['hit_ratio']*100,
+                         s['bytes_decoded']/2.0**20,s['redundancy']))
+        lines.append('')
+        row='%-60s %6s %6s %8s %9s'
+        lines.append(row%('View','Views','Calls','Mpixels','MB req.'))
+        lines.append(row%('-'*60,'-'*6,'-'*6,'-'*8,'-'*9))
+        for label in sorted(summary['views']):
+            v=summary['views'][label]
+            lines.append('%-60s %6d %6d %8.2f %9.1f'%(label[-60:],v['views'],v['calls'],
+                                                     v['pixels']/1e6,v['bytes']/2.0**20))
+        lines.append('')
+        if summary['written']:
+            row='%-60s %6s %8s %9s'
+            lines.append(row%('Written','Calls','Mpixels','MB'))
+            lines.append(row%('-'*60,'-'*6,'-'*8,'-'*9))
+            for path in sorted(summary['written']):
+                w=summary['written'][path]
+                lines.append('%-60s %6d %8.2f %9.1f'%(path[-60:],w['calls'],w['pixels']/1e6,w['bytes']/2.0**20))
+            lines.append('')
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.table()
+
+    def __cache__(self,key,nbytes):
+        self._cache[key]=nbytes
+        self._cached+=nbytes
+        cachemax=gdal.GetCacheMax()
+        while self._cached>cachemax and len(self._cache)>1:
+            oldest,n=self._cache.popitem(last=False)
+            self._cached-=n
+
+    def __sourcewindow__(self,view,ds,window):
+        '''Map a window of a view to a (x0,y0,x1,y1) window of its source Dataset'''
+        x_off,y_off,x_size,y_size=window
+        if view is ds:return x_off,y_off,x_off+x_size,y_off+y_size
+        gt=view.gt
+        xs=[gt[0]+x*gt[1] for x in (x_off,x_off+x_size)]
+        ys=[gt[3]+y*gt[5] for y in (y_off,y_off+y_size)]
+        points=[(x,y) for x in xs for y in ys]
+        if view.srs and ds.srs and view.srs!=ds.srs:
+            transform=self.__transform__(view.srs,ds.srs)
+            if transform is not None:points=[transform.TransformPoint(x,y)[:2] for x,y in points]
+        sgt=ds.gt
+        cols=[(x-sgt[0])/sgt[1] for x,y in points]
+        rows=[(y-sgt[3])/sgt[5] for x,y in points]
+        x0=min(max(int(math.floor(min(cols))),0),ds.x_size)
+        y0=min(max(int(math.floor(min(rows))),0),ds.y_size)
+        x1=min(max(int(math.ceil(max(cols))),0),ds.x_size)
+        y1=min(max(int(math.ceil(max(rows))),0),ds.y_size)
+        return x0,y0,x1,y1
+
+    def __transform__(self,src,dst):
+        try:return self._transforms[(src,dst)]
+        except KeyError:pass
+        srcsrs,dstsrs=osr.SpatialReference(src),osr.SpatialReference(dst)
+        for srs in (srcsrs,dstsrs):
+            try:srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER) #GDAL >= 3
+            except AttributeError:pass
+        if srcsrs.IsSame(dstsrs):transform=None
+        else:transform=osr.CoordinateTransformation(srcsrs,dstsrs)
+        self._transforms[(src,dst)]=transform
+        return transform
+
+def heatmap_path(path):
+    '''Get the path of the heatmap GTiff saved alongside an output, i.e. out.img -> out_heatmap.tif'''
+    return '%s_heatmap.tif'%os.path.splitext(path)[0]
+
+def describe(dataset):
+    '''Get the path of the source file of a Dataset/Band, following
+       Clipped/Converted/Warped Datasets back to the Dataset they were created from'''
+    while hasattr(dataset,'_parentds'):dataset=dataset._parentds
+    try:dataset=dataset.dataset #Is it a Band
+    except AttributeError:pass
+    try:return dataset._dataset.GetDescription()
+    except AttributeError:return repr(dataset)
+
+def source(dataset_or_band):
+    '''Get the Dataset a Dataset/Band reads from, following Clipped/Converted/Warped
+       Datasets and Bands back to the Dataset they were created from, and the
+       (zero based) bands read from it'''
+    dataset,bands=dataset_or_band,None
+    while True:
+        if hasattr(dataset,'_parentds'):dataset=dataset._parentds
+        elif hasattr(dataset,'band'): #Band, map the band indexes to its Dataset's
+            if bands is None:bands=list(dataset.bands)
+            else:bands=[dataset.bands[i] for i in bands]
+            dataset=dataset.dataset
+        else:break
+    if bands is None:bands=list(dataset.bands)
+    return dataset,bands
+
+def viewname(dataset_or_band):
+    '''Describe a Dataset/Band and the views it's derived from,
+       i.e. ClippedDataset(WarpedDataset(/path/to/source.tif[0]))'''
+    dataset,chain=dataset_or_band,[]
+    while True:
+        if hasattr(dataset,'_parentds'):
+            chain.append('%s(%%s)'%type(dataset).__name__)
+            dataset=dataset._parentds
+        elif hasattr(dataset,'band'): #Band
+            chain.append('%%s[%s]'%dataset.bands[0])
+            dataset=dataset.dataset
+        else:break
+    label=dataset._dataset.GetDescription()
+    for view in reversed(chain):label=view%label
+    return label
+
+def nbytes(data):
+    '''Get the bytes of an array and, if it's a MaskedArray, its mask'''
+    mask=np.ma.getmask(data)
+    if mask is np.ma.nomask:return data.nbytes
+    else:return data.nbytes+mask.nbytes
+
+def filesize(path):
+    '''Get the size of a file in bytes, including /vsimem files'''
+    try:
+        if path.startswith('/vsi'):return gdal.VSIStatL(path).size
+        else:return os.path.getsize(path)
+    except Exception:return 0
+
+def profiled(phase,dataset=None,window=None):
+    '''Decorator to time (Env.profile) and trace (Env.trace) calls to a function as a phase.
+       dataset is the index of a positional Dataset/Band argument to also
+       aggregate the time by and window the index of the x_off,y_off(,x_size,y_size)
+       positional arguments to add to the trace. Nested phases are counted in the outer phase'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args,**kwargs):
+            profiler=Env.profiler
+            if not (Env.profile or Env.trace) or profiler._inphase:return func(*args,**kwargs)
+            if dataset is not None and len(args)>dataset:ds=args[dataset]
+            else:ds=None
+            profiler._inphase=True
+            trace=Env.trace
+            if trace:
+                name=phase
+                if phase=='vrt':name=type(args[0]).__name__ #Warped/Clipped/ConvertedDataset
+                traceargs={}
+                if ds is not None:traceargs['dataset']=describe(ds)
+                if window is not None:traceargs['window']=list(args[window:window+4])
+                Env.tracer.begin(name,phase,traceargs)
+            start=timer()
+            try:return func(*args,**kwargs)
+            finally:
+                profiler._inphase=False
+                if trace:Env.tracer.end(name,phase)
+                if Env.profile:profiler.add(phase,timer()-start,ds)
+        return wrapper
+    return decorator
+
+def profilenode(name):
+    '''Decorator to time (Env.profile) and trace (Env.trace) calls to a function as a node.
+       name is a string or a function that gets the name from the call arguments'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args,**kwargs):
+            profile,trace=Env.profile,Env.trace
+            if not (profile or trace):return func(*args,**kwargs)
+            if callable(name):label=name(*args,**kwargs)
+            else:label=name
+            if profile:Env.profiler.begin(label)
+            if trace:Env.tracer.begin(label,'operation')
+            try:return func(*args,**kwargs)
+            finally:
+                if trace:Env.tracer.end(label,'operation')
+                if profile:Env.profiler.end()
+        return wrapper
+    return decorator
+
+Env.profiler=Profiler()
+Env.tracer=Tracer()
+Env.heatmapper=Heatmapper()
+Env.iocounter=IOCounter()
@@ -0,0 +1,441 @@
+# -*- coding: UTF-8 -*-
+'''
+Name: stats.py
+Purpose: Mergeable statistics for streaming (block by block) reductions
+
+Author: Luke Pinner
+'''
+# Copyright: (c) Luke Pinner 2013
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+#-------------------------------------------------------------------------------
+__all__ = [ "Statistics", "Histogram", "QuantileSketch",
+            "ZonalStatistics", "zonal_stats" ]
+
+import numpy as np
+from environment import Env
+from profiling import profilenode
+
+def _rows(data, pooled=False, skipnan=True):
+    ''' Reshape block data to (bands, pixels) values and an invalid mask,
+        masked and (if skipnan) NaN values are invalid
+    '''
+    mask=np.ma.getmaskarray(data)
+    values=np.ma.getdata(data)
+    if pooled or values.ndim<3:rows=1
+    else:rows=values.shape[0]
+    shape=(rows,values.size//rows)
+    values,mask=values.reshape(shape),mask.reshape(shape)
+    if skipnan and values.dtype.kind in 'fc':mask=mask|np.isnan(values)
+    return values,mask
+
+class Statistics(object):
+    ''' Mergeable count, sum, min, max, mean and variance.
+
+        Blocks are added with `update` and partial results from different
+        blocks/threads can be combined with `merge`. Means and variances are
+        accumulated with the parallel (Chan et al.) form of Welford's algorithm
+        so they're numerically stable regardless of the number of blocks.
+
+        Masked (numpy.ma) values are ignored. NaN values are ignored too unless
+        skipnan is False, then they propagate to the sum/min/max/mean/var/std
+        as they do in numpy.
+
+        Integer data is summed as int64 and min/max are returned in the datatype
+        of the data (unless there are no values), like the numpy reductions.
+
+        If nbands is None, all bands are pooled and scalars are returned,
+        otherwise arrays with one value per band are returned.
+    '''
+    def __init__(self, nbands=None, skipnan=True):
+        self.nbands=nbands
+        self.skipnan=skipnan
+        n=1 if nbands is None else nbands
+        self._dtype=None
+        self._count=np.zeros(n,np.int64)
+        self._sum=np.zeros(n,np.int64)
+        self._min=np.empty(n,np.float64)
+        self._min.fill(np.inf)
+        self._max=np.empty(n,np.float64)
+        self._max.fill(-np.inf)
+        self._mean=np.zeros(n,np.float64)
+        self._m2=np.zeros(n,np.float64)
+
+    def update(self, data):
+        ''' Add a block (ndarray or MaskedArray) of data'''
+        values,mask=_rows(data,self.nbands is None,self.skipnan)
+        if values.shape[0]!=len(self._count):
+            raise ValueError('Expected %s bands, got %s'%(len(self._count),values.shape[0]))
+
+        part=Statistics(self.nbands,self.skipnan)
+        valid=~mask
+        part._count=valid.sum(axis=1).astype(np.int64)
+        if not part._count.any():return self
+        part._dtype=values.dtype
+        if values.dtype.kind in 'iub':
+            part._sum=np.where(valid,values,0).sum(axis=1,dtype=np.int64)
+            values=values.astype(np.float64)
+        else:
+            values=values.astype(np.float64)
+            part._sum=np.where(valid,values,0).sum(axis=1)
+        if values.shape[1]:
+            part._min=np.where(valid,values,np.inf).min(axis=1)
+            part._max=np.where(valid,values,-np.inf).max(axis=1)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            part._mean=np.where(part._count>0,part._sum/part._count,0)
+        part._m2=(np.where(valid,values-part._mean[:,np.newaxis],0)**2).sum(axis=1)
+        return self.merge(part)
+
+    def merge(self, other):
+        ''' Combine the partial statistics from another Statistics object'''
+        na,nb=self._count.astype(np.float64),other._count.astype(np.float64)
+        n=na+nb
+        with np.errstate(invalid='ignore',divide='ignore'):
+            delta=other._mean-self._mean
+            mean=np.where(n>0,self._mean+delta*nb/n,0)
+            m2=np.where(n>0,self._m2+other._m2+delta**2*na*nb/n,0)
+        self._mean,self._m2=mean,m2
+        self._count=self._count+other._count
+        self._sum=self._sum+other._sum
+        self._min=np.minimum(self._min,other._min)
+        self._max=np.maximum(self._max,other._max)
+        if self._dtype is None:self._dtype=other._dtype
+        elif other._dtype is not None:self._dtype=np.result_type(self._dtype,other._dtype)
+        return self
+
+    def __result__(self, values):
+        values=np.where(self._count>0,values,np.nan)
+        if self.nbands is None:return values[0]
+        else:return values
+
+    def count(self):
+        if self.nbands is None:return self._count[0]
+        else:return self._count.copy()
+
+    def sum(self):
+        if self.nbands is None:return self._sum[0]
+        else:return self._sum.copy()
+
+    def __extreme__(self, values):
+        #min/max in the datatype of the data if every band has values
+        if self._dtype is None or self._dtype.kind=='f' or not self._count.all():
+            return self.__result__(values)
+        values=values.astype(self._dtype)
+        if self.nbands is None:return values[0]
+        else:return values
+
+    def min(self):
+        return self.__extreme__(self._min)
+
+    def max(self):
+        return self.__extreme__(self._max)
+
+    def mean(self):
+        return self.__result__(self._mean)
+
+    def var(self, ddof=0):
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return self.__result__(self._m2/(self._count-ddof))
+
+    def std(self, ddof=0):
+        return np.sqrt(self.var(ddof))
+
+    def __repr__(self):
+        return 'Statistics(count=%s, sum=%s, min=%s, max=%s, mean=%s, std=%s)'%(
+                self.count(), self.sum(), self.min(), self.max(), self.mean(), self.std())
+
+class Histogram(object):
+    ''' Mergeable fixed bin histogram.
+
+        range is a (min, max) tuple or, if nbands is not None, can be a list of
+        (min, max) tuples, one per band. Values outside the range are counted
+        in `outside`. Masked (numpy.ma) and NaN values are ignored.
+    '''
+    def __init__(self, bins, range, nbands=None):
+        self.nbands=nbands
+        n=1 if nbands is None else nbands
+        self.bins=int(bins)
+        range=np.array(range,np.float64)
+        if range.ndim==1:range=np.tile(range,(n,1))
+        self._min,self._max=range[:,0],range[:,1]
+        self._counts=np.zeros((n,self.bins),np.int64)
+        self._outside=np.zeros(n,np.int64)
+
+    @property
+    def edges(self):
+        edges=np.array([np.linspace(lo,hi,self.bins+1) for lo,hi in zip(self._min,self._max)])
+        if self.nbands is None:return edges[0]
+        else:return edges
+
+    @property
+    def counts(self):
+        if self.nbands is None:return self._counts[0]
+        else:return self._counts
+
+    @property
+    def outside(self):
+        if self.nbands is None:return self._outside[0]
+        else:return self._outside
+
+    def update(self, data):
+        ''' Add a block (ndarray or MaskedArray) of data'''
+        values,mask=_rows(data,self.nbands is None)
+        rows=values.shape[0]
+        if rows!=len(self._counts):
+            raise ValueError('Expected %s bands, got %s'%(len(self._counts),rows))
+
+        lo,hi=self._min[:,np.newaxis],self._max[:,np.newaxis]
+        valid=~mask
+        inside=valid&(values>=lo)&(values<=hi)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            idx=((values-lo)*(self.bins/(hi-lo))).astype(np.int64)
+        idx=np.clip(idx,0,self.bins-1) #values==max go in the last bin
+        idx=(idx+np.arange(rows)[:,np.newaxis]*self.bins)[inside]
+        self._counts+=np.bincount(idx,minlength=rows*self.bins).reshape(rows,self.bins)
+        self._outside+=(valid&~inside).sum(axis=1)
+        return self
+
+    def merge(self, other):
+        ''' Combine the counts from another Histogram with the same bins'''
+        if self.bins!=other.bins or not (np.all(self._min==other._min) and np.all(self._max==other._max)):
+            raise ValueError('Histogram bins differ')
+        self._counts=self._counts+other._counts
+        self._outside=self._outside+other._outside
+        return self
+
+    def percentile(self, q):
+        ''' Approximate percentile(s) interpolated within the histogram bins'''
+        q=np.asarray(q,np.float64)
+        result=[]
+        for counts,lo,hi in zip(self._counts,self._min,self._max):
+            cdf=np.cumsum(counts)
+            if not cdf[-1]:
+                result.append(np.zeros(q.shape)+np.nan)
+                continue
+            width=(hi-lo)/self.bins
+            target=q/100.0*cdf[-1]
+            i=np.clip(np.searchsorted(cdf,target,'left'),0,self.bins-1)
+            below=np.where(i>0,cdf[i-1],0)
+            with np.errstate(invalid='ignore',divide='ignore'):
+                frac=np.where(counts[i]>0,(target-below)/counts[i],0)
+            result.append(lo+(i+np.clip(frac,0,1))*width)
+        if self.nbands is None:return result[0]
+        else:return np.array(result)
+
+class QuantileSketch(object):
+    ''' Mergeable approximate quantile sketch with bounded memory.
+
+        Values are added to a stack of sorted compactors (a simple KLL/MRL
+        style sketch). When a level holds 2*k values, it is sorted and every
+        second value is promoted to the next level with double the weight,
+        so memory is O(k*log2(n/k)) regardless of the number of values.
+        Larger k is more accurate. Masked (numpy.ma) and NaN values are ignored.
+    '''
+    def __init__(self, k=2048, nbands=None):
+        self.k=int(k)
+        self.nbands=nbands
+        n=1 if nbands is None else nbands
+        self._levels=[[] for i in range(n)]
+        self._count=np.zeros(n,np.int64)
+        self._offset=0
+
+    def count(self):
+        if self.nbands is None:return self._count[0]
+        else:return self._count.copy()
+
+    def update(self, data):
+        ''' Add a block (ndarray or MaskedArray) of data'''
+        values,mask=_rows(data,self.nbands is None)
+        if values.shape[0]!=len(self._levels):
+            raise ValueError('Expected %s bands, got %s'%(len(self._levels),values.shape[0]))
+        for i in range(values.shape[0]):
+            v=values[i][~mask[i]].astype(np.float64)
+            self._count[i]+=v.size
+            self.__insert__(i,0,v)
+        return self
+
+    def merge(self, other):
+        ''' Combine the values from another QuantileSketch'''
+        if len(other._levels)!=len(self._levels):raise ValueError('Number of bands differ')
+        for i,levels in enumerate(other._levels):
+            for level,values in enumerate(levels):
+                self.__insert__(i,level,values)
+            self._count[i]+=other._count[i]
+        return self
+
+    def __insert__(self, band, level, values):
+        levels=self._levels[band]
+        while values.size:
+            if len(levels)<=level:levels.append(np.empty(0,np.float64))
+            values=np.concatenate((levels[level],values))
+            if values.size<2*self.k:
+                levels[level]=values
+                return
+            values.sort()
+            if values.size%2:levels[level],values=values[-1:],values[:-1]
+            else:levels[level]=np.empty(0,np.float64)
+            #Alternate the compaction offset so errors don't accumulate in one direction
+            self._offset^=1
+            values=values[self._offset::2]
+            level+=1
+
+    def quantile(self, q):
+        ''' Approximate quantile(s), q in the range 0-1'''
+        q=np.asarray(q,np.float64)
+        result=[]
+        for levels in self._levels:
+            values=[v for v in levels if v.size]
+            if not values:
+                result.append(np.zeros(q.shape)+np.nan)
+                continue
+            weights=np.concatenate([np.zeros(v.size,np.float64)+2.0**l for l,v in enumerate(levels) if v.size])
+            values=np.concatenate(values)
+            order=np.argsort(values)
+            values,cdf=values[order],np.cumsum(weights[order])
+            i=np.searchsorted(cdf,q*cdf[-1],'left')
+            result.append(values[np.clip(i,0,values.size-1)])
+        if self.nbands is None:return result[0]
+        else:return np.array(result)
+
+    def percentile(self, q):
+        ''' Approximate percentile(s), q in the range 0-100'''
+        return self.quantile(np.asarray(q,np.float64)/100.0)
+
+class ZonalStatistics(object):
+    ''' Mergeable per zone count, sum, min, max, mean and variance.
+
+        Blocks of values and zones are added with `update`, values are grouped
+        by zone with numpy.bincount so memory use depends on the number of zones,
+        not the number of values. Masked (numpy.ma) and NaN values and zones are
+        ignored. Multiband values are pooled, i.e. the zones apply to each band.
+    '''
+    def __init__(self):
+        self._zones=None
+        self._stats=Statistics(0)
+
+    def update(self, data, zones):
+        ''' Add a block (ndarray or MaskedArray) of data and the matching zones'''
+        values,mask=_rows(data,True)
+        z,zmask=_rows(zones,True)
+        if values.shape[1]!=z.shape[1]: #Multiband values
+            nbands=values.shape[1]//z.shape[1]
+            z,zmask=np.tile(z,nbands),np.tile(zmask,nbands)
+        valid=~(mask[0]|zmask[0])
+        values,z=values[0][valid].astype(np.float64),z[0][valid]
+        if not values.size:return self
+
+        ids,idx=np.unique(z,return_inverse=True)
+        n=len(ids)
+        part=Statistics(n)
+        part._count=np.bincount(idx,minlength=n).astype(np.int64)
+        part._sum=np.bincount(idx,values,n)
+        part._mean=part._sum/part._count
+        part._m2=np.bincount(idx,(values-part._mean[idx])**2,n)
+        order=np.argsort(idx,kind='mergesort')
+        starts=np.concatenate(([0],np.cumsum(part._count)[:-1]))
+        part._min=np.minimum.reduceat(values[order],starts)
+        part._max=np.maximum.reduceat(values[order],starts)
+        return self.__merge__(ids,part)
+
+    def merge(self, other):
+        ''' Combine the partial statistics from another ZonalStatistics object'''
+        return self.__merge__(other._zones,other._stats)
+
+    def __merge__(self, zones, stats):
+        if zones is None:return self
+        if self._zones is None:
+            self._zones,self._stats=zones,self.__expand__(zones,zones,stats)
+            return self
+        union=np.union1d(self._zones,zones)
+        merged=self.__expand__(union,self._zones,self._stats)
+        self._stats=merged.merge(self.__expand__(union,zones,stats))
+        self._zones=union
+        return self
+
+    def __expand__(self, union, zones, stats):
+        ''' Reindex Statistics to the union of zones'''
+        if len(zones)==len(union):return Statistics(len(union)).merge(stats) #copy
+        idx=np.searchsorted(union,zones)
+        expanded=Statistics(len(union))
+        for attr in ('_count','_sum','_min','_max','_mean','_m2'):
+            getattr(expanded,attr)[idx]=getattr(stats,attr)
+        return expanded
+
+    def zones(self):
+        if self._zones is None:return np.empty(0)
+        return self._zones.copy()
+
+    def count(self):
+        return self._stats.count()
+
+    def sum(self):
+        return self._stats.sum()
+
+    def min(self):
+        return self._stats.min()
+
+    def max(self):
+        return self._stats.max()
+
+    def mean(self):
+        return self._stats.mean()
+
+    def var(self, ddof=0):
+        return self._stats.var(ddof)
+
+    def std(self, ddof=0):
+        return self._stats.std(ddof)
+
+    def table(self, stats=['count','sum','mean']):
+        ''' Return a numpy record array with a zone field and a field for each statistic'''
+        fields=[self.zones()]+[getattr(self,stat)() for stat in stats]
+        return np.rec.fromarrays(fields,names=['zone']+list(stats))
+
+@profilenode('zonal_stats')
+def zonal_stats(values, zones, stats=['count','sum','mean']):
+    ''' Calculate statistics of a values Dataset/Band for each zone in a zones
+        Dataset/Band, block by block.
+
+        The rasters are aligned with the Env settings (extent, cellsize, srs...)
+        and NoData (if Env.nodata is set) and NaN values and zones are ignored.
+        stats can include any of count, sum, min, max, mean, var and std.
+
+        Returns a numpy record array with one row per zone.
+    '''
+    for stat in stats:
+        if stat not in ('count','sum','min','max','mean','var','std'):
+            raise ValueError('%s not one of count|sum|min|max|mean|var|std'%repr(stat))
+    from gdal_dataset import Block #Deferred, gdal_dataset imports this module
+    values,zones=values.apply_environment(zones)
+
+    zonal=ZonalStatistics()
+    if Env.tiled:windows=list(values.__windows__())
+    else:windows=[(0, 0, values.x_size, values.y_size)]
+    Env.progress.start(windows,values)
+    for window in windows:
+        if Env.sparse and Env.nodata and values.__isempty__(*window):
+            Env.progress.update_progress()
+            continue
+        data=values.__readblock__(*window).data
+        zonal.update(data,zones.__readblock__(*window).data)
+        Env.progress.update_progress()
+
+    Block.clear_mask_cache()
+    return zonal.table(stats)